@@ -2,9 +2,106 @@ import requests, json
 import streamlit as st
 from PIL import Image, UnidentifiedImageError, ImageFile
 from io import BytesIO
-from db import bytes_to_megabytes
+from assetCatalog import AssetCatalog
 from pillow_heif import register_heif_opener
 import os
+import re
+import time
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import inc, observe, timer
+
+# Defaults for the shared HTTP client
+DEFAULT_TIMEOUT_MS = 2000        # Connect/read timeout for small requests
+DEFAULT_LONG_READ_TIMEOUT = 300  # Read timeout (s) for asset lists and original downloads
+DEFAULT_POOL_SIZE = 8
+DEFAULT_RETRIES = 3
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+_ASSET_ID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+def _endpoint(path):
+    """The path of a request without its query and with asset ids replaced, so metrics have one series per endpoint."""
+    return _ASSET_ID.sub('{id}', path.split('?', 1)[0]).rstrip('/')
+
+def _record_request(method, path, status, seconds, size):
+    endpoint = _endpoint(path)
+    observe('immich_http_request_duration_seconds', seconds, method=method, path=endpoint)
+    inc('immich_http_requests_total', method=method, path=endpoint, status=status)
+    if size:
+        inc('immich_http_response_bytes_total', size, path=endpoint)
+
+class ImmichClient:
+    """Keep-alive HTTP session for one Immich server with a sized connection pool,
+    default timeouts and retries with exponential backoff on 429/5xx responses."""
+
+    def __init__(self, immich_server_url, api_key, timeout_ms=DEFAULT_TIMEOUT_MS, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES):
+        self.base_url = immich_server_url.rstrip('/')
+        self.timeout = max(float(timeout_ms or DEFAULT_TIMEOUT_MS), 1.0) / 1000
+        self.session = requests.Session()
+        self.session.headers.update({'x-api-key': api_key})
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def long_timeout(self):
+        """(connect, read) timeout for requests that transfer a lot of data."""
+        return (self.timeout, max(self.timeout, DEFAULT_LONG_READ_TIMEOUT))
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.exceptions.RequestException:
+            _record_request(method, path, 'error', time.perf_counter() - start, 0)
+            raise
+        _record_request(method, path, response.status_code, time.perf_counter() - start, len(response.content))
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+_client_settings = {'timeout_ms': DEFAULT_TIMEOUT_MS, 'pool_size': DEFAULT_POOL_SIZE, 'retries': DEFAULT_RETRIES}
+_clients = {}
+_clients_lock = threading.Lock()
+
+def configureClient(timeout_ms=DEFAULT_TIMEOUT_MS, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES):
+    """Set the timeout, pool size and retry count used by the shared clients."""
+    settings = {'timeout_ms': timeout_ms, 'pool_size': max(1, int(pool_size)), 'retries': retries}
+    with _clients_lock:
+        if settings != _client_settings:
+            _client_settings.update(settings)
+            for client in _clients.values():
+                client.session.close()
+            _clients.clear()
+
+def getClient(immich_server_url, api_key):
+    """Return the process-wide ImmichClient for this server and API key."""
+    key = (immich_server_url.rstrip('/'), api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = ImmichClient(immich_server_url, api_key, **_client_settings)
+            _clients[key] = client
+        return client
 
 @st.cache_data(show_spinner=True) 
 def fetchAssets(immich_server_url, api_key, timeout, type):
@@ -16,14 +113,13 @@ def fetchAssets(immich_server_url, api_key, timeout, type):
     # Initialize assets to None or an empty list, depending on your usage expectation
     assets = []
 
-    # Remove trailing slash from immich_server_url if present
-    base_url = immich_server_url.rstrip('/')
-    asset_info_url = f"{base_url}/api/asset/"
+    client = getClient(immich_server_url, api_key)
+    connect_timeout = max(float(timeout or DEFAULT_TIMEOUT_MS), 1.0) / 1000
     
     try:
         with st.spinner('Fetching assets...'):
             # Make the HTTP GET request
-            response = requests.get(asset_info_url, headers={'Accept': 'application/json', 'x-api-key': api_key}, verify=False, timeout=timeout)
+            response = client.get("/api/asset/", headers={'Accept': 'application/json'}, verify=False, timeout=(connect_timeout, DEFAULT_LONG_READ_TIMEOUT))
             response.raise_for_status()  # This will raise an exception for HTTP errors
             
             content_type = response.headers.get('Content-Type', '')
@@ -54,64 +150,76 @@ def fetchAssets(immich_server_url, api_key, timeout, type):
     message_placeholder.text(st.session_state['fetch_message'])
     return assets
 
-def getImage(asset_id, immich_server_url,photo_choice,api_key):   
-    # Determine whether to fetch the original or thumbnail based on user selection
+def fetchAssetPage(immich_server_url, api_key, skip, take, updated_after=None):
+    """Fetch one page of assets, optionally only those updated after an ISO timestamp.
+    Raises requests exceptions on failure."""
+    client = getClient(immich_server_url, api_key)
+    params = {'skip': skip, 'take': take}
+    if updated_after:
+        params['updatedAfter'] = updated_after
+    response = client.get("/api/asset", params=params, headers={'Accept': 'application/json'}, verify=False, timeout=client.long_timeout())
+    response.raise_for_status()
+    return response.json() if response.text else []
+
+def fetchDeletedAssetIds(immich_server_url, api_key, after):
+    """Return (needs_full_sync, ids) for assets deleted since an ISO timestamp, using the audit log.
+    Raises requests exceptions on failure."""
+    client = getClient(immich_server_url, api_key)
+    response = client.get("/api/audit/deletes", params={'entityType': 'ASSET', 'after': after}, headers={'Accept': 'application/json'})
+    response.raise_for_status()
+    result = response.json()
+    return result.get('needsFullSync', False), result.get('ids', [])
+
+def fetchImageBytes(asset_id, immich_server_url, photo_choice, api_key):
+    """Download the raw bytes of a thumbnail or original image, or None if the request failed or the asset is not an image."""
+    client = getClient(immich_server_url, api_key)
+    try:
+        if photo_choice == 'Thumbnail (fast)':
+            response = client.get(f"/api/asset/thumbnail/{asset_id}?format=JPEG", headers={'Accept': 'application/octet-stream'})
+        else:
+            response = client.post(f"/api/download/asset/{asset_id}", headers={'Accept': 'application/octet-stream'}, timeout=client.long_timeout())
+    except requests.exceptions.RequestException:
+        # Timeouts and connection errors are counted by the request metrics
+        return None
+
+    if response.status_code == 200 and 'image/' in response.headers.get('Content-Type', ''):
+        return response.content
+    return None
+
+def decodeImage(content, asset_id=None):
+    """Decode downloaded image bytes into a fully loaded PIL image, or None if they can't be identified."""
     register_heif_opener()
     ImageFile.LOAD_TRUNCATED_IMAGES = True
-    if photo_choice == 'Thumbnail (fast)':
-        response = requests.request("GET", f"{immich_server_url}/api/asset/thumbnail/{asset_id}?format=JPEG", headers={'Accept': 'application/octet-stream','x-api-key': api_key}, data={})
-    else:
-        asset_download_url = f"{immich_server_url}/api/download/asset/{asset_id}"
-        response = requests.post(asset_download_url, headers={'Accept': 'application/octet-stream', 'x-api-key': api_key}, stream=True)
-        
-    if response.status_code == 200 and 'image/' in response.headers.get('Content-Type', ''):
-        image_bytes = BytesIO(response.content)
-        try:
+    image_bytes = BytesIO(content)
+    try:
+        with timer('image_decode_duration_seconds'):
             image = Image.open(image_bytes)
             image.load()  # Force loading the image data while the file is open
-            image_bytes.close()  # Now we can safely close the stream
-            return image
-        except UnidentifiedImageError:
-            print(f"Failed to identify image for asset_id {asset_id}. Content-Type: {response.headers.get('Content-Type')}")
-            image_bytes.close()  # Ensure the stream is closed even if an error occurs
-            return None
-        finally:
-            image_bytes.close()  # Ensure the stream is always closed
-            del image_bytes 
-    else:
-        print(f"Skipping non-image asset_id {asset_id} with Content-Type: {response.headers.get('Content-Type')}")
+        return image
+    except UnidentifiedImageError:
+        inc('image_decode_failures_total')
+        print(f"Failed to identify image for asset_id {asset_id}.")
         return None
+    finally:
+        image_bytes.close()  # Ensure the stream is always closed
+        del image_bytes
 
-def getAssetInfo(asset_id, assets):
-    # Search for the asset in the provided list of assets.
-    asset_info = next((asset for asset in assets if asset['id'] == asset_id), None)
-
-    if asset_info:
-        # Extract all required info.
-        try:
-            formatted_file_size = bytes_to_megabytes(asset_info['exifInfo']['fileSizeInByte'])
-        except KeyError:
-            formatted_file_size = "Unknown"
-        
-        original_file_name = asset_info.get('originalFileName', 'Unknown')
-        resolution = "{} x {}".format(
-            asset_info.get('exifInfo', {}).get('exifImageHeight', 'Unknown'), 
-            asset_info.get('exifInfo', {}).get('exifImageWidth', 'Unknown')
-        )
-        lens_model = asset_info.get('exifInfo', {}).get('lensModel', 'Unknown')
-        creation_date = asset_info.get('fileCreatedAt', 'Unknown')
-        original_path = asset_info.get('originalPath', 'Unknown')
-        is_offline = asset_info.get('isOffline', False)
-        is_trashed = asset_info.get('isTrashed', False)  # Extract isTrashed
-        is_favorite = asset_info.get('isFavorite', False)        
-        # Add more fields as needed and return them
-        return formatted_file_size, original_file_name, resolution, lens_model, creation_date, original_path, is_offline, is_trashed,is_favorite
-    else:
+def getImage(asset_id, immich_server_url,photo_choice,api_key):   
+    # Determine whether to fetch the original or thumbnail based on user selection
+    content = fetchImageBytes(asset_id, immich_server_url, photo_choice, api_key)
+    if content is None:
         return None
+    return decodeImage(content, asset_id)
+
+def getAssetInfo(asset_id, assets):
+    """Return the AssetInfo display record of an asset from an AssetCatalog (or a list of assets), or None."""
+    if not isinstance(assets, AssetCatalog):
+        assets = AssetCatalog(assets)
+    return assets.info(asset_id)
     
 def getServerStatistics(immich_server_url, api_key):
     try:
-        response = requests.get(f"{immich_server_url}/api/server-info/statistics", headers={'Accept': 'application/json', 'x-api-key': api_key})
+        response = getClient(immich_server_url, api_key).get("/api/server-info/statistics", headers={'Accept': 'application/json'})
         if response.ok:        
             return response.json()  # This will parse the JSON response body and return it as a dictionary
         else:
@@ -121,18 +229,16 @@ def getServerStatistics(immich_server_url, api_key):
     
 def deleteAsset(immich_server_url, asset_id, api_key):
     st.session_state['show_faiss_duplicate'] = False
-    url = f"{immich_server_url}/api/asset"
     payload = json.dumps({
         "force": True,
         "ids": [asset_id]
     })
     headers = {
-        'Content-Type': 'application/json',
-        'x-api-key': api_key
+        'Content-Type': 'application/json'
     }
 
     try:
-        response = requests.delete(url, headers=headers, data=payload)
+        response = getClient(immich_server_url, api_key).delete("/api/asset", headers=headers, data=payload)
         if response.status_code == 204:
             st.success(f"Successfully deleted asset with ID: {asset_id}")
             print(f"Successfully deleted asset with ID: {asset_id}")
@@ -150,7 +256,7 @@ def deleteAsset(immich_server_url, asset_id, api_key):
         return False
 
 def updateAsset(immich_server_url, asset_id, api_key, dateTimeOriginal, description, isFavorite, latitude, longitude, isArchived):
-    url = f"{immich_server_url}/api/asset/{asset_id}"  # Ensure the URL is constructed correctly
+    path = f"/api/asset/{asset_id}"
     
     payload = json.dumps({
         "dateTimeOriginal": dateTimeOriginal,
@@ -163,12 +269,11 @@ def updateAsset(immich_server_url, asset_id, api_key, dateTimeOriginal, descript
     
     headers = {
         'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'x-api-key': api_key  # Authorization via API key
+        'Accept': 'application/json'
     }
 
     try:
-        response = requests.put(url, headers=headers, data=payload)
+        response = getClient(immich_server_url, api_key).put(path, headers=headers, data=payload)
         if response.status_code == 200:
             response_data = response.json()
             st.success(f"Successfully move on archive asset with ID: {asset_id}")
@@ -190,7 +295,8 @@ def getVideoAndSave(asset_id, immich_server_url,api_key,save_directory):
     if not os.path.exists(save_directory):
         os.makedirs(save_directory)
 
-    response = requests.get(f"{immich_server_url}/api/download/asset/{asset_id}", headers={'Accept': 'application/octet-stream', 'x-api-key': api_key}, stream=True)
+    client = getClient(immich_server_url, api_key)
+    response = client.get(f"/api/download/asset/{asset_id}", headers={'Accept': 'application/octet-stream'}, timeout=client.long_timeout())
     file_path = os.path.join(save_directory, f"{asset_id}.mp4")
 
     if response.status_code == 200 and 'video/' in response.headers.get('Content-Type', ''):
@@ -1,16 +1,29 @@
 import streamlit as st
 import os
+import time
+from datetime import datetime
 
-from api import fetchAssets
-from db import startup_db_configurations, startup_processed_assets_db, startup_processed_duplicate_faiss_db
+from api import configureClient
+from assetSync import getAssetCatalog, isCatalogSynced
+from db import startup_db_configurations, startup_processed_assets_db, startup_processed_duplicate_faiss_db, DUPLICATE_METHODS
+from hammingIndex import HASH_ENGINES, DEFAULT_MAX_DISTANCE, DEFAULT_BRUTE_FORCE_WORKERS
+from cascade import DEFAULT_CASCADE_HASH_DISTANCE, DEFAULT_CASCADE_TIME_WINDOW
 from startup import startup_sidebar
-from imageDuplicate import generate_db_duplicate,show_duplicate_photos_faiss,calculateFaissIndex
+from jobManager import get_job_manager, ACTIVE_STATUSES, RESUMABLE_STATUSES
+from metrics import registry as metrics_registry
+from backbones import backbone_names, normalizes_embeddings, DEFAULT_BACKBONE
+from inferenceBackend import BACKENDS, QUANTIZED_BACKENDS, DEFAULT_BACKEND, DEFAULT_QUANTIZE
+from embeddingStore import EMBEDDING_DTYPES, DEFAULT_EMBEDDING_DTYPE
+from indexFactory import INDEX_TYPES, DEFAULT_INDEX_TYPE, DEFAULT_NLIST, DEFAULT_HNSW_M, DEFAULT_PQ_M, DEFAULT_NPROBE, DEFAULT_EF_SEARCH
 
 
 # Set the environment variable to allow multiple OpenMP libraries
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 ###############STARTUP#####################
 
+JOB_HISTORY = 10           # jobs listed in the job panel
+JOB_REFRESH_INTERVAL = 2   # seconds between reruns while a job runs
+
 # Set page title and favicon
 st.set_page_config(page_title="Immich duplicator finder ", page_icon="https://immich.app/img/immich-logo-stacked-dark.svg")
 
@@ -30,11 +43,46 @@ def setup_session_state():
         'calculate_faiss': False,
         'generate_db_duplicate': False,
         'show_faiss_duplicate': False,
+        'sync_assets': False,
+        'full_sync': False,
         'avoid_thumbnail_jpeg': True,
         'is_trashed': False,
         'is_favorite': True,
         'stop_process' : False,
-        'stop_index' : False,
+        'faiss_flush_interval': 60,
+        'faiss_flush_batches': 20,
+        'inference_batch_size': 32,
+        'inference_threads': 0,
+        'fetch_workers': 8,
+        'decode_workers': 4,
+        'index_processes': 1,
+        'merge_shards': False,
+        'embedding_model': DEFAULT_BACKBONE,
+        'inference_backend': DEFAULT_BACKEND,
+        'inference_int8': DEFAULT_QUANTIZE,
+        'embedding_dtype': DEFAULT_EMBEDDING_DTYPE,
+        'check_backend': False,
+        'search_mode': 'knn',
+        'search_k': 5,
+        'search_radius': 0.6,
+        'index_type': DEFAULT_INDEX_TYPE,
+        'index_nlist': DEFAULT_NLIST,
+        'index_hnsw_m': DEFAULT_HNSW_M,
+        'index_pq_m': DEFAULT_PQ_M,
+        'index_nprobe': DEFAULT_NPROBE,
+        'index_ef_search': DEFAULT_EF_SEARCH,
+        'rebuild_faiss': False,
+        'find_exact_duplicates': False,
+        'calculate_phash': False,
+        'generate_phash_duplicates': False,
+        'phash_max_distance': DEFAULT_MAX_DISTANCE,
+        'phash_engine': 'multi-index',
+        'run_cascade': False,
+        'cascade_hash_distance': DEFAULT_CASCADE_HASH_DISTANCE,
+        'cascade_time_window': DEFAULT_CASCADE_TIME_WINDOW,
+        'duplicate_method': 'faiss',
+        'auto_refresh_jobs': True,
+        'show_metrics': False,
         'photo_choice': 'Thumbnail (fast)'  # Initialize with default action to not show duplicates
     }
     for key, default_value in session_defaults.items():
@@ -43,9 +91,18 @@ def setup_session_state():
 
 def configure_sidebar():
     """Configure the sidebar for user inputs."""
+    # Normalized embeddings are at most 4 apart (squared L2); legacy logit indexes have larger distances
+    max_distance = 4.0 if normalizes_embeddings(st.session_state['embedding_model']) else 10.0
     with st.sidebar:
         st.markdown("---")
         with st.expander("Image Duplicate Finder", expanded=True):
+            # Buttons to update the local asset catalog from the server
+            if st.button('Sync assets', help="Fetch only the assets changed or deleted since the last sync."):
+                st.session_state['sync_assets'] = True
+            if st.button('Full asset resync', help="Fetch every asset again and drop the ones deleted on the server."):
+                st.session_state['sync_assets'] = True
+                st.session_state['full_sync'] = True
+
             # Button to generate/update the FAISS index
             if st.button('Create/Update FAISS index'):
                 st.session_state['calculate_faiss'] = True
@@ -54,18 +111,80 @@ def configure_sidebar():
             if st.button('Create/Update duplicate DB'):
                 st.session_state['generate_db_duplicate'] = True
 
+            # Options for the all-pairs duplicate search
+            st.session_state['search_mode'] = st.selectbox(
+                "Duplicate search mode", ['knn', 'range'],
+                index=['knn', 'range'].index(st.session_state['search_mode']),
+                help="'knn' pairs every image with its k nearest neighbours; 'range' with every image closer than the range threshold."
+            )
+            if st.session_state['search_mode'] == 'knn':
+                st.session_state['search_k'] = st.number_input(
+                    "Neighbours per image (k)", min_value=1, max_value=100,
+                    value=st.session_state['search_k'], step=1,
+                    help="Number of nearest neighbours stored as candidate duplicates for every image."
+                )
+            else:
+                st.session_state['search_radius'] = st.number_input(
+                    "Range threshold", min_value=0.0, max_value=max_distance,
+                    value=min(st.session_state['search_radius'], max_distance), step=0.01,
+                    help="Store every pair of images whose FAISS distance is below this threshold. "
+                         "Embeddings are normalized, so the distance is 2 - 2 x their cosine similarity."
+                )
+
+            st.markdown("---")
+            # Byte-identical copies are found from the catalog alone, without downloading anything
+            if st.button('Find exact duplicates', help="Pair assets with the same checksum and file size and store them as 'checksum' duplicates."):
+                st.session_state['find_exact_duplicates'] = True
+
+            st.markdown("---")
+            # Perceptual hashes find near-identical images without the embedding model
+            if st.button('Calculate pHashes'):
+                st.session_state['calculate_phash'] = True
+            st.session_state['phash_max_distance'] = st.number_input(
+                "pHash max distance (bits)", min_value=0, max_value=32,
+                value=st.session_state['phash_max_distance'], step=1,
+                help="Store every pair of images whose 64-bit pHashes differ in at most this many bits."
+            )
+            st.session_state['phash_engine'] = st.selectbox(
+                "pHash search engine", HASH_ENGINES,
+                index=HASH_ENGINES.index(st.session_state['phash_engine']),
+                help="'multi-index' only compares hashes sharing a chunk of bits. 'brute-force' compares every pair on all CPU cores; it is exact and serves as a reference."
+            )
+            if st.button('Find pHash duplicates'):
+                st.session_state['generate_phash_duplicates'] = True
+
+            st.markdown("---")
+            # Cheap thumbnail hashes and EXIF pick the candidates; only those are embedded
+            st.session_state['cascade_hash_distance'] = st.number_input(
+                "Cascade hash distance (bits)", min_value=0, max_value=32,
+                value=st.session_state['cascade_hash_distance'], step=1,
+                help="Thumbnails whose dHash or pHash differ in at most this many bits become candidate pairs."
+            )
+            st.session_state['cascade_time_window'] = st.number_input(
+                "Cascade capture time window (s)", min_value=0, max_value=3600,
+                value=st.session_state['cascade_time_window'], step=1,
+                help="Photos taken this close together with the same aspect ratio also become candidate pairs."
+            )
+            if st.button('Run duplicate cascade', help="Embed only the candidate assets and store their pairs as 'cascade' duplicates."):
+                st.session_state['run_cascade'] = True
+
             st.markdown("---")
+            st.session_state['duplicate_method'] = st.selectbox(
+                "Show duplicates found by", DUPLICATE_METHODS,
+                index=DUPLICATE_METHODS.index(st.session_state['duplicate_method']),
+                help="'faiss' pairs are filtered by the FAISS thresholds below, 'phash' pairs by the pHash max distance. 'checksum' pairs are exact copies at distance 0."
+            )
             # Input for setting the minimum FAISS threshold
             st.session_state['faiss_min_threshold'] = st.number_input(
-                "Minimum Faiss threshold", min_value=0.0, max_value=10.0,
-                value=st.session_state.get('faiss_min_threshold', 0.0), step=0.01,
+                "Minimum Faiss threshold", min_value=0.0, max_value=max_distance,
+                value=min(st.session_state.get('faiss_min_threshold', 0.0), max_distance), step=0.01,
                 help="Set the lower limit of the FAISS similarity threshold for considering duplicates."
             )
 
             # Input for setting the maximum FAISS threshold
             st.session_state['faiss_max_threshold'] = st.number_input(
-                "Maximum Faiss threshold", min_value=0.0, max_value=10.0,
-                value=st.session_state.get('faiss_max_threshold', 0.6), step=0.01,
+                "Maximum Faiss threshold", min_value=0.0, max_value=max_distance,
+                value=min(st.session_state.get('faiss_max_threshold', 0.6), max_distance), step=0.01,
                 help="Set the upper limit of the FAISS similarity threshold for considering duplicates."
             )
 
@@ -79,6 +198,110 @@ def configure_sidebar():
             if st.button('Find duplicate photos'):
                 st.session_state['show_faiss_duplicate'] = True
 
+        with st.expander("Indexing settings", expanded=False):
+            models = backbone_names()
+            st.session_state['embedding_model'] = st.selectbox(
+                "Embedding model", models,
+                index=models.index(st.session_state['embedding_model']),
+                help="Backbone used to embed images. An existing index can only be updated with the model it was built with."
+            )
+            st.session_state['inference_backend'] = st.selectbox(
+                "Inference backend", BACKENDS,
+                index=BACKENDS.index(st.session_state['inference_backend']),
+                help="'torchscript' and 'onnxruntime' export the model once and run the exported graph on CPU."
+            )
+            # torch's dynamic quantization leaves the convolutions in fp32, so only ONNX Runtime offers int8
+            int8_supported = st.session_state['inference_backend'] in QUANTIZED_BACKENDS
+            st.session_state['inference_int8'] = st.checkbox(
+                "int8 quantization", value=st.session_state['inference_int8'] and int8_supported, disabled=not int8_supported,
+                help="Use dynamically quantized int8 weights; only available with the 'onnxruntime' backend. "
+                     "Check the agreement with the fp32 model before indexing."
+            ) and int8_supported
+            if st.button('Check backend agreement'):
+                st.session_state['check_backend'] = True
+
+            st.markdown("---")
+            st.session_state['index_type'] = st.selectbox(
+                "Index type", INDEX_TYPES,
+                index=INDEX_TYPES.index(st.session_state['index_type']),
+                help="'Flat' searches exactly. IVF and HNSW search approximately and are much faster on large libraries; IVFPQ also compresses the vectors."
+            )
+            if st.session_state['index_type'] in ('IVFFlat', 'IVFPQ'):
+                st.session_state['index_nlist'] = st.number_input(
+                    "IVF cells (nlist)", min_value=0, value=st.session_state['index_nlist'], step=64,
+                    help="Number of IVF clusters. 0 picks about 4 x sqrt(number of images)."
+                )
+                st.session_state['index_nprobe'] = st.number_input(
+                    "nprobe", min_value=1, value=st.session_state['index_nprobe'], step=1,
+                    help="IVF clusters visited per query. Higher is slower but finds more duplicates."
+                )
+            if st.session_state['index_type'] == 'IVFPQ':
+                st.session_state['index_pq_m'] = st.number_input(
+                    "PQ sub-quantizers", min_value=0, value=st.session_state['index_pq_m'], step=8,
+                    help="Number of PQ sub-quantizers; must divide the embedding dimension. 0 picks dimension / 8."
+                )
+            if st.session_state['index_type'] == 'HNSW':
+                st.session_state['index_hnsw_m'] = st.number_input(
+                    "HNSW M", min_value=4, max_value=128, value=st.session_state['index_hnsw_m'], step=4,
+                    help="Graph neighbours per node."
+                )
+                st.session_state['index_ef_search'] = st.number_input(
+                    "efSearch", min_value=1, value=st.session_state['index_ef_search'], step=16,
+                    help="Candidate list size per query. Higher is slower but finds more duplicates."
+                )
+            st.session_state['embedding_dtype'] = st.selectbox(
+                "Embedding store precision", EMBEDDING_DTYPES,
+                index=EMBEDDING_DTYPES.index(st.session_state['embedding_dtype']),
+                help="Precision of the embeddings kept on disk for rebuilding the index. float16 halves the file, not the in-memory index; it only applies when the store is first created."
+            )
+            if st.button('Rebuild FAISS index'):
+                st.session_state['rebuild_faiss'] = True
+            if st.button('Merge index shards', help="Add the vectors of index shards written by `python -m cli index --shard I/N` to the index."):
+                st.session_state['merge_shards'] = True
+            st.session_state['faiss_flush_interval'] = st.number_input(
+                "Index flush interval (s)", min_value=1,
+                value=st.session_state['faiss_flush_interval'], step=10,
+                help="Write the FAISS index to disk at most this many seconds apart while indexing."
+            )
+            st.session_state['faiss_flush_batches'] = st.number_input(
+                "Index flush every N batches", min_value=1,
+                value=st.session_state['faiss_flush_batches'], step=1,
+                help="Write the FAISS index to disk after this many batches of vectors have been added."
+            )
+            st.session_state['inference_batch_size'] = st.number_input(
+                "Inference batch size", min_value=1, max_value=1024,
+                value=st.session_state['inference_batch_size'], step=8,
+                help="Number of images embedded together in one model call."
+            )
+            st.session_state['inference_threads'] = st.number_input(
+                "Inference threads", min_value=0, max_value=256,
+                value=st.session_state['inference_threads'], step=1,
+                help="Number of CPU threads used by torch for inference. 0 keeps the torch default."
+            )
+            st.session_state['fetch_workers'] = st.number_input(
+                "Download workers", min_value=1, max_value=64,
+                value=st.session_state['fetch_workers'], step=1,
+                help="Number of thumbnails downloaded concurrently while indexing."
+            )
+            st.session_state['decode_workers'] = st.number_input(
+                "Decode workers", min_value=1, max_value=64,
+                value=st.session_state['decode_workers'], step=1,
+                help="Number of threads decoding and resizing images while indexing."
+            )
+            st.session_state['index_processes'] = st.number_input(
+                "Indexing processes", min_value=1, max_value=64,
+                value=st.session_state['index_processes'], step=1,
+                help="Number of worker processes, each embedding its own share of the assets. Their vectors are merged into the index when all finish."
+            )
+
+        with st.expander("Diagnostics", expanded=False):
+            st.session_state['show_metrics'] = st.checkbox(
+                "Show pipeline metrics", value=st.session_state['show_metrics'],
+                help="Latency and throughput of every stage (downloads, decoding, inference, index, database, pair search) since the app started."
+            )
+            if st.button('Reset metrics'):
+                metrics_registry.reset()
+
         with st.expander("Video Duplicate Finder", expanded=True):
             # Button to generate/update the FAISS index
             if st.button('Find duplicate video'):
@@ -90,41 +313,203 @@ def configure_sidebar():
         additional_data = "Immich duplicator finder"
         st.markdown(f"**Version:** {program_version}\n\n{additional_data}")
 
+def index_job_params():
+    """Parameters of the jobs that embed images, from the indexing settings."""
+    return {
+        'flush_interval': st.session_state['faiss_flush_interval'],
+        'flush_batches': st.session_state['faiss_flush_batches'],
+        'batch_size': st.session_state['inference_batch_size'],
+        'threads': st.session_state['inference_threads'],
+        'fetch_workers': st.session_state['fetch_workers'],
+        'decode_workers': st.session_state['decode_workers'],
+        'model': st.session_state['embedding_model'],
+        'backend': st.session_state['inference_backend'],
+        'int8': st.session_state['inference_int8'],
+        'embedding_dtype': st.session_state['embedding_dtype'],
+        'processes': st.session_state['index_processes'],
+    }
+
+def start_job(kind, **params):
+    """Start a background job; it keeps running across reruns and browser reconnects. Returns True if it started."""
+    try:
+        get_job_manager().start(kind, {'server': immich_server_url, 'api_key': api_key, **params})
+        return True
+    except (RuntimeError, ValueError) as e:
+        st.error(str(e))
+        return False
+
+def show_metrics():
+    """Show the per-stage metrics recorded by this server process, and the same metrics in the Prometheus text format."""
+    st.subheader("Pipeline metrics")
+    since = datetime.fromtimestamp(metrics_registry.started_at).strftime('%Y-%m-%d %H:%M:%S')
+    rows = metrics_registry.summary()
+    if not rows:
+        st.write(f"Nothing recorded since {since}. Run a job to see its stages here.")
+        return
+    st.caption(f"Recorded since {since}. Latency quantiles are the upper bounds of histogram buckets.")
+    st.table(rows)
+    exposition = metrics_registry.render()
+    st.download_button("Download metrics", exposition, file_name='metrics.prom', mime='text/plain')
+    with st.expander("Prometheus text format"):
+        st.code(exposition, language='text')
+
+def show_jobs():
+    """Show the progress of the latest background job and the ones before it. Returns True while a job runs."""
+    manager = get_job_manager()
+    jobs = manager.jobs(limit=JOB_HISTORY)
+    if not jobs:
+        return False
+    job = jobs[0]
+    running = job['status'] in ACTIVE_STATUSES
+    with st.expander(f"Job {job['id']}: {job['kind']} ({job['status']})", expanded=running or job['status'] == 'failed'):
+        if job['total']:
+            st.progress(min(job['done'] / job['total'], 1.0))
+        if job['message']:
+            st.text(job['message'])
+        # Jobs of an earlier process only have their checkpoint
+        for level, text in job.get('logs', []):
+            {'warning': st.warning, 'error': st.error}.get(level, st.write)(text)
+        if job['error'] and 'logs' not in job:
+            st.error(job['error'])
+        for title, rows in job.get('tables', []):
+            if title:
+                st.write(title)
+            st.table(rows)
+
+        if running:
+            col1, col2 = st.columns(2)
+            if col1.button('Stop job', key=f"stop_job_{job['id']}"):
+                manager.stop(job['id'])
+            col2.button('Refresh')
+            st.checkbox(f"Refresh every {JOB_REFRESH_INTERVAL} s while the job runs", key='auto_refresh_jobs')
+        elif job['status'] in RESUMABLE_STATUSES:
+            if st.button('Resume job', key=f"resume_job_{job['id']}", help="Start the job again with the same settings; work already done is skipped."):
+                try:
+                    manager.resume(job['id'], api_key=api_key)
+                    st.rerun()
+                except (RuntimeError, ValueError) as e:
+                    st.error(str(e))
+
+        if len(jobs) > 1:
+            st.write("Earlier jobs:")
+            st.table([{'job': earlier['id'], 'kind': earlier['kind'], 'status': earlier['status'],
+                       'progress': f"{earlier['done']}/{earlier['total']}" if earlier['total'] else earlier['done'],
+                       'started': datetime.fromtimestamp(earlier['started_at']).strftime('%Y-%m-%d %H:%M')} for earlier in jobs[1:]])
+    return running
+
 def main():
     #print(fetchAssets(immich_server_url, api_key,timeout, 'VIDEO'))
     setup_session_state()
     configure_sidebar()
+    # Size the shared HTTP connection pool to the number of download workers
+    configureClient(timeout_ms=timeout, pool_size=st.session_state['fetch_workers'])
     assets = None
 
+    # Long-running work runs as background jobs owned by the server process, not by this script run.
+    # Syncing too: it prunes deleted assets from the index, which must not happen under a running index or merge job.
+    if st.session_state['sync_assets']:
+        full_sync = st.session_state['full_sync']
+        st.session_state['sync_assets'] = False
+        st.session_state['full_sync'] = False
+        start_job('sync', full=full_sync)
+
+    if st.session_state['calculate_faiss']:
+        st.session_state['calculate_faiss'] = False
+        start_job('index', **index_job_params())
+
+    if st.session_state['generate_db_duplicate']:
+        st.session_state['generate_db_duplicate'] = False
+        start_job('pairs', mode=st.session_state['search_mode'], k=st.session_state['search_k'], radius=st.session_state['search_radius'],
+                  nprobe=st.session_state['index_nprobe'], ef_search=st.session_state['index_ef_search'])
+
+    # Rebuild the index as the selected index type
+    if st.session_state['rebuild_faiss']:
+        st.session_state['rebuild_faiss'] = False
+        start_job('rebuild', index_type=st.session_state['index_type'], nlist=st.session_state['index_nlist'],
+                  hnsw_m=st.session_state['index_hnsw_m'], pq_m=st.session_state['index_pq_m'], k=st.session_state['search_k'])
+
+    if st.session_state['merge_shards']:
+        st.session_state['merge_shards'] = False
+        start_job('merge', flush_interval=st.session_state['faiss_flush_interval'], flush_batches=st.session_state['faiss_flush_batches'],
+                  embedding_dtype=st.session_state['embedding_dtype'], remove=True)
+
+    # Hash the photos and pair up those with nearly identical pHashes
+    if st.session_state['calculate_phash']:
+        st.session_state['calculate_phash'] = False
+        start_job('phash')
+
+    if st.session_state['generate_phash_duplicates']:
+        st.session_state['generate_phash_duplicates'] = False
+        start_job('phash-pairs', max_distance=st.session_state['phash_max_distance'], engine=st.session_state['phash_engine'],
+                  workers=DEFAULT_BRUTE_FORCE_WORKERS)
+
+    # Two-stage cascade: hash prefilter, then embeddings for the candidates only
+    if st.session_state['run_cascade']:
+        st.session_state['run_cascade'] = False
+        start_job('cascade', hash_distance=st.session_state['cascade_hash_distance'], time_window=st.session_state['cascade_time_window'],
+                  max_distance=st.session_state['faiss_max_threshold'], **index_job_params())
+
+    job_running = show_jobs()
+    if st.session_state['show_metrics']:
+        show_metrics()
+
     # Attempt to fetch assets if any asset-related operation is to be performed
-    if st.session_state['calculate_faiss'] or st.session_state['generate_db_duplicate'] or st.session_state['show_faiss_duplicate']:
-        assets = fetchAssets(immich_server_url, api_key,timeout, 'IMAGE')
+    # On first use, sync the local asset catalog with a job and carry on once it has finished
+    needs_assets = st.session_state['show_faiss_duplicate'] or st.session_state['check_backend'] or st.session_state['find_exact_duplicates']
+    waiting_for_sync = needs_assets and not isCatalogSynced()
+    if waiting_for_sync:
+        if not job_running:
+            job_running = start_job('sync')
+        st.info("The asset catalog hasn't been synced yet. It is being synced now; this continues once the sync job has finished.")
+        needs_assets = False
+
+    if needs_assets:
+        # Imported here so torch and the embedding model are only loaded when needed
+        from imageDuplicate import show_duplicate_photos_faiss,checkInferenceBackend
+        assets = getAssetCatalog('IMAGE')
         if not assets:
             st.error("No assets found or failed to fetch assets.")
             return  # Stop further execution since there are no assets to process
 
-
-    # Calculate the FAISS index if the corresponding flag is set
-    if st.session_state['calculate_faiss'] and assets:
-        calculateFaissIndex(
-            assets, 
-            immich_server_url, 
-            api_key
+    # Compare the selected inference backend against the fp32 model
+    if st.session_state['check_backend'] and assets:
+        st.session_state['check_backend'] = False
+        checkInferenceBackend(
+            assets,
+            immich_server_url,
+            api_key,
+            model_name=st.session_state['embedding_model'],
+            backend=st.session_state['inference_backend'],
+            quantize=st.session_state['inference_int8'],
+            num_threads=st.session_state['inference_threads']
         )
 
-    # Show FAISS duplicate photos if the corresponding flag is set
-    if st.session_state['generate_db_duplicate']:
-        generate_db_duplicate()
+    # Pair up byte-identical assets from their checksums and file sizes
+    if st.session_state['find_exact_duplicates'] and assets:
+        st.session_state['find_exact_duplicates'] = False
+        from exactDuplicates import saveExactDuplicates
+        groups = saveExactDuplicates(assets)
+        st.write(f"Found {sum(len(group) for group in groups)} assets in {len(groups)} groups of exact duplicates.")
 
     # Show FAISS duplicate photos if the corresponding flag is set
     if st.session_state['show_faiss_duplicate'] and assets:
+        if st.session_state['duplicate_method'] == 'phash':
+            min_threshold, max_threshold = 0, st.session_state['phash_max_distance']
+        else:
+            min_threshold, max_threshold = st.session_state['faiss_min_threshold'], st.session_state['faiss_max_threshold']
         show_duplicate_photos_faiss(
             assets, st.session_state['limit'], 
-            st.session_state['faiss_min_threshold'],
-            st.session_state['faiss_max_threshold'],
+            min_threshold,
+            max_threshold,
             immich_server_url,
-            api_key
+            api_key,
+            methods=[st.session_state['duplicate_method']]
         )
 
+    # Poll the running job, unless duplicates are being reviewed: every rerun would fetch their images again
+    if job_running and st.session_state['auto_refresh_jobs'] and (waiting_for_sync or not st.session_state['show_faiss_duplicate']):
+        time.sleep(JOB_REFRESH_INTERVAL)
+        st.rerun()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
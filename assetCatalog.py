@@ -0,0 +1,66 @@
+from typing import NamedTuple
+from db import bytes_to_megabytes
+
+class AssetInfo(NamedTuple):
+    """Display fields of an asset shown next to a duplicate pair."""
+    file_size: str
+    original_file_name: str
+    resolution: str
+    lens_model: str
+    creation_date: str
+    original_path: str
+    is_offline: bool
+    is_trashed: bool
+    is_favorite: bool
+
+def asset_info_from_asset(asset):
+    """Extract the display fields of an asset dict returned by the Immich API."""
+    exif_info = asset.get('exifInfo') or {}
+    try:
+        formatted_file_size = bytes_to_megabytes(exif_info['fileSizeInByte'])
+    except KeyError:
+        formatted_file_size = "Unknown"
+    resolution = "{} x {}".format(
+        exif_info.get('exifImageHeight', 'Unknown'),
+        exif_info.get('exifImageWidth', 'Unknown')
+    )
+    return AssetInfo(
+        file_size=formatted_file_size,
+        original_file_name=asset.get('originalFileName', 'Unknown'),
+        resolution=resolution,
+        lens_model=exif_info.get('lensModel', 'Unknown'),
+        creation_date=asset.get('fileCreatedAt', 'Unknown'),
+        original_path=asset.get('originalPath', 'Unknown'),
+        is_offline=asset.get('isOffline', False),
+        is_trashed=asset.get('isTrashed', False),
+        is_favorite=asset.get('isFavorite', False),
+    )
+
+class AssetCatalog:
+    """Assets of one fetch indexed by id for constant-time lookups."""
+
+    def __init__(self, assets):
+        self.assets = list(assets)
+        self.by_id = {asset['id']: asset for asset in self.assets}
+        self._info = {}
+
+    def __len__(self):
+        return len(self.assets)
+
+    def __iter__(self):
+        return iter(self.assets)
+
+    def __contains__(self, asset_id):
+        return asset_id in self.by_id
+
+    def get(self, asset_id):
+        return self.by_id.get(asset_id)
+
+    def info(self, asset_id):
+        """Return the AssetInfo of an asset, or None if it isn't in the catalog."""
+        if asset_id not in self._info:
+            asset = self.by_id.get(asset_id)
+            if asset is None:
+                return None
+            self._info[asset_id] = asset_info_from_asset(asset)
+        return self._info[asset_id]
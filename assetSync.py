@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+import requests
+import streamlit as st
+
+from api import fetchAssetPage, fetchDeletedAssetIds
+from assetCatalog import AssetCatalog
+from faissIndex import pruneDeletedAssets
+from db import assets_db, getSyncState, setSyncState, upsertAssets, markAssetsDeleted, markUnseenAssetsDeleted, bumpCatalogVersion, loadCatalogAssets
+
+DEFAULT_PAGE_SIZE = 1000
+# Changes are requested from slightly before the last sync started to absorb clock skew
+SYNC_OVERLAP = timedelta(minutes=5)
+
+def syncAssetCatalog(immich_server_url, api_key, page_size=DEFAULT_PAGE_SIZE, full=False, progress_callback=None):
+    """Bring the local asset catalog in assets.db up to date with the server.
+
+    The first sync (or a full one) pages through every asset and marks the
+    ones the server no longer returns as deleted. Later syncs only page
+    through assets updated since the last sync watermark and take deletions
+    from the server's audit log. Vectors of deleted assets are then removed
+    from the FAISS index. Returns a dict describing what changed.
+    """
+    started = datetime.now(timezone.utc)
+    watermark = getSyncState('watermark')
+    needs_full_sync = full or watermark is None
+    deleted_ids = []
+    if not needs_full_sync:
+        needs_full_sync, deleted_ids = fetchDeletedAssetIds(immich_server_url, api_key, watermark)
+    updated_after = None if needs_full_sync else watermark
+    generation = int(getSyncState('generation', 0)) + 1
+    database = assets_db()
+
+    fetched = 0
+    while True:
+        page = fetchAssetPage(immich_server_url, api_key, fetched, page_size, updated_after)
+        if page:
+            with database.transaction() as conn:
+                upsertAssets(conn, page, generation)
+        fetched += len(page)
+        if progress_callback:
+            progress_callback(fetched)
+        # A short page is the last one; a page larger than requested means the server ignores paging
+        if len(page) != page_size:
+            break
+
+    with database.transaction() as conn:
+        if needs_full_sync:
+            deleted = markUnseenAssetsDeleted(conn, generation)
+        else:
+            markAssetsDeleted(deleted_ids, conn)
+            deleted = len(deleted_ids)
+        setSyncState(conn, 'generation', generation)
+        setSyncState(conn, 'watermark', (started - SYNC_OVERLAP).isoformat())
+        bumpCatalogVersion(conn)
+    pruned = pruneDeletedAssets()
+    return {'full_sync': needs_full_sync, 'fetched': fetched, 'deleted': deleted, 'pruned': pruned}
+
+def isCatalogSynced():
+    return getSyncState('watermark') is not None
+
+def syncAssets(immich_server_url, api_key, full=False):
+    """Sync the asset catalog while showing progress in the app. Returns False if the sync failed."""
+    message_placeholder = st.empty()
+    try:
+        with st.spinner('Syncing assets...'):
+            result = syncAssetCatalog(immich_server_url, api_key, full=full,
+                                      progress_callback=lambda count: message_placeholder.text(f"Synced {count} assets..."))
+    except requests.exceptions.RequestException as e:
+        message_placeholder.text(f'Error syncing assets: {e}')
+        return False
+    kind = 'Full' if result['full_sync'] else 'Incremental'
+    message_placeholder.text(f"{kind} sync complete: {result['fetched']} assets updated, {result['deleted']} deleted, {result['pruned']} removed from the index.")
+    return True
+
+@st.cache_resource(show_spinner="Loading asset catalog...", max_entries=4)
+def _loadAssetCatalog(type, version):
+    return AssetCatalog(loadCatalogAssets(type))
+
+def getAssetCatalog(type):
+    """Return an AssetCatalog of the synced, not deleted assets of a type.
+
+    The catalog is built once per catalog version and shared between reruns
+    without being copied, so it must be treated as read-only."""
+    return _loadAssetCatalog(type, getSyncState('version', '0'))
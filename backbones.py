@@ -0,0 +1,66 @@
+import os
+import streamlit as st
+
+# Registry of embedding backbones: name -> (torchvision constructor, weights enum, embedding dimension, head attribute).
+# The head attribute is replaced by an identity so the model returns the pooled
+# penultimate-layer features instead of the 1000 ImageNet class logits.
+# Names are resolved lazily so importing this module doesn't import torch.
+BACKBONES = {
+    'resnet18': ('resnet18', 'ResNet18_Weights', 512, 'fc'),
+    'resnet50': ('resnet50', 'ResNet50_Weights', 2048, 'fc'),
+    'resnet152': ('resnet152', 'ResNet152_Weights', 2048, 'fc'),
+    'mobilenet_v3_small': ('mobilenet_v3_small', 'MobileNet_V3_Small_Weights', 576, 'classifier'),
+    'mobilenet_v3_large': ('mobilenet_v3_large', 'MobileNet_V3_Large_Weights', 960, 'classifier'),
+    'efficientnet_b0': ('efficientnet_b0', 'EfficientNet_B0_Weights', 1280, 'classifier'),
+    # Indexes built before the registry existed used the ResNet152 class logits
+    'resnet152_logits': ('resnet152', 'ResNet152_Weights', 1000, None),
+}
+
+DEFAULT_BACKBONE = 'mobilenet_v3_large'
+LEGACY_BACKBONE = 'resnet152_logits'
+
+# Directory holding downloaded model weights. When it contains the weight files
+# models load without network access; otherwise they are downloaded into it once.
+# Defaults to the torch hub cache when unset.
+WEIGHTS_DIR = os.environ.get('MODEL_WEIGHTS_DIR') or None
+
+def backbone_names():
+    return list(BACKBONES)
+
+def backbone_dimension(name):
+    """Return the size of the embedding produced by a backbone."""
+    return get_backbone_spec(name)[2]
+
+def normalizes_embeddings(name):
+    """Return True if a backbone's embeddings are indexed as unit vectors.
+
+    The norm of pooled features differs from backbone to backbone, so they are
+    L2-normalized and the index's squared L2 distances (2 - 2 x cosine, from 0
+    to 4) mean the same for every model. Legacy logit indexes keep their raw vectors."""
+    get_backbone_spec(name)
+    return name != LEGACY_BACKBONE
+
+def get_backbone_spec(name):
+    if name not in BACKBONES:
+        raise ValueError(f"Unknown embedding model '{name}'. Available models: {', '.join(BACKBONES)}")
+    return BACKBONES[name]
+
+def load_backbone(name, weights_dir=WEIGHTS_DIR):
+    """Build a backbone with pretrained weights in evaluation mode, returning pooled embeddings."""
+    import torch
+    from torchvision import models
+
+    constructor_name, weights_name, _, head = get_backbone_spec(name)
+    weights = getattr(models, weights_name).DEFAULT
+    model = getattr(models, constructor_name)(weights=None)
+    # Reads weights_dir/<file> if present, otherwise downloads it there
+    model.load_state_dict(weights.get_state_dict(progress=False, model_dir=weights_dir))
+    if head is not None:
+        setattr(model, head, torch.nn.Identity())
+    model.eval()  # Set model to evaluation mode
+    return model
+
+@st.cache_resource(show_spinner="Loading embedding model...")
+def get_model(name=DEFAULT_BACKBONE):
+    """Return the process-wide embedding model for a backbone, loading it on first use."""
+    return load_backbone(name)
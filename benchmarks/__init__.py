@@ -0,0 +1,4 @@
+"""Benchmarks of the indexing and duplicate search pipeline on a synthetic library.
+
+Run `python -m benchmarks.run --help` from the repository directory.
+"""
@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+API_KEY = 'benchmark-key'
+
+def _now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+class FakeImmichServer:
+    """A local HTTP server answering the Immich API calls of api.py from a SyntheticCorpus.
+
+    It serves the asset list (whole or paged, with updatedAfter), the audit
+    log of deletions, thumbnails, original downloads, deletes, updates and
+    server statistics, checking the x-api-key header. `latency` seconds are
+    added to every request to mimic a remote server. Requests and bytes sent
+    are counted per endpoint. Use it as a context manager; `url` is the
+    address to pass as the server URL.
+    """
+
+    def __init__(self, corpus, latency=0.0, api_key=API_KEY, host='127.0.0.1', port=0):
+        self.assets = {asset['id']: dict(asset) for asset in corpus.assets}
+        self.originals = corpus.originals
+        self.thumbnails = corpus.thumbnails
+        self.latency = latency
+        self.api_key = api_key
+        self.deleted = []   # (time, asset id) audit log
+        self.requests = {}
+        self.bytes_sent = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-immich', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent.clear()
+
+    def record(self, endpoint, size):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + size
+
+    def route(self, method, path, query, body):
+        """Return (endpoint name, status, content type, body bytes) of a request."""
+        parts = path.rstrip('/').split('/')
+        if method == 'GET' and path.rstrip('/') == '/api/asset':
+            return 'assets', 200, 'application/json', json.dumps(self._asset_page(query)).encode()
+        if method == 'GET' and path == '/api/audit/deletes':
+            after = query.get('after', [''])[0]
+            ids = [asset_id for deleted_at, asset_id in self.deleted if deleted_at > after]
+            return 'audit', 200, 'application/json', json.dumps({'needsFullSync': False, 'ids': ids}).encode()
+        if method == 'GET' and path.startswith('/api/asset/thumbnail/'):
+            content = self.thumbnails.get(parts[-1]) if parts[-1] in self.assets else None
+            return self._image('thumbnail', content)
+        if method in ('GET', 'POST') and path.startswith('/api/download/asset/'):
+            content = self.originals.get(parts[-1]) if parts[-1] in self.assets else None
+            return self._image('download', content)
+        if method == 'DELETE' and path.rstrip('/') == '/api/asset':
+            deleted_at = _now()
+            with self._lock:
+                for asset_id in json.loads(body or b'{}').get('ids', []):
+                    if self.assets.pop(asset_id, None) is not None:
+                        self.deleted.append((deleted_at, asset_id))
+            return 'delete', 204, 'application/json', b''
+        if method == 'PUT' and path.startswith('/api/asset/'):
+            asset = self.assets.get(parts[-1])
+            if asset is None:
+                return 'update', 404, 'application/json', json.dumps({'message': 'Asset not found'}).encode()
+            changes = json.loads(body or b'{}')
+            with self._lock:
+                asset.update({key: value for key, value in changes.items() if key in ('description', 'isArchived', 'isFavorite')})
+                asset['updatedAt'] = _now()
+            return 'update', 200, 'application/json', json.dumps(asset).encode()
+        if method == 'GET' and path == '/api/server-info/statistics':
+            usage = sum(len(self.originals[asset_id]) for asset_id in self.assets)
+            return 'statistics', 200, 'application/json', json.dumps({'photos': len(self.assets), 'videos': 0, 'usage': usage}).encode()
+        return 'unknown', 404, 'application/json', json.dumps({'message': f"Cannot {method} {path}"}).encode()
+
+    def _asset_page(self, query):
+        assets = list(self.assets.values())
+        updated_after = query.get('updatedAfter', [None])[0]
+        if updated_after:
+            assets = [asset for asset in assets if asset['updatedAt'] > updated_after]
+        if 'take' in query:
+            skip = int(query.get('skip', ['0'])[0])
+            assets = assets[skip:skip + int(query['take'][0])]
+        return assets
+
+    def _image(self, endpoint, content):
+        if content is None:
+            return endpoint, 404, 'application/json', json.dumps({'message': 'Asset not found'}).encode()
+        return endpoint, 200, 'image/jpeg', content
+
+def _handler_for(server):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, like the real server, so the client's connection pool is what gets measured
+        protocol_version = 'HTTP/1.1'
+
+        def _handle(self):
+            if server.latency:
+                time.sleep(server.latency)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            if self.headers.get('x-api-key') != server.api_key:
+                endpoint, status, content_type, content = 'unauthorized', 401, 'application/json', b'{"message": "Invalid API key"}'
+            else:
+                url = urlsplit(self.path)
+                endpoint, status, content_type, content = server.route(self.command, url.path, parse_qs(url.query), body)
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            server.record(endpoint, len(content))
+
+        do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,396 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+# The benchmarks import the app's modules from the repository directory
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic import SyntheticCorpus, TRANSFORMS
+from benchmarks.fakeImmich import FakeImmichServer, API_KEY
+from metrics import registry as metrics_registry
+
+RESULTS_VERSION = 1
+DEFAULT_HASH_THRESHOLDS = '0,2,4,6,8,10,12,16'
+DEFAULT_RADII = '0.1,0.2,0.4,0.6,0.8,1.0,1.5,2.0'
+# Training IVFPQ's codebooks takes minutes on a few CPUs, so it only runs when asked for
+DEFAULT_INDEX_TYPES = 'Flat,IVFFlat,HNSW'
+# Ratios of a timing to its baseline beyond which compare() flags a change
+REGRESSION_RATIO = 1.10
+IMPROVEMENT_RATIO = 0.90
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _rate(items, seconds):
+    return round(items / seconds, 2) if seconds else None
+
+def _thresholds(value, cast):
+    return [cast(part) for part in value.split(',') if part.strip()]
+
+class BenchmarkContext:
+    """State shared by the benchmarks of one run: the arguments, the corpus, the fake server and the synced catalog."""
+
+    def __init__(self, args, corpus, server):
+        self.args = args
+        self.corpus = corpus
+        self.server = server
+        self.catalog = None
+        self.exact_pairs = []
+
+    def ensure_catalog(self):
+        if self.catalog is None:
+            from assetSync import syncAssetCatalog
+            from assetCatalog import AssetCatalog
+            from db import loadCatalogAssets
+            syncAssetCatalog(self.server.url, API_KEY, page_size=self.args.page_size)
+            self.catalog = AssetCatalog(loadCatalogAssets('IMAGE'))
+        return self.catalog
+
+def bench_sync(ctx):
+    """Page the asset list into assets.db."""
+    from assetSync import syncAssetCatalog
+    from assetCatalog import AssetCatalog
+    from db import loadCatalogAssets
+    ctx.server.reset_counters()
+    result, seconds = _timed(syncAssetCatalog, ctx.server.url, API_KEY, page_size=ctx.args.page_size, full=True)
+    ctx.catalog = AssetCatalog(loadCatalogAssets('IMAGE'))
+    return {'seconds': round(seconds, 4), 'assets': result['fetched'], 'assets_per_second': _rate(result['fetched'], seconds),
+            'requests': ctx.server.requests.get('assets', 0), 'bytes': ctx.server.bytes_sent.get('assets', 0)}
+
+def _download_all(ctx, photo_choice):
+    from api import fetchImageBytes
+    asset_ids = [asset['id'] for asset in ctx.ensure_catalog()]
+    ctx.server.reset_counters()
+    def fetch(asset_id):
+        return fetchImageBytes(asset_id, ctx.server.url, photo_choice, API_KEY)
+    with ThreadPoolExecutor(max_workers=ctx.args.fetch_workers) as executor:
+        contents, seconds = _timed(lambda: list(executor.map(fetch, asset_ids)))
+    received = sum(len(content) for content in contents if content)
+    return {'seconds': round(seconds, 4), 'images': len(asset_ids), 'failed': sum(content is None for content in contents),
+            'images_per_second': _rate(len(asset_ids), seconds), 'megabytes_per_second': _rate(received / 1e6, seconds),
+            'workers': ctx.args.fetch_workers}
+
+def bench_thumbnails(ctx):
+    """Download every thumbnail through the shared client with fetch_workers threads."""
+    return _download_all(ctx, "Thumbnail (fast)")
+
+def bench_originals(ctx):
+    """Download every original through the shared client with fetch_workers threads."""
+    return _download_all(ctx, "Original Photo (slow)")
+
+def bench_decode(ctx):
+    """Decode the thumbnails and originals and hash the thumbnails, on one thread."""
+    from api import decodeImage
+    from cascade import thumbnail_hashes
+    results = {}
+    for name, contents in (('thumbnails', ctx.corpus.thumbnails), ('originals', ctx.corpus.originals)):
+        images, seconds = _timed(lambda: [decodeImage(content) for content in contents.values()])
+        results[f"{name}_seconds"] = round(seconds, 4)
+        results[f"{name}_per_second"] = _rate(len(images), seconds)
+        if name == 'thumbnails':
+            _, seconds = _timed(lambda: [thumbnail_hashes(image) for image in images])
+            results['thumbnail_hashes_per_second'] = _rate(len(images), seconds)
+    return results
+
+def bench_exact(ctx):
+    """Pair byte-identical assets from their checksums."""
+    from exactDuplicates import saveExactDuplicates, exact_duplicate_pairs
+    groups, seconds = _timed(saveExactDuplicates, ctx.ensure_catalog())
+    ctx.exact_pairs = exact_duplicate_pairs(groups)
+    return {'seconds': round(seconds, 4), 'groups': len(groups), 'score': ctx.corpus.score(ctx.exact_pairs)}
+
+def bench_phash(ctx):
+    """Hash the originals downloaded from the server, then score the pHash pairs at every threshold."""
+    from imageProcessing import calculatepHashPhotos
+    from hammingIndex import phash_to_int, pack_hashes, find_hash_pairs
+    from db import getPhashes
+    catalog = ctx.ensure_catalog()
+    summary, seconds = _timed(calculatepHashPhotos, catalog, ctx.server.url, API_KEY)
+    rows = [(asset_id, phash_to_int(value)) for asset_id, value in getPhashes() if asset_id in catalog]
+    asset_ids = [asset_id for asset_id, _ in rows]
+    thresholds = _thresholds(ctx.args.hash_thresholds, int)
+    pairs = [pair for block in find_hash_pairs(asset_ids, pack_hashes([value for _, value in rows]), max(thresholds)) for pair in block]
+    return {'seconds': round(seconds, 4), 'images_per_second': _rate(summary['processed'], seconds), 'summary': summary,
+            'scores': {str(threshold): ctx.corpus.score([pair for pair in pairs if pair[2] <= threshold]) for threshold in thresholds},
+            'recall_by_transform': ctx.corpus.recall_by_transform([pair for pair in pairs if pair[2] <= 6])}
+
+def _planted_hashes(count, seed, near_share=0.1, max_flips=4):
+    """Random 64-bit hashes where near_share of them are copies of another with up to max_flips bits flipped."""
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, 2 ** 63, size=count, dtype='int64').astype('uint64') | (rng.integers(0, 2, size=count).astype('uint64') << np.uint64(63))
+    near = rng.choice(count, size=int(count * near_share), replace=False)
+    for index in near.tolist():
+        flips = rng.choice(64, size=rng.integers(0, max_flips + 1), replace=False)
+        value = int(hashes[rng.integers(0, count)])
+        for bit in flips.tolist():
+            value ^= 1 << bit
+        hashes[index] = value
+    return hashes
+
+def bench_hash_search(ctx):
+    """Pair --hashes planted 64-bit hashes with both engines; the exact brute-force engine is the oracle."""
+    from hammingIndex import find_hash_pairs, HASH_ENGINES
+    hashes = _planted_hashes(ctx.args.hashes, ctx.args.seed)
+    asset_ids = list(range(len(hashes)))
+    results, found = {'hashes': len(hashes), 'max_distance': ctx.args.max_distance}, {}
+    for engine in HASH_ENGINES:
+        pairs, seconds = _timed(lambda: {(min(a, b), max(a, b)) for block in find_hash_pairs(
+            asset_ids, hashes, ctx.args.max_distance, engine=engine, workers=ctx.args.workers) for a, b, _ in block})
+        found[engine] = pairs
+        results[engine] = {'seconds': round(seconds, 4), 'pairs': len(pairs), 'hashes_per_second': _rate(len(hashes), seconds)}
+    oracle = found['brute-force']
+    for engine, pairs in found.items():
+        results[engine]['recall'] = round(len(pairs & oracle) / len(oracle), 4) if oracle else 1.0
+    return results
+
+def bench_embedding(ctx):
+    """Embed the thumbnails into the index with calculateFaissIndex, then score the index's pairs at every radius."""
+    try:
+        from imageDuplicate import calculateFaissIndex
+    except ImportError as e:
+        return {'skipped': f"{e}"}
+    from faissIndex import init_or_load_faiss_index, find_duplicate_pairs
+    catalog = ctx.ensure_catalog()
+    summary, seconds = _timed(calculateFaissIndex, catalog, ctx.server.url, API_KEY, batch_size=ctx.args.batch_size,
+                              fetch_workers=ctx.args.fetch_workers, model_name=ctx.args.model)
+    if summary is None:
+        return {'error': "calculateFaissIndex could not start"}
+    index, id_map = init_or_load_faiss_index()
+    radii = _thresholds(ctx.args.radii, float)
+    pairs = [pair for _, block in find_duplicate_pairs(index, id_map, mode='range', radius=max(radii)) for pair in block]
+    # Copies are paired from checksums instead of being embedded, as in the app
+    return {'seconds': round(seconds, 4), 'images_per_second': _rate(summary['processed'], seconds), 'summary': summary,
+            'scores': {str(radius): ctx.corpus.score([pair for pair in pairs if pair[2] <= radius] + ctx.exact_pairs) for radius in radii}}
+
+def _clustered_vectors(count, dimension, seed, group_size=4, noise=0.05):
+    """Unit vectors in groups of group_size close neighbours; returns (vectors, group of each vector)."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((count // group_size + 1, dimension)).astype('float32')
+    groups = np.arange(count) // group_size
+    vectors = centres[groups] + noise * rng.standard_normal((count, dimension)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True), groups
+
+def bench_index(ctx):
+    """Build the --index-types from --vectors clustered vectors and search them for pairs; the Flat index is the oracle."""
+    from indexFactory import build_index, set_search_params
+    from faissIndex import find_duplicate_pairs
+    from backbones import backbone_dimension
+    vectors, _ = _clustered_vectors(ctx.args.vectors, backbone_dimension(ctx.args.model), ctx.args.seed)
+    id_map = {vector_id: vector_id for vector_id in range(len(vectors))}
+    results, found = {'vectors': len(vectors), 'dimension': vectors.shape[1]}, {}
+    # The oracle is built even if it isn't asked for
+    index_types = ['Flat'] + [name for name in ctx.args.index_types.split(',') if name and name != 'Flat']
+    for index_type in index_types:
+        try:
+            index, build_seconds = _timed(build_index, index_type, vectors)
+        except ValueError as e:
+            results[index_type] = {'skipped': str(e)}
+            continue
+        set_search_params(index)
+        pairs, search_seconds = _timed(lambda: {pair[:2] for _, block in find_duplicate_pairs(index, id_map, mode='knn', k=ctx.args.k)
+                                                for pair in block})
+        found[index_type] = pairs
+        results[index_type] = {'build_seconds': round(build_seconds, 4), 'search_seconds': round(search_seconds, 4),
+                               'vectors_per_second': _rate(len(vectors), search_seconds), 'pairs': len(pairs)}
+    oracle = found.get('Flat', set())
+    for index_type, pairs in found.items():
+        results[index_type]['recall'] = round(len(pairs & oracle) / len(oracle), 4) if oracle else None
+    return results
+
+def bench_merge(ctx):
+    """Write --merge-vectors random vectors of --model to --merge-shards shards and merge them into an empty index."""
+    from shardIndex import ShardWriter, merge_shards
+    from backbones import backbone_dimension
+    rng = np.random.default_rng(ctx.args.seed)
+    num_shards = max(1, ctx.args.merge_shards)
+    vectors = rng.standard_normal((ctx.args.merge_vectors, backbone_dimension(ctx.args.model))).astype('float32')
+    writers = [ShardWriter(shard, num_shards, ctx.args.model, 1, root='bench-shards') for shard in range(num_shards)]
+    for position, vector in enumerate(vectors):
+        writers[position % num_shards].add(f"merge-{position}", vector)
+    for writer in writers:
+        writer.close()
+    counts, seconds = _timed(merge_shards, 'bench-shards', remove=True)
+    # merge_shards returns None when the merged index fails its verification
+    return {'vectors': len(vectors), 'shards': num_shards, 'verified': counts is not None,
+            'added': counts['added'] if counts else 0, 'vectors_per_second': _rate(len(vectors), seconds)}
+
+def bench_db_writes(ctx):
+    """Write --pairs duplicate pairs, replace them, and upsert --db-assets assets, each in one transaction."""
+    from db import save_duplicate_pairs, replace_duplicate_pairs, upsertAssets, assets_db
+    rng = np.random.default_rng(ctx.args.seed)
+    ids = [f"bench-{value}" for value in range(max(2, ctx.args.pairs))]
+    left, right = rng.integers(0, len(ids), size=(2, ctx.args.pairs)).tolist()
+    # Distinct unordered pairs, like a search returns
+    ordered = sorted({(min(a, b), max(a, b)) for a, b in zip(left, right) if a != b})
+    pairs = [(ids[a], ids[b], float(distance)) for (a, b), distance in zip(ordered, rng.random(len(ordered)))]
+    _, save_seconds = _timed(save_duplicate_pairs, pairs, method='benchmark')
+    _, replace_seconds = _timed(replace_duplicate_pairs, pairs, method='benchmark')
+    replace_duplicate_pairs([], method='benchmark')
+    template = ctx.corpus.assets[0]
+    assets = [{**template, 'id': f"bench-{value}"} for value in range(ctx.args.db_assets)]
+    def upsert():
+        with assets_db().transaction() as conn:
+            upsertAssets(conn, assets, 0)
+    _, upsert_seconds = _timed(upsert)
+    return {'pairs': len(pairs), 'save_pairs_per_second': _rate(len(pairs), save_seconds),
+            'replace_pairs_per_second': _rate(len(pairs), replace_seconds),
+            'assets': len(assets), 'upsert_assets_per_second': _rate(len(assets), upsert_seconds)}
+
+# Run in this order; later benchmarks reuse the catalog and the exact pairs of earlier ones
+BENCHMARKS = {
+    'sync': bench_sync,
+    'thumbnails': bench_thumbnails,
+    'originals': bench_originals,
+    'decode': bench_decode,
+    'exact': bench_exact,
+    'phash': bench_phash,
+    'hash_search': bench_hash_search,
+    'embedding': bench_embedding,
+    'index': bench_index,
+    'merge': bench_merge,
+    'db_writes': bench_db_writes,
+}
+
+def environment():
+    """Versions and hardware the results depend on."""
+    versions = {}
+    for package in ('numpy', 'faiss', 'PIL', 'imagehash', 'torch', 'onnxruntime'):
+        try:
+            versions[package] = getattr(__import__(package), '__version__', 'unknown')
+        except ImportError:
+            versions[package] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(), 'commit': commit,
+            'packages': versions}
+
+def _timings(results, prefix=''):
+    """Flatten the numeric results into {'benchmark.metric': value}."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_timings(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(baseline, results):
+    """Return lines comparing the seconds and per-second rates of two runs, flagging changes beyond 10%."""
+    old, new = _timings(baseline['results']), _timings(results['results'])
+    lines = []
+    for name in sorted(old.keys() & new.keys()):
+        if not (name.endswith('seconds') or name.endswith('per_second')) or not old[name]:
+            continue
+        ratio = new[name] / old[name]
+        # Fewer seconds is better, a higher rate is better
+        better = ratio < 1 if name.endswith('seconds') and not name.endswith('per_second') else ratio > 1
+        flag = '' if IMPROVEMENT_RATIO <= ratio <= REGRESSION_RATIO else ('  faster' if better else '  SLOWER')
+        lines.append(f"{name}: {old[name]} -> {new[name]} ({ratio:.2f}x){flag}")
+    return lines
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description="Benchmark the pipeline on a generated library of near-duplicate photos served by a local stand-in "
+                    "for the Immich API. Runs in a temporary directory, so the app's databases and index are never touched. "
+                    "The results are written as JSON.")
+    parser.add_argument('--output', default='benchmark.json', help="file the results are written to")
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help=f"comma-separated benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--groups', type=int, default=40, help="photos with near-duplicates")
+    parser.add_argument('--variants', type=int, default=len(TRANSFORMS), help="edited copies per photo with near-duplicates")
+    parser.add_argument('--unique', type=int, default=100, help="photos without duplicates")
+    parser.add_argument('--copies', type=int, default=10, help="photos with a byte-identical copy")
+    parser.add_argument('--latency-ms', type=float, default=0, help="delay the fake server adds to every request")
+    parser.add_argument('--page-size', type=int, default=100, help="assets per page when syncing")
+    parser.add_argument('--fetch-workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--model', default='mobilenet_v3_large')
+    parser.add_argument('--hash-thresholds', default=DEFAULT_HASH_THRESHOLDS, help="pHash distances to score, in bits")
+    parser.add_argument('--radii', default=DEFAULT_RADII, help="embedding distances to score")
+    parser.add_argument('--hashes', type=int, default=100000, help="hashes of the hash search benchmark")
+    parser.add_argument('--max-distance', type=int, default=6, help="bits of the hash search benchmark")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes of the brute-force hash engine")
+    parser.add_argument('--vectors', type=int, default=20000, help="vectors of the index benchmark")
+    parser.add_argument('--index-types', default=DEFAULT_INDEX_TYPES, help="comma-separated index types of the index benchmark")
+    parser.add_argument('--k', type=int, default=5, help="neighbours per vector of the index benchmark")
+    parser.add_argument('--merge-vectors', type=int, default=5000, help="vectors of the shard merge benchmark")
+    parser.add_argument('--merge-shards', type=int, default=4, help="shards of the shard merge benchmark")
+    parser.add_argument('--pairs', type=int, default=100000, help="pairs of the database benchmark")
+    parser.add_argument('--db-assets', type=int, default=20000, help="assets of the database benchmark")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    selected = [name for name in args.only.split(',') if name]
+    unknown = [name for name in selected if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    corpus, corpus_seconds = _timed(SyntheticCorpus, groups=args.groups, variants=args.variants, unique=args.unique,
+                                    copies=args.copies, seed=args.seed)
+    print(f"Generated {len(corpus)} photos in {corpus_seconds:.1f}s", file=sys.stderr)
+    run = {'version': RESULTS_VERSION, 'started_at': datetime.now(timezone.utc).isoformat(), 'environment': environment(),
+           'settings': vars(args), 'corpus': {'assets': len(corpus), 'true_pairs': len(corpus.true_pairs())}, 'results': {}, 'stages': {}}
+
+    # The databases, index and embedding store are relative paths: keep them out of the working directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='immich-benchmark-')
+    os.chdir(workdir)
+    try:
+        from api import configureClient
+        configureClient(pool_size=args.fetch_workers)
+        with FakeImmichServer(corpus, latency=args.latency_ms / 1000) as server:
+            ctx = BenchmarkContext(args, corpus, server)
+            for name in BENCHMARKS:
+                if name not in selected:
+                    continue
+                print(f"Running {name}...", file=sys.stderr)
+                metrics_registry.reset()
+                try:
+                    run['results'][name] = BENCHMARKS[name](ctx)
+                except Exception as e:
+                    run['results'][name] = {'error': f"{type(e).__name__}: {e}"}
+                # Where the time of the benchmark went, stage by stage
+                run['stages'][name] = metrics_registry.summary()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2, default=str)
+    print(f"Results written to {output}", file=sys.stderr)
+    if baseline is not None:
+        for line in compare(baseline, run):
+            print(line)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
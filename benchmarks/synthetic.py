@@ -0,0 +1,174 @@
+import base64
+import hashlib
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from itertools import combinations
+
+from PIL import Image, ImageDraw, ImageEnhance
+
+DEFAULT_IMAGE_SIZE = (640, 480)
+THUMBNAIL_SIZE = 250           # long side of the thumbnails served like Immich's preview JPEGs
+BASE_QUALITY = 90              # JPEG quality of the originals
+LIBRARY_START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+def _crop(image, rng):
+    """Cut away 5-15% of the width and height, off centre."""
+    width, height = image.size
+    dx, dy = int(width * rng.uniform(0.05, 0.15)), int(height * rng.uniform(0.05, 0.15))
+    left, top = rng.randint(0, dx), rng.randint(0, dy)
+    return image.crop((left, top, left + width - dx, top + height - dy))
+
+def _recompress(image, rng):
+    """Save again as a low quality JPEG."""
+    return Image.open(BytesIO(_jpeg(image, rng.randint(20, 50)))).convert('RGB')
+
+def _resize(image, rng):
+    """Downscale to 40-80% of the size."""
+    scale = rng.uniform(0.4, 0.8)
+    return image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.BILINEAR)
+
+def _colour(image, rng):
+    """Shift brightness, contrast and saturation by up to 25%."""
+    for enhancer in (ImageEnhance.Brightness, ImageEnhance.Contrast, ImageEnhance.Color):
+        image = enhancer(image).enhance(rng.uniform(0.75, 1.25))
+    return image
+
+# Edits that turn an original into a near-duplicate, like a phone's edit, share or export would
+TRANSFORMS = {
+    'crop': _crop,
+    'recompress': _recompress,
+    'resize': _resize,
+    'colour': _colour,
+}
+
+def _jpeg(image, quality):
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def make_base_image(rng, size=DEFAULT_IMAGE_SIZE):
+    """A random picture: a two-colour gradient with a few filled shapes, different enough from any other."""
+    width, height = size
+    top = [rng.randint(0, 255) for _ in range(3)]
+    bottom = [rng.randint(0, 255) for _ in range(3)]
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.composite(Image.new('RGB', size, tuple(bottom)), Image.new('RGB', size, tuple(top)), gradient)
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(4, 10)):
+        x0, y0 = rng.randint(0, width - 1), rng.randint(0, height - 1)
+        x1, y1 = x0 + rng.randint(width // 10, width // 2), y0 + rng.randint(height // 10, height // 2)
+        colour = tuple(rng.randint(0, 255) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=colour)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=colour)
+    return image
+
+def thumbnail_bytes(content):
+    """The JPEG thumbnail of an original."""
+    image = Image.open(BytesIO(content)).convert('RGB')
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    return _jpeg(image, 80)
+
+class SyntheticCorpus:
+    """A library of generated photos with known near-duplicates.
+
+    Every group is an original plus `variants` edited copies made with the
+    TRANSFORMS, and `copies` groups also get a byte-identical copy of their
+    original. `unique` photos have no duplicate. Assets look like the ones
+    the Immich API returns; variants are captured a second after their
+    original, unrelated photos at least an hour apart. Generated from `seed`,
+    the same arguments always give the same library.
+    """
+
+    def __init__(self, groups=50, variants=3, unique=100, copies=10, seed=0, size=DEFAULT_IMAGE_SIZE, transforms=None):
+        rng = random.Random(seed)
+        transform_names = list(transforms or TRANSFORMS)
+        self.assets = []
+        self.originals = {}
+        self.thumbnails = {}
+        self.group_of = {}       # asset id -> group number; photos without duplicates have none
+        self.transform_of = {}   # asset id -> transform that made it, 'original' or 'copy'
+        captured = LIBRARY_START
+
+        for group in range(groups + unique):
+            captured += timedelta(hours=rng.randint(1, 48))
+            base = make_base_image(rng, size)
+            base_content = _jpeg(base, BASE_QUALITY)
+            members = [('original', base_content)]
+            if group < groups:
+                for variant in range(variants):
+                    name = transform_names[variant % len(transform_names)]
+                    members.append((name, _jpeg(TRANSFORMS[name](base, rng), BASE_QUALITY)))
+                if group < copies:
+                    members.append(('copy', base_content))
+            for position, (name, content) in enumerate(members):
+                asset_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+                self._add(asset_id, content, name, captured + timedelta(seconds=min(position, 1)), group if group < groups else None)
+
+    def _add(self, asset_id, content, transform, captured, group):
+        image = Image.open(BytesIO(content))
+        timestamp = captured.isoformat().replace('+00:00', 'Z')
+        self.assets.append({
+            'id': asset_id,
+            'type': 'IMAGE',
+            'originalFileName': f"IMG_{len(self.assets):05d}.jpg",
+            'originalPath': f"/photos/{asset_id}.jpg",
+            # Immich's checksum is the base64 SHA-1 of the file
+            'checksum': base64.b64encode(hashlib.sha1(content).digest()).decode('ascii'),
+            'fileCreatedAt': timestamp,
+            'updatedAt': timestamp,
+            'isFavorite': False,
+            'isArchived': False,
+            'isTrashed': False,
+            'isOffline': False,
+            'exifInfo': {
+                'fileSizeInByte': len(content),
+                'exifImageWidth': image.width,
+                'exifImageHeight': image.height,
+                'dateTimeOriginal': timestamp,
+            },
+        })
+        self.originals[asset_id] = content
+        self.thumbnails[asset_id] = thumbnail_bytes(content)
+        self.group_of[asset_id] = group
+        self.transform_of[asset_id] = transform
+
+    def __len__(self):
+        return len(self.assets)
+
+    def true_pairs(self):
+        """Every unordered pair of assets of the same group, as (smaller id, larger id)."""
+        members = {}
+        for asset_id, group in self.group_of.items():
+            if group is not None:
+                members.setdefault(group, []).append(asset_id)
+        return {tuple(sorted(pair)) for group in members.values() for pair in combinations(group, 2)}
+
+    def score(self, pairs):
+        """Precision, recall and F1 of found (asset_id1, asset_id2, ...) pairs against the true pairs."""
+        found = {tuple(sorted(pair[:2])) for pair in pairs}
+        true = self.true_pairs()
+        hits = len(found & true)
+        precision = hits / len(found) if found else 1.0
+        recall = hits / len(true) if true else 1.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        return {'found': len(found), 'true': len(true), 'hits': hits,
+                'precision': round(precision, 4), 'recall': round(recall, 4), 'f1': round(f1, 4)}
+
+    def recall_by_transform(self, pairs):
+        """Share of the variants of each transform found paired with their group's original."""
+        found = {tuple(sorted(pair[:2])) for pair in pairs}
+        originals = {self.group_of[asset_id]: asset_id for asset_id, name in self.transform_of.items()
+                     if name == 'original' and self.group_of[asset_id] is not None}
+        totals, hits = {}, {}
+        for asset_id, name in self.transform_of.items():
+            group = self.group_of[asset_id]
+            if name == 'original' or group is None:
+                continue
+            totals[name] = totals.get(name, 0) + 1
+            if tuple(sorted((asset_id, originals[group]))) in found:
+                hits[name] = hits.get(name, 0) + 1
+        return {name: round(hits.get(name, 0) / total, 4) for name, total in totals.items()}
@@ -0,0 +1,198 @@
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from imagehash import dhash, phash
+
+from api import fetchImageBytes, decodeImage
+from db import getThumbnailHashes, saveThumbnailHashes, save_duplicate_pairs, load_duplicate_pairs
+from hammingIndex import MultiIndexHash, phash_to_int, pack_hashes
+from faissIndex import init_or_load_faiss_index, DEFAULT_SEARCH_RADIUS
+from indexFactory import index_ids, reconstruct_ids
+from pipeline import DEFAULT_FETCH_WORKERS
+from reporter import Reporter
+from metrics import timer
+
+# Defaults of the first, cheap stage
+DEFAULT_CASCADE_HASH_DISTANCE = 10   # bits between thumbnail dHashes or pHashes
+DEFAULT_CASCADE_TIME_WINDOW = 2      # seconds between capture times
+MAX_TIME_GROUP = 50                  # larger groups of equal capture times are import artefacts, not bursts
+HASH_SAVE_BATCH = 500
+
+def thumbnail_hashes(image):
+    """Return the 64-bit (dHash, pHash) hex strings of an image."""
+    with timer('image_hash_duration_seconds', hashes='dhash+phash'):
+        return str(dhash(image)), str(phash(image))
+
+def _capture_time(asset):
+    """Capture time of an asset in seconds since the epoch, or None if unknown."""
+    value = (asset.get('exifInfo') or {}).get('dateTimeOriginal') or asset.get('fileCreatedAt')
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def _aspect_ratio(asset):
+    """Long side over short side from EXIF, ignoring orientation, or None if unknown."""
+    exif_info = asset.get('exifInfo') or {}
+    width, height = exif_info.get('exifImageWidth'), exif_info.get('exifImageHeight')
+    if not width or not height:
+        return None
+    return round(max(width, height) / min(width, height), 2)
+
+def hash_pairs(hashes, max_distance):
+    """Return the set of (i, j) positions, i < j, of hashes within max_distance bits."""
+    pairs = set()
+    for left, right, _ in MultiIndexHash(hashes, max_distance).pairs():
+        pairs.update(zip(np.minimum(left, right).tolist(), np.maximum(left, right).tolist()))
+    return pairs
+
+def exif_pairs(capture_times, aspect_ratios, time_window):
+    """Return the set of (i, j) positions of assets captured within time_window seconds with the same aspect ratio."""
+    known = [i for i, value in enumerate(capture_times) if value is not None]
+    if not known:
+        return set()
+    order = np.array(known)[np.argsort([capture_times[i] for i in known], kind='stable')]
+    times = np.array([capture_times[i] for i in order])
+    ends = np.searchsorted(times, times + time_window, side='right')
+    pairs = set()
+    for start, end in enumerate(ends.tolist()):
+        if end - start - 1 > MAX_TIME_GROUP:
+            continue
+        for other in range(start + 1, end):
+            i, j = int(order[start]), int(order[other])
+            if aspect_ratios[i] is not None and aspect_ratios[j] is not None and aspect_ratios[i] != aspect_ratios[j]:
+                continue
+            pairs.add((min(i, j), max(i, j)))
+    return pairs
+
+def propose_candidate_pairs(assets, hashes, max_hash_distance=DEFAULT_CASCADE_HASH_DISTANCE, time_window=DEFAULT_CASCADE_TIME_WINDOW):
+    """First stage: propose pairs of assets that may be duplicates.
+
+    A pair is proposed when the dHashes or pHashes of the thumbnails differ in
+    at most max_hash_distance bits, or when both were captured within
+    time_window seconds with the same aspect ratio. hashes maps asset ids to
+    (dhash_hex, phash_hex); assets without hashes only take part through
+    their EXIF features. Returns a set of ordered (asset_id1, asset_id2)."""
+    assets = list(assets)
+    asset_ids = [asset['id'] for asset in assets]
+    hashed = [i for i, asset_id in enumerate(asset_ids) if asset_id in hashes]
+    pairs = set()
+    for column in (0, 1):
+        values = [phash_to_int(hashes[asset_ids[i]][column]) for i in hashed]
+        usable = [(i, value) for i, value in zip(hashed, values) if value is not None]
+        positions = [i for i, _ in usable]
+        for left, right in hash_pairs(pack_hashes(value for _, value in usable), max_hash_distance):
+            pairs.add((positions[left], positions[right]))
+    pairs |= exif_pairs([_capture_time(asset) for asset in assets], [_aspect_ratio(asset) for asset in assets], time_window)
+    return {(min(asset_ids[i], asset_ids[j]), max(asset_ids[i], asset_ids[j])) for i, j in pairs}
+
+def verify_candidate_pairs(candidate_pairs, index, asset_to_vector):
+    """Second stage: return (asset_id1, asset_id2, distance) for the candidate pairs whose embeddings are both indexed.
+
+    Distances are squared L2 like those of IndexFlatL2, so the FAISS thresholds apply."""
+    pairs = [(id1, id2) for id1, id2 in candidate_pairs if id1 in asset_to_vector and id2 in asset_to_vector]
+    if not pairs:
+        return []
+    left = reconstruct_ids(index, [asset_to_vector[id1] for id1, _ in pairs])
+    right = reconstruct_ids(index, [asset_to_vector[id2] for _, id2 in pairs])
+    distances = np.sum((left - right) ** 2, axis=1)
+    return [(id1, id2, float(distance)) for (id1, id2), distance in zip(pairs, distances.tolist())]
+
+def _hash_thumbnail(asset_id, immich_server_url, api_key):
+    try:
+        content = fetchImageBytes(asset_id, immich_server_url, "Thumbnail (fast)", api_key)
+        image = decodeImage(content, asset_id) if content is not None else None
+        return (asset_id, *thumbnail_hashes(image)) if image is not None else None
+    except Exception as e:
+        print(f"Failed to hash thumbnail for asset_id {asset_id}: {e}")
+        return None
+
+def runDuplicateCascade(assets, immich_server_url, api_key, max_hash_distance=DEFAULT_CASCADE_HASH_DISTANCE,
+                        time_window=DEFAULT_CASCADE_TIME_WINDOW, max_distance=DEFAULT_SEARCH_RADIUS,
+                        fetch_workers=DEFAULT_FETCH_WORKERS, reporter=None, **index_options):
+    """Find duplicates in two stages and report how many assets each stage eliminated.
+
+    Stage 1 hashes every thumbnail (once; hashes are kept in processed_assets.db)
+    and proposes candidate pairs. Stage 2 embeds only the assets of candidate
+    pairs with calculateFaissIndex (index_options are passed to it) and stores
+    the embedding distance of every candidate pair as a 'cascade' duplicate;
+    pairs within max_distance count as confirmed. If full FAISS pairs exist,
+    the report includes the share of them the first stage proposed. Returns
+    None when the reporter asks to stop."""
+    from imageDuplicate import calculateFaissIndex
+
+    reporter = reporter or Reporter()
+    assets = list(assets)
+    start_time = time.time()
+
+    # Stage 1: hash the thumbnails that haven't been hashed yet
+    hashes = getThumbnailHashes()
+    missing = [asset['id'] for asset in assets if asset['id'] not in hashes]
+    failed = 0
+    rows = []
+    executor = ThreadPoolExecutor(max_workers=max(1, int(fetch_workers)))
+    try:
+        for done, row in enumerate(executor.map(lambda asset_id: _hash_thumbnail(asset_id, immich_server_url, api_key), missing), start=1):
+            if reporter.stop_requested():
+                reporter.log("Processing stopped by user.")
+                break
+            if row is None:
+                failed += 1
+            else:
+                rows.append(row)
+                hashes[row[0]] = row[1:]
+            if len(rows) >= HASH_SAVE_BATCH:
+                saveThumbnailHashes(rows)
+                rows = []
+            reporter.progress(done, len(missing), f"Stage 1: hashed {done}/{len(missing)} new thumbnails ({failed} failed)", failed=failed)
+    finally:
+        # Drop the thumbnails not fetched yet instead of hashing the rest of the library after a stop
+        executor.shutdown(wait=True, cancel_futures=True)
+    saveThumbnailHashes(rows)
+    if reporter.stop_requested():
+        return None
+
+    candidate_pairs = propose_candidate_pairs(assets, hashes, max_hash_distance, time_window)
+    candidate_ids = {asset_id for pair in candidate_pairs for asset_id in pair}
+    stage1_time = time.time() - start_time
+    reporter.log(f"Stage 1: {len(candidate_pairs)} candidate pairs among {len(candidate_ids)} of {len(assets)} assets.")
+
+    # Stage 2: embed the candidates only, then measure the candidate pairs
+    summary = {'processed': 0, 'skipped': 0, 'cached': 0, 'copies': 0, 'errors': 0}
+    if candidate_ids:
+        summary = calculateFaissIndex([asset for asset in assets if asset['id'] in candidate_ids], immich_server_url, api_key,
+                                      fetch_workers=fetch_workers, reporter=reporter, **index_options) or summary
+        if reporter.stop_requested():
+            return None
+    index, id_map = init_or_load_faiss_index()
+    verified = []
+    if index is not None:
+        indexed = set(index_ids(index).tolist())
+        asset_to_vector = {asset_id: vector_id for vector_id, asset_id in id_map.items() if vector_id in indexed and asset_id in candidate_ids}
+        verified = verify_candidate_pairs(candidate_pairs, index, asset_to_vector)
+        save_duplicate_pairs(verified, method='cascade')
+
+    confirmed = [pair for pair in verified if pair[2] <= max_distance]
+    confirmed_ids = {asset_id for pair in confirmed for asset_id in pair[:2]}
+    report = [
+        {'stage': '1. thumbnail hashes + EXIF', 'assets in': len(assets), 'assets eliminated': len(assets) - len(candidate_ids),
+         'work': f"{len(missing) - failed} thumbnails hashed, {len(candidate_pairs)} candidate pairs", 'seconds': round(stage1_time, 1)},
+        {'stage': '2. CNN embeddings', 'assets in': len(candidate_ids), 'assets eliminated': len(candidate_ids) - len(confirmed_ids),
+         'work': f"{summary['processed']} embedded, {summary['skipped'] + summary['cached']} already indexed, {summary['copies']} exact copies, "
+                 f"{len(verified)} pairs measured, {len(confirmed)} within {max_distance}",
+         'seconds': round(time.time() - start_time - stage1_time, 1)},
+    ]
+    saved = len(assets) - len(candidate_ids)
+    reporter.table(report, f"Duplicate cascade: stage 1 spared {saved} of {len(assets)} assets ({saved / max(len(assets), 1):.0%}) from CNN inference.")
+
+    # Recall of the first stage against pairs found by searching the whole index
+    asset_ids = {asset['id'] for asset in assets}
+    reference = {tuple(pair) for pair in load_duplicate_pairs(0, max_distance, ['faiss']) or [] if pair[0] in asset_ids and pair[1] in asset_ids}
+    if reference:
+        found = len(reference & candidate_pairs)
+        reporter.log(f"Stage 1 proposed {found} of the {len(reference)} FAISS pairs within {max_distance} (recall {found / len(reference):.1%}).")
+    return report
@@ -0,0 +1,172 @@
+import argparse
+import os
+import signal
+import sys
+from contextlib import nullcontext
+
+import requests
+
+from api import configureClient, DEFAULT_TIMEOUT_MS
+from db import startup_db_configurations, startup_processed_assets_db, startup_processed_duplicate_faiss_db, load_settings_from_db
+from reporter import JsonLinesReporter
+from metrics import METRICS_FILE, DEFAULT_WRITE_INTERVAL, MetricsFileWriter
+from jobManager import JOB_RUNNERS
+from backbones import backbone_names, DEFAULT_BACKBONE
+from inferenceBackend import BACKENDS, QUANTIZED_BACKENDS, DEFAULT_BACKEND, DEFAULT_QUANTIZE
+from embeddingStore import EMBEDDING_DTYPES, DEFAULT_EMBEDDING_DTYPE
+from pipeline import DEFAULT_FETCH_WORKERS, DEFAULT_DECODE_WORKERS
+from faissIndex import DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_BATCHES, DEFAULT_SEARCH_K, DEFAULT_SEARCH_RADIUS
+from indexFactory import INDEX_TYPES, DEFAULT_INDEX_TYPE, DEFAULT_NLIST, DEFAULT_HNSW_M, DEFAULT_PQ_M, DEFAULT_NPROBE, DEFAULT_EF_SEARCH
+from hammingIndex import HASH_ENGINES, DEFAULT_MAX_DISTANCE, DEFAULT_BRUTE_FORCE_WORKERS
+from cascade import DEFAULT_CASCADE_HASH_DISTANCE, DEFAULT_CASCADE_TIME_WINDOW
+from shardIndex import SHARDS_DIR, parse_shard
+
+EXIT_OK = 0
+EXIT_FAILED = 1      # the job could not run or raised an error
+EXIT_USAGE = 2       # bad arguments (argparse uses 2 as well)
+EXIT_PARTIAL = 3     # the job finished, but some assets failed
+EXIT_STOPPED = 130   # stopped by SIGINT or SIGTERM
+
+# Commands that download from the server; the others only need a synced catalog
+SERVER_COMMANDS = ('sync', 'index', 'phash', 'cascade')
+
+def _add_index_options(parser):
+    parser.add_argument('--model', choices=backbone_names(), default=DEFAULT_BACKBONE, help="embedding model")
+    parser.add_argument('--backend', choices=BACKENDS, default=DEFAULT_BACKEND, help="inference backend")
+    parser.add_argument('--int8', action='store_true', default=DEFAULT_QUANTIZE, help="use dynamically quantized int8 weights (onnxruntime backend only)")
+    parser.add_argument('--batch-size', type=int, default=32, help="images embedded per model call")
+    parser.add_argument('--threads', type=int, default=0, help="torch CPU threads, 0 keeps the torch default")
+    parser.add_argument('--fetch-workers', type=int, default=DEFAULT_FETCH_WORKERS, help="concurrent thumbnail downloads")
+    parser.add_argument('--decode-workers', type=int, default=DEFAULT_DECODE_WORKERS, help="threads decoding images")
+    parser.add_argument('--embedding-dtype', choices=EMBEDDING_DTYPES, default=DEFAULT_EMBEDDING_DTYPE,
+                        help="precision of the embedding store when it is created")
+    parser.add_argument('--flush-interval', type=int, default=DEFAULT_FLUSH_INTERVAL, help="seconds between index flushes")
+    parser.add_argument('--flush-batches', type=int, default=DEFAULT_FLUSH_BATCHES, help="batches added between index flushes")
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m cli',
+        description="Run the indexing and duplicate search jobs without the web app. "
+                    "Progress is written to stdout as one JSON object per line; the last line is the result. "
+                    f"Exit codes: {EXIT_OK} done, {EXIT_FAILED} failed, {EXIT_USAGE} bad arguments, "
+                    f"{EXIT_PARTIAL} done with failed assets, {EXIT_STOPPED} stopped by a signal.")
+    parser.add_argument('--server', default=os.environ.get('IMMICH_SERVER_URL'),
+                        help="Immich server URL (default: $IMMICH_SERVER_URL, then the URL saved in the app)")
+    parser.add_argument('--api-key', default=os.environ.get('IMMICH_API_KEY'),
+                        help="Immich API key (default: $IMMICH_API_KEY, then the key saved in the app)")
+    parser.add_argument('--timeout', type=int, default=None, help="request timeout in ms (default: the one saved in the app)")
+    parser.add_argument('--progress-interval', type=float, default=1.0, help="seconds between progress lines")
+    parser.add_argument('--metrics-file', default=METRICS_FILE,
+                        help="write per-stage metrics in the Prometheus text format to this file while the job runs "
+                             "(default: $METRICS_FILE), e.g. for node_exporter's textfile collector")
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_WRITE_INTERVAL, help="seconds between writes of the metrics file")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    command = commands.add_parser('sync', help="update the local asset catalog from the server")
+    command.add_argument('--full', action='store_true', help="page through every asset instead of the changes since the last sync")
+
+    command = commands.add_parser('index', help="embed the assets that aren't indexed yet")
+    _add_index_options(command)
+    command.add_argument('--processes', type=int, default=1,
+                         help="worker processes, each embedding one shard of the assets; the shards are merged when all finish")
+    command.add_argument('--shard', default=None, metavar='I/N',
+                         help="only embed shard I of N and write it to the shards directory, e.g. to index on several machines; "
+                              "run `merge` once every shard is done")
+    command.add_argument('--shards-dir', default=SHARDS_DIR, help="directory of the index shards (default: $INDEX_SHARDS_DIR or shards)")
+
+    command = commands.add_parser('merge', help="add the vectors of finished index shards to the index")
+    command.add_argument('--shards-dir', default=SHARDS_DIR, help="directory of the index shards (default: $INDEX_SHARDS_DIR or shards)")
+    command.add_argument('--remove', action='store_true', help="delete the shards once they are merged")
+    command.add_argument('--embedding-dtype', choices=EMBEDDING_DTYPES, default=DEFAULT_EMBEDDING_DTYPE,
+                         help="precision of the embedding store when it is created")
+    command.add_argument('--flush-interval', type=int, default=DEFAULT_FLUSH_INTERVAL, help="seconds between index flushes")
+    command.add_argument('--flush-batches', type=int, default=DEFAULT_FLUSH_BATCHES, help="batches added between index flushes")
+
+    command = commands.add_parser('pairs', help="search the index for duplicate pairs")
+    command.add_argument('--mode', choices=['knn', 'range'], default='knn', help="k nearest neighbours or range search")
+    command.add_argument('--k', type=int, default=DEFAULT_SEARCH_K, help="neighbours per image in knn mode")
+    command.add_argument('--radius', type=float, default=DEFAULT_SEARCH_RADIUS, help="distance threshold in range mode")
+    command.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE, help="IVF cells visited per query")
+    command.add_argument('--ef-search', type=int, default=DEFAULT_EF_SEARCH, help="HNSW candidate list size per query")
+
+    command = commands.add_parser('rebuild', help="rebuild the index as another index type")
+    command.add_argument('--index-type', choices=INDEX_TYPES, default=DEFAULT_INDEX_TYPE)
+    command.add_argument('--nlist', type=int, default=DEFAULT_NLIST, help="IVF cells, 0 picks about 4 x sqrt(N)")
+    command.add_argument('--hnsw-m', type=int, default=DEFAULT_HNSW_M, help="HNSW graph neighbours per node")
+    command.add_argument('--pq-m', type=int, default=DEFAULT_PQ_M, help="PQ sub-quantizers, 0 picks dimension / 8")
+    command.add_argument('--k', type=int, default=DEFAULT_SEARCH_K, help="neighbours compared in the recall report")
+
+    command = commands.add_parser('exact', help="pair byte-identical assets from their checksums and file sizes")
+
+    command = commands.add_parser('phash', help="compute the pHashes of the original photos")
+
+    command = commands.add_parser('phash-pairs', help="pair assets with nearly identical pHashes")
+    command.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE, help="bits")
+    command.add_argument('--engine', choices=HASH_ENGINES, default='multi-index')
+    command.add_argument('--workers', type=int, default=DEFAULT_BRUTE_FORCE_WORKERS, help="processes of the brute-force engine")
+
+    command = commands.add_parser('cascade', help="pair assets with the two-stage hash + embedding cascade")
+    command.add_argument('--hash-distance', type=int, default=DEFAULT_CASCADE_HASH_DISTANCE, help="bits between thumbnail hashes")
+    command.add_argument('--time-window', type=int, default=DEFAULT_CASCADE_TIME_WINDOW, help="seconds between capture times")
+    command.add_argument('--max-distance', type=float, default=DEFAULT_SEARCH_RADIUS, help="embedding distance of a confirmed pair")
+    _add_index_options(command)
+    return parser
+
+def _exit_code(reporter, summary):
+    if reporter.stop_requested():
+        return EXIT_STOPPED
+    if summary is None:
+        return EXIT_FAILED
+    return EXIT_PARTIAL if summary.get('errors') else EXIT_OK
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'int8', False) and args.backend not in QUANTIZED_BACKENDS:
+        parser.error(f"--int8 needs the {', '.join(QUANTIZED_BACKENDS)} backend")
+    if args.command == 'index':
+        if args.processes < 1:
+            parser.error("--processes must be at least 1")
+        if args.shard is not None:
+            try:
+                parse_shard(args.shard)
+            except ValueError as e:
+                parser.error(str(e))
+
+    startup_db_configurations()
+    startup_processed_assets_db()
+    startup_processed_duplicate_faiss_db()
+    saved_url, saved_key, _, saved_timeout = load_settings_from_db()
+    args.server = (args.server or saved_url or '').rstrip('/')
+    args.api_key = args.api_key or saved_key
+    if args.command in SERVER_COMMANDS and not (args.server and args.api_key):
+        parser.error("the Immich server URL and API key are required: pass --server and --api-key, "
+                     "set IMMICH_SERVER_URL and IMMICH_API_KEY, or save them in the app")
+    configureClient(timeout_ms=args.timeout or saved_timeout or DEFAULT_TIMEOUT_MS,
+                    pool_size=max(getattr(args, 'fetch_workers', DEFAULT_FETCH_WORKERS), 1))
+
+    reporter = JsonLinesReporter(args.command, min_interval=args.progress_interval)
+    # The first SIGINT/SIGTERM stops the job at the next batch; a second one kills it
+    def request_stop(signum, frame):
+        reporter.request_stop()
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    reporter.emit('start')
+    metrics_writer = MetricsFileWriter(args.metrics_file, args.metrics_interval) if args.metrics_file else nullcontext()
+    try:
+        with metrics_writer:
+            summary = JOB_RUNNERS[args.command](vars(args), reporter)
+    except requests.exceptions.RequestException as e:
+        reporter.log(f"Request to the Immich server failed: {e}", 'error')
+        summary = None
+    except Exception as e:
+        reporter.log(f"{type(e).__name__}: {e}", 'error')
+        summary = None
+    exit_code = _exit_code(reporter, summary)
+    reporter.emit('result', exit_code=exit_code, summary=summary)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,81 +1,208 @@
-import sqlite3, json
+import json
 from collections import Counter
+from storage import get_database
 
 #############DATABASE###################
 
-def startup_db_configurations():
-    conn = sqlite3.connect('settings.db')
-    c = conn.cursor()
-    c.execute('''
+# Schema migrations of each database file; see storage.Database
+SETTINGS_MIGRATIONS = [
+    '''
         CREATE TABLE IF NOT EXISTS settings (
-            immich_server_url text, 
-            api_key text, 
-            images_folder text, 
+            immich_server_url text,
+            api_key text,
+            images_folder text,
             timeout number
         )
-    ''')
-
-    # Check if the table is empty
-    c.execute('SELECT COUNT(*) FROM settings')
-    if c.fetchone()[0] == 0:
-        # Insert default settings, setting timeout to 1500 ms
-        c.execute('''
-            INSERT INTO settings (immich_server_url, api_key, images_folder, timeout)
-            VALUES (?, ?, ?, ?)
-        ''', ('', '', '', 2000))
-    
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
+    ''',
+]
 
-def startup_processed_assets_db():
-    conn = sqlite3.connect('processed_assets.db')  # Separate database for processed assets
-    c = conn.cursor()
-    c.execute('''
+PROCESSED_ASSETS_MIGRATIONS = [
+    '''
         CREATE TABLE IF NOT EXISTS processed_assets (
-            asset_id TEXT PRIMARY KEY, 
+            asset_id TEXT PRIMARY KEY,
             phash TEXT NOT NULL,
             asset_info TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
+    ''',
+    # dHash and pHash of the thumbnails, used by the first stage of the duplicate cascade
+    '''
+        CREATE TABLE IF NOT EXISTS thumbnail_hashes (
+            asset_id TEXT PRIMARY KEY,
+            dhash TEXT NOT NULL,
+            phash TEXT NOT NULL
+        )
+    ''',
+]
+
+def _migrate_duplicates_unique_pairs(conn):
+    # Older databases may hold both orders of a pair: store every pair as (min_id, max_id)
+    # and keep only its first row before enforcing uniqueness
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_duplicates_pair'").fetchone() is None:
+        conn.execute("UPDATE duplicates SET vector_id1 = vector_id2, vector_id2 = vector_id1 WHERE vector_id1 > vector_id2")
+        conn.execute("DELETE FROM duplicates WHERE id NOT IN (SELECT MIN(id) FROM duplicates GROUP BY vector_id1, vector_id2)")
+        conn.execute("CREATE UNIQUE INDEX idx_duplicates_pair ON duplicates(vector_id1, vector_id2)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_duplicates_similarity ON duplicates(similarity)")
+
+DUPLICATES_MIGRATIONS = [
+    '''CREATE TABLE IF NOT EXISTS duplicates(
+           id INTEGER PRIMARY KEY,
+           vector_id1 INT,
+           vector_id2 INT,
+           similarity FLOAT
+        )''',
+    _migrate_duplicates_unique_pairs,
+    # Pairs remember the engine that found them; similarity is a FAISS distance or a Hamming distance in bits
+    '''
+        ALTER TABLE duplicates ADD COLUMN method TEXT NOT NULL DEFAULT 'faiss';
+        DROP INDEX IF EXISTS idx_duplicates_pair;
+        CREATE UNIQUE INDEX idx_duplicates_pair ON duplicates(vector_id1, vector_id2, method);
+        CREATE INDEX IF NOT EXISTS idx_duplicates_method ON duplicates(method, similarity)
+    ''',
+]
+
+# Engines that write duplicate pairs
+DUPLICATE_METHODS = ['faiss', 'phash', 'cascade', 'checksum']
+
+ASSETS_MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS assets (
+            asset_id TEXT PRIMARY KEY,
+            type TEXT,
+            checksum TEXT,
+            original_path TEXT,
+            updated_at TEXT,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            sync_generation INTEGER NOT NULL DEFAULT 0,
+            data TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_assets_type ON assets(type, deleted);
+        CREATE INDEX IF NOT EXISTS idx_assets_checksum ON assets(checksum);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''',
+    # Stable FAISS ids: vectors are stored in the index under vector_id, never under their position
+    '''
+        CREATE TABLE IF NOT EXISTS vector_ids (
+            vector_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            asset_id TEXT NOT NULL UNIQUE
+        )
+    ''',
+]
+
+EMBEDDING_CACHE_MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            id INTEGER PRIMARY KEY,
+            checksum TEXT NOT NULL,
+            model TEXT NOT NULL,
+            preprocessing INTEGER NOT NULL,
+            dtype TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_embedding_cache_key ON embedding_cache(checksum, model, preprocessing);
+        CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache(last_used)
+    ''',
+    # Vectors also depend on the inference backend and int8 quantization; older rows don't say which made them
+    '''
+        DELETE FROM embedding_cache;
+        ALTER TABLE embedding_cache ADD COLUMN backend TEXT NOT NULL DEFAULT '';
+        ALTER TABLE embedding_cache ADD COLUMN int8 INTEGER NOT NULL DEFAULT 0;
+        DROP INDEX IF EXISTS idx_embedding_cache_key;
+        CREATE UNIQUE INDEX idx_embedding_cache_key ON embedding_cache(checksum, model, backend, int8, preprocessing)
+    ''',
+]
+
+# Background jobs of the app and their last checkpoint; counts and params are JSON
+JOBS_MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            counts TEXT NOT NULL DEFAULT '{}',
+            message TEXT,
+            error TEXT,
+            resumed_from INTEGER,
+            started_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)
+    ''',
+]
+
+def settings_db():
+    return get_database('settings.db', SETTINGS_MIGRATIONS)
+
+def processed_assets_db():
+    return get_database('processed_assets.db', PROCESSED_ASSETS_MIGRATIONS)  # Separate database for processed assets
+
+def duplicates_db():
+    return get_database('duplicates.db', DUPLICATES_MIGRATIONS)
+
+def assets_db():
+    return get_database('assets.db', ASSETS_MIGRATIONS)
+
+def embedding_cache_db():
+    return get_database('embedding_cache.db', EMBEDDING_CACHE_MIGRATIONS)
+
+def jobs_db():
+    return get_database('jobs.db', JOBS_MIGRATIONS)
+
+# Larger IN (...) lists are split so they stay under SQLite's variable limit
+SQL_CHUNK_SIZE = 500
+
+def _chunks(items, size=SQL_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def startup_db_configurations():
+    with settings_db().transaction() as conn:
+        # Check if the table is empty
+        if conn.execute('SELECT COUNT(*) FROM settings').fetchone()[0] == 0:
+            # Insert default settings, setting timeout to 2000 ms
+            conn.execute('''
+                INSERT INTO settings (immich_server_url, api_key, images_folder, timeout)
+                VALUES (?, ?, ?, ?)
+            ''', ('', '', '', 2000))
+
+def startup_processed_assets_db():
+    processed_assets_db().connection  # Opens the database and applies pending migrations
 
 def load_settings_from_db():
-    conn = sqlite3.connect('settings.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM settings LIMIT 1")
-    settings = c.fetchone()
-    conn.close()
+    settings = settings_db().fetchone("SELECT * FROM settings LIMIT 1")
     return settings if settings else (None, None, None, None)
 
 def save_settings_to_db(immich_server_url, api_key, images_folder, timeout):
-    conn = sqlite3.connect('settings.db')
-    c = conn.cursor()
-    # This simple logic assumes one row of settings; adjust according to your needs
-    c.execute("DELETE FROM settings")  # Clear existing settings
-    c.execute("INSERT INTO settings VALUES (?, ?, ?, ?)", (immich_server_url, api_key, images_folder, timeout))
-    conn.commit()
-    conn.close()
+    with settings_db().transaction() as conn:
+        # This simple logic assumes one row of settings; adjust according to your needs
+        conn.execute("DELETE FROM settings")  # Clear existing settings
+        conn.execute("INSERT INTO settings VALUES (?, ?, ?, ?)", (immich_server_url, api_key, images_folder, timeout))
 
 def saveAssetInfoToDb(asset_id, phash, asset_info):
-    conn = sqlite3.connect('processed_assets.db')
-    c = conn.cursor()
+    saveAssetsInfoToDb([(asset_id, phash, asset_info)])
+
+def saveAssetsInfoToDb(rows):
+    """Save many (asset_id, phash, asset_info) rows in a single transaction."""
     # Convert asset_info (a dict) to a string for storage; consider what info you need
-    asset_info_str = json.dumps(asset_info)
-    c.execute("INSERT OR REPLACE INTO processed_assets VALUES (?, ?, ?)",
-              (asset_id, phash, asset_info_str))
-    conn.commit()
-    conn.close()
+    processed_assets_db().executemany("INSERT OR REPLACE INTO processed_assets VALUES (?, ?, ?)",
+                                      [(asset_id, phash, json.dumps(asset_info)) for asset_id, phash, asset_info in rows])
 
 def isAssetProcessed(asset_id):
-    conn = sqlite3.connect('processed_assets.db')
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM processed_assets WHERE asset_id = ?", (asset_id,))
-    result = c.fetchone()
-    conn.close()
+    result = processed_assets_db().fetchone("SELECT 1 FROM processed_assets WHERE asset_id = ?", (asset_id,))
     return result is not None
 
+def getProcessedAssetIds():
+    """Return the ids of all processed assets as a set, for checking many assets at once."""
+    return {row[0] for row in processed_assets_db().fetchall("SELECT asset_id FROM processed_assets")}
+
 def bytes_to_megabytes(bytes_size):
     """Convert bytes to megabytes (MB) and format to 3 decimal places."""
     if bytes_size is None:
@@ -84,31 +211,31 @@ def bytes_to_megabytes(bytes_size):
     return f"{megabytes:.3f} MB"
 
 def countProcessedAssets():
-    conn = sqlite3.connect('processed_assets.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM processed_assets")
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    return processed_assets_db().fetchone("SELECT COUNT(*) FROM processed_assets")[0]
+
+def getPhashes():
+    """Return (asset_id, phash_hex) of every processed asset."""
+    return processed_assets_db().fetchall("SELECT asset_id, phash FROM processed_assets")
+
+def getThumbnailHashes():
+    """Return {asset_id: (dhash_hex, phash_hex)} of every hashed thumbnail."""
+    return {asset_id: (dhash, phash) for asset_id, dhash, phash in
+            processed_assets_db().fetchall("SELECT asset_id, dhash, phash FROM thumbnail_hashes")}
+
+def saveThumbnailHashes(rows):
+    """Save many (asset_id, dhash_hex, phash_hex) rows in a single transaction."""
+    processed_assets_db().executemany("INSERT OR REPLACE INTO thumbnail_hashes VALUES (?, ?, ?)", rows)
 
 def getHashFromDb(asset_id):
-    conn = sqlite3.connect('processed_assets.db')
-    c = conn.cursor()
-    c.execute("SELECT phash FROM processed_assets WHERE asset_id = ?", (asset_id,))
-    result = c.fetchone()
-    conn.close()
+    result = processed_assets_db().fetchone("SELECT phash FROM processed_assets WHERE asset_id = ?", (asset_id,))
     if result:
         return result[0]
     else:
         return None
-    
+
 def countDuplicates():
-    conn = sqlite3.connect('processed_assets.db')
-    c = conn.cursor()
     # Fetch all hashes from the database
-    c.execute("SELECT phash FROM processed_assets")
-    hashes = c.fetchall()
-    conn.close()
+    hashes = processed_assets_db().fetchall("SELECT phash FROM processed_assets")
     # Flatten the list of tuples to a list of strings
     hash_list = [item[0] for item in hashes]
     # Use Counter to count occurrences of each hash
@@ -118,92 +245,225 @@ def countDuplicates():
     return duplicates
 
 
+####################### ASSET CATALOG #############################
+def getSyncState(key, default=None):
+    result = assets_db().fetchone("SELECT value FROM sync_state WHERE key = ?", (key,))
+    return result[0] if result else default
+
+def setSyncState(conn, key, value):
+    conn.execute("INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+
+def upsertAssets(conn, assets, generation):
+    """Insert or update assets returned by the API and mark them as seen by a sync generation."""
+    conn.executemany("""
+        INSERT INTO assets (asset_id, type, checksum, original_path, updated_at, deleted, sync_generation, data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(asset_id) DO UPDATE SET
+            type = excluded.type, checksum = excluded.checksum, original_path = excluded.original_path,
+            updated_at = excluded.updated_at, deleted = excluded.deleted,
+            sync_generation = excluded.sync_generation, data = excluded.data""",
+        [(asset['id'], asset.get('type'), asset.get('checksum'), asset.get('originalPath'), asset.get('updatedAt'),
+          int(bool(asset.get('isTrashed', False))), generation, json.dumps(asset)) for asset in assets])
+
+def markAssetsDeleted(asset_ids, conn=None):
+    """Record that assets were deleted (or trashed) on the server."""
+    rows = [(asset_id,) for asset_id in asset_ids]
+    if conn is not None:
+        conn.executemany("UPDATE assets SET deleted = 1 WHERE asset_id = ?", rows)
+        return
+    with assets_db().transaction() as conn:
+        conn.executemany("UPDATE assets SET deleted = 1 WHERE asset_id = ?", rows)
+        bumpCatalogVersion(conn)
+
+def markUnseenAssetsDeleted(conn, generation):
+    """After a full sync, every asset the server didn't return has been deleted."""
+    return conn.execute("UPDATE assets SET deleted = 1 WHERE sync_generation < ? AND deleted = 0", (generation,)).rowcount
+
+def bumpCatalogVersion(conn):
+    version = conn.execute("SELECT value FROM sync_state WHERE key = 'version'").fetchone()
+    setSyncState(conn, 'version', int(version[0]) + 1 if version else 1)
+
+def loadCatalogAssets(type):
+    """Return the stored, not deleted assets of a type as dicts."""
+    rows = assets_db().fetchall("SELECT data FROM assets WHERE type = ? AND deleted = 0", (type,))
+    return [json.loads(row[0]) for row in rows]
+
+
+####################### EMBEDDING CACHE #############################
+def loadCachedEmbeddings(checksums, model, backend, int8, preprocessing, last_used):
+    """Return {checksum: (dtype, vector_bytes)} of the cached embeddings and mark them as used."""
+    found = {}
+    key = (model, backend, int(bool(int8)), preprocessing)
+    with embedding_cache_db().transaction() as conn:
+        for chunk in _chunks(checksums):
+            rows = conn.execute(f"""
+                SELECT checksum, dtype, vector FROM embedding_cache
+                WHERE model = ? AND backend = ? AND int8 = ? AND preprocessing = ? AND checksum IN ({','.join('?' * len(chunk))})""",
+                (*key, *chunk))
+            found.update((checksum, (dtype, vector)) for checksum, dtype, vector in rows)
+        conn.executemany("UPDATE embedding_cache SET last_used = ? WHERE checksum = ? AND model = ? AND backend = ? AND int8 = ? AND preprocessing = ?",
+                         [(last_used, checksum, *key) for checksum in found])
+    return found
+
+def saveCachedEmbeddings(rows):
+    """Save many (checksum, model, backend, int8, preprocessing, dtype, vector_bytes, last_used) rows in a single transaction."""
+    embedding_cache_db().executemany("""
+        INSERT INTO embedding_cache (checksum, model, backend, int8, preprocessing, dtype, vector, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(checksum, model, backend, int8, preprocessing) DO UPDATE SET
+            dtype = excluded.dtype, vector = excluded.vector, last_used = excluded.last_used""", rows)
+
+def countCachedEmbeddings():
+    return embedding_cache_db().fetchone("SELECT COUNT(*) FROM embedding_cache")[0]
+
+def evictCachedEmbeddings(max_entries):
+    """Delete the least recently used embeddings beyond max_entries. Returns the number deleted."""
+    with embedding_cache_db().transaction() as conn:
+        excess = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0] - max_entries
+        if excess <= 0:
+            return 0
+        return conn.execute("DELETE FROM embedding_cache WHERE id IN (SELECT id FROM embedding_cache ORDER BY last_used LIMIT ?)",
+                            (excess,)).rowcount
+
+
+####################### JOBS #############################
+JOB_COLUMNS = ['id', 'kind', 'params', 'status', 'done', 'total', 'counts', 'message', 'error', 'resumed_from', 'started_at', 'updated_at', 'finished_at']
+
+def _job_from_row(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job['params'] = json.loads(job['params'])
+    job['counts'] = json.loads(job['counts'])
+    return job
+
+def createJob(kind, params, started_at, resumed_from=None):
+    """Record a new running job and return its id."""
+    with jobs_db().transaction() as conn:
+        return conn.execute("""
+            INSERT INTO jobs (kind, params, status, resumed_from, started_at, updated_at) VALUES (?, ?, 'running', ?, ?, ?)""",
+            (kind, json.dumps(params), resumed_from, started_at, started_at)).lastrowid
+
+def saveJobCheckpoint(job_id, status, done, total, counts, message, error, updated_at, finished_at=None):
+    jobs_db().execute("""
+        UPDATE jobs SET status = ?, done = ?, total = ?, counts = ?, message = ?, error = ?, updated_at = ?, finished_at = ?
+        WHERE id = ?""", (status, done, total, json.dumps(counts), message, error, updated_at, finished_at, job_id))
+
+def loadJob(job_id):
+    row = jobs_db().fetchone(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,))
+    return _job_from_row(row) if row else None
+
+def loadJobs(limit=10):
+    """Return the most recent jobs as dicts, newest first."""
+    rows = jobs_db().fetchall(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+    return [_job_from_row(row) for row in rows]
+
+def markInterruptedJobs():
+    """Mark the jobs still recorded as running, whose process has died, as interrupted. Returns their number."""
+    with jobs_db().transaction() as conn:
+        return conn.execute("UPDATE jobs SET status = 'interrupted' WHERE status IN ('running', 'stopping')").rowcount
+
+
 ####################### FAISS #############################
 def startup_processed_duplicate_faiss_db():
     try:
-        conn = sqlite3.connect('duplicates.db')
-        cursor = conn.cursor()
-        sql = '''CREATE TABLE IF NOT EXISTS duplicates(
-           id INTEGER PRIMARY KEY,
-           vector_id1 INT,
-           vector_id2 INT,
-           similarity FLOAT
-        )'''
-        cursor.execute(sql)
-        conn.commit()
+        duplicates_db().connection  # Opens the database and applies pending migrations
     except Exception as e:
         print("Error creating database/table:", e)
-    finally:
-        conn.close()
 
-def save_duplicate_pair(vector_id1, vector_id2, similarity):
-    similarity = float(similarity)
+def getVectorIds(asset_ids):
+    """Return {asset_id: vector_id} for the assets, allocating ids for assets that don't have one yet."""
+    vector_ids = {}
+    with assets_db().transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO vector_ids (asset_id) VALUES (?)", [(asset_id,) for asset_id in asset_ids])
+        for chunk in _chunks(asset_ids):
+            rows = conn.execute(f"SELECT asset_id, vector_id FROM vector_ids WHERE asset_id IN ({','.join('?' * len(chunk))})", chunk)
+            vector_ids.update(rows)
+    return vector_ids
+
+def loadVectorIdMap(include_deleted=False):
+    """Return {vector_id: asset_id}. Assets deleted on the server are left out unless include_deleted is set."""
+    if include_deleted:
+        rows = assets_db().fetchall("SELECT vector_id, asset_id FROM vector_ids")
+    else:
+        rows = assets_db().fetchall("""
+            SELECT v.vector_id, v.asset_id FROM vector_ids v LEFT JOIN assets a ON a.asset_id = v.asset_id
+            WHERE COALESCE(a.deleted, 0) = 0""")
+    return dict(rows)
+
+def getDeletedVectorIds():
+    """Return {vector_id: asset_id} of assets that have a vector id but were deleted or trashed on the server."""
+    return dict(assets_db().fetchall("""
+        SELECT v.vector_id, v.asset_id FROM vector_ids v JOIN assets a ON a.asset_id = v.asset_id
+        WHERE a.deleted = 1"""))
+
+def deleteVectorIds(vector_ids):
+    assets_db().executemany("DELETE FROM vector_ids WHERE vector_id = ?", [(int(vector_id),) for vector_id in vector_ids])
+
+def _ordered_pair(vector_id1, vector_id2):
+    """Pairs are stored as (min_id, max_id) so each pair has a single row."""
+    return (vector_id1, vector_id2) if vector_id1 <= vector_id2 else (vector_id2, vector_id1)
+
+def save_duplicate_pair(vector_id1, vector_id2, similarity, method='faiss'):
+    save_duplicate_pairs([(vector_id1, vector_id2, similarity)], method)
+
+def save_duplicate_pairs(pairs, method='faiss'):
+    """Save many (vector_id1, vector_id2, similarity) pairs found by a method in a single transaction.
+    A pair that already exists for the method, in either order, has its similarity updated."""
+    if not pairs:
+        return
+    rows = [(*_ordered_pair(id1, id2), float(similarity), method) for id1, id2, similarity in pairs]
     try:
-        conn = sqlite3.connect('duplicates.db')
-        cursor = conn.cursor()
-
-        # Check if the pair already exists in either order
-        cursor.execute("SELECT * FROM duplicates WHERE (vector_id1 = ? AND vector_id2 = ?) OR (vector_id1 = ? AND vector_id2 = ?)",
-                       (vector_id1, vector_id2, vector_id2, vector_id1))
-        if cursor.fetchone():
-            #print("Duplicate pair already exists.")
-            return
-
-        # If not, insert the new pair
-        cursor.execute("INSERT INTO duplicates (vector_id1, vector_id2, similarity) VALUES (?, ?, ?)",
-                       (vector_id1, vector_id2, similarity))
-        conn.commit()
+        duplicates_db().executemany("""
+            INSERT INTO duplicates (vector_id1, vector_id2, similarity, method) VALUES (?, ?, ?, ?)
+            ON CONFLICT(vector_id1, vector_id2, method) DO UPDATE SET similarity = excluded.similarity""", rows)
     except Exception as e:
-        print("Error inserting duplicate pair:", e)
-    finally:
-        conn.close()
+        print("Error inserting duplicate pairs:", e)
+
+def replace_duplicate_pairs(pairs, method):
+    """Replace every stored pair of a method with pairs, in a single transaction.
+    A pair given more than once, in either order, keeps its last similarity."""
+    rows = [(*_ordered_pair(id1, id2), float(similarity), method) for id1, id2, similarity in pairs]
+    with duplicates_db().transaction() as conn:
+        conn.execute("DELETE FROM duplicates WHERE method = ?", (method,))
+        conn.executemany("""
+            INSERT INTO duplicates (vector_id1, vector_id2, similarity, method) VALUES (?, ?, ?, ?)
+            ON CONFLICT(vector_id1, vector_id2, method) DO UPDATE SET similarity = excluded.similarity""", rows)
 
 def delete_duplicate_pair(asset_id_1, asset_id_2):
     try:
-        conn = sqlite3.connect('duplicates.db')
-        cursor = conn.cursor()
         # Delete the specific duplicate entry involving the two asset IDs
-        cursor.execute("DELETE FROM duplicates WHERE (vector_id1 = ? AND vector_id2 = ?) OR (vector_id1 = ? AND vector_id2 = ?)", (asset_id_1, asset_id_2, asset_id_2, asset_id_1))
-        conn.commit()
+        duplicates_db().execute("DELETE FROM duplicates WHERE vector_id1 = ? AND vector_id2 = ?", _ordered_pair(asset_id_1, asset_id_2))
         print("Deleted asset from db")
     except Exception as e:
         print(f"Error deleting duplicate entries for asset pair {asset_id_1}-{asset_id_2}:", e)
-    finally:
-        conn.close()
 
-def load_duplicate_pairs(min_threshold, max_threshold):
-    """Load duplicate pairs with a similarity between the specified minimum and maximum thresholds."""
+def delete_duplicate_pairs_of_assets(asset_ids):
+    """Delete every duplicate pair that involves one of the assets."""
+    with duplicates_db().transaction() as conn:
+        for chunk in _chunks(asset_ids):
+            placeholders = ','.join('?' * len(chunk))
+            conn.execute(f"DELETE FROM duplicates WHERE vector_id1 IN ({placeholders}) OR vector_id2 IN ({placeholders})", chunk + chunk)
+
+def load_duplicate_pairs(min_threshold, max_threshold, methods=None):
+    """Load duplicate pairs with a similarity between the specified minimum and maximum thresholds.
+    methods limits the pairs to those found by the given engines; a pair found by several is returned once."""
+    methods = list(methods or DUPLICATE_METHODS)
     try:
-        conn = sqlite3.connect('duplicates.db')
-        cursor = conn.cursor()
         # Adjust the SQL query to filter duplicates within the specified range
-        cursor.execute("""
-            SELECT vector_id1, vector_id2 FROM duplicates
-            WHERE similarity >= ? AND similarity <= ?""",
-            (min_threshold, max_threshold))
-        duplicates = cursor.fetchall()
+        duplicates = duplicates_db().fetchall(f"""
+            SELECT DISTINCT vector_id1, vector_id2 FROM duplicates
+            WHERE similarity >= ? AND similarity <= ? AND method IN ({','.join('?' * len(methods))})""",
+            (min_threshold, max_threshold, *methods))
         if not duplicates:
             print(f"No duplicates found within thresholds {min_threshold} and {max_threshold}")
         return duplicates
     except Exception as e:
         print("Error loading duplicates:", e)
-    finally:
-        if conn:
-            conn.close()
 
 def is_db_populated():
     """Check if the 'duplicates' table in the database has any entries."""
-    conn = None
     try:
-        conn = sqlite3.connect('duplicates.db')
-        cursor = conn.cursor()
         # Check if there are any rows in the table
-        cursor.execute("SELECT EXISTS(SELECT 1 FROM duplicates LIMIT 1)")
-        exists = cursor.fetchone()[0]
+        exists = duplicates_db().fetchone("SELECT EXISTS(SELECT 1 FROM duplicates LIMIT 1)")[0]
         return exists == 1
     except Exception as e:
         print("Error checking database population:", e)
         return False
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
@@ -0,0 +1,61 @@
+import os
+import time
+
+import numpy as np
+
+from db import loadCachedEmbeddings, saveCachedEmbeddings, evictCachedEmbeddings
+
+# Embeddings kept in embedding_cache.db; the least recently used ones are evicted beyond this
+DEFAULT_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 500000))
+CACHE_DTYPE = 'float16'
+
+class EmbeddingCache:
+    """Embeddings keyed by the content checksum Immich reports for an asset.
+
+    A re-imported, moved or restored asset keeps its checksum but gets a new
+    id, so its embedding is found here instead of downloading and embedding
+    the image again. Entries are also keyed by the embedding model, the
+    inference backend, int8 quantization and the preprocessing version, so
+    changing any of them never returns vectors of another model variant.
+    hits and misses count the lookups of this instance.
+    """
+
+    def __init__(self, model_name, preprocessing_version, backend, quantize=False, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.backend = backend
+        self.quantize = bool(quantize)
+        self.preprocessing_version = int(preprocessing_version)
+        self.max_entries = max(0, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, checksums):
+        """Return {checksum: float32 vector} for the checksums that are cached."""
+        checksums = list(dict.fromkeys(checksum for checksum in checksums if checksum))
+        if not checksums or not self.max_entries:
+            self.misses += len(checksums)
+            return {}
+        found = loadCachedEmbeddings(checksums, self.model_name, self.backend, self.quantize, self.preprocessing_version, time.time())
+        self.hits += len(found)
+        self.misses += len(checksums) - len(found)
+        return {checksum: np.frombuffer(vector, dtype=dtype).astype('float32') for checksum, (dtype, vector) in found.items()}
+
+    def put_many(self, items):
+        """Cache (checksum, vector) items; items without a checksum are ignored."""
+        if not self.max_entries:
+            return
+        now = time.time()
+        rows = [(checksum, self.model_name, self.backend, int(self.quantize), self.preprocessing_version, CACHE_DTYPE,
+                 np.asarray(vector, dtype=CACHE_DTYPE).reshape(-1).tobytes(), now)
+                for checksum, vector in items if checksum]
+        if rows:
+            saveCachedEmbeddings(rows)
+
+    def evict(self):
+        """Delete the least recently used entries beyond max_entries. Returns the number deleted."""
+        return evictCachedEmbeddings(self.max_entries)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"embedding cache {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
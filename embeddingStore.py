@@ -0,0 +1,127 @@
+import os
+import json
+
+import numpy as np
+
+# Embeddings are stored next to the index, one row per stable vector id
+embeddings_path = 'embeddings.bin'             # rows of `dimension` values of `dtype`
+embeddings_valid_path = 'embeddings.valid'     # one byte per row, 1 if the row holds a vector
+embeddings_info_path = 'embeddings.json'       # model, dimension and dtype of the rows
+
+EMBEDDING_DTYPES = ['float16', 'float32']
+DEFAULT_EMBEDDING_DTYPE = os.environ.get('EMBEDDING_DTYPE', 'float16')
+MIN_CAPACITY = 1024  # rows reserved when the store is created
+
+class EmbeddingStore:
+    """Embeddings of the indexed assets in a memory-mapped array on disk.
+
+    Row i holds the vector of vector id i (see db.getVectorIds), so vectors are
+    looked up without an index, and a FAISS index of any type can be built
+    from the store without downloading anything again. The files grow by
+    doubling when vectors are appended. Opened read-only, the store is
+    shared through the page cache by every process that maps it.
+    """
+
+    def __init__(self, readonly=False):
+        if not os.path.exists(embeddings_info_path):
+            raise FileNotFoundError(f"No embedding store at {embeddings_path}.")
+        with open(embeddings_info_path) as f:
+            info = json.load(f)
+        self.model_name = info['model']
+        self.dimension = int(info['dimension'])
+        self.dtype = np.dtype(info['dtype'])
+        self.readonly = readonly
+        self._map()
+
+    @classmethod
+    def create(cls, model_name, dimension, dtype=DEFAULT_EMBEDDING_DTYPE):
+        """Create an empty store, replacing any existing one."""
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{dtype}'. Available dtypes: {', '.join(EMBEDDING_DTYPES)}")
+        for path, size in ((embeddings_path, MIN_CAPACITY * dimension * np.dtype(dtype).itemsize), (embeddings_valid_path, MIN_CAPACITY)):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        tmp_path = f"{embeddings_info_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'model': model_name, 'dimension': int(dimension), 'dtype': dtype}, f)
+        os.replace(tmp_path, embeddings_info_path)
+        return cls()
+
+    @classmethod
+    def open_or_create(cls, model_name, dimension, dtype=DEFAULT_EMBEDDING_DTYPE):
+        """Open the store for writing, creating it if there is none. Raise ValueError if it holds another model's vectors."""
+        if not os.path.exists(embeddings_info_path):
+            return cls.create(model_name, dimension, dtype)
+        store = cls()
+        if store.model_name != model_name or store.dimension != dimension:
+            store.close()
+            raise ValueError(
+                f"The embedding store holds '{store.model_name}' vectors ({store.dimension} dimensions) but '{model_name}' "
+                f"({dimension} dimensions) is selected. Select '{store.model_name}' or delete {embeddings_path}, "
+                f"{embeddings_valid_path} and {embeddings_info_path}."
+            )
+        return store
+
+    def _map(self):
+        mode = 'r' if self.readonly else 'r+'
+        self.capacity = os.path.getsize(embeddings_valid_path)
+        self.vectors = np.memmap(embeddings_path, dtype=self.dtype, mode=mode, shape=(self.capacity, self.dimension))
+        self.valid = np.memmap(embeddings_valid_path, dtype='uint8', mode=mode, shape=(self.capacity,))
+
+    def _reserve(self, rows):
+        """Grow the files so they hold at least `rows` rows."""
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, 2 * self.capacity, MIN_CAPACITY)
+        self.close()
+        with open(embeddings_path, 'r+b') as f:
+            f.truncate(capacity * self.dimension * self.dtype.itemsize)
+        with open(embeddings_valid_path, 'r+b') as f:
+            f.truncate(capacity)
+        self._map()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.valid))
+
+    def __contains__(self, vector_id):
+        return 0 <= vector_id < self.capacity and bool(self.valid[vector_id])
+
+    def ids(self):
+        """Return the vector ids that have a stored vector."""
+        return np.flatnonzero(self.valid).astype('int64')
+
+    def get(self, vector_ids):
+        """Return the vectors of the given ids as float32."""
+        return np.asarray(self.vectors[np.asarray(vector_ids, dtype='int64')], dtype='float32')
+
+    def add(self, vector_ids, vectors):
+        """Store vectors under their vector ids, overwriting existing rows."""
+        vector_ids = np.asarray(vector_ids, dtype='int64')
+        if not len(vector_ids):
+            return
+        self._reserve(int(vector_ids.max()) + 1)
+        self.vectors[vector_ids] = np.asarray(vectors, dtype='float32').reshape(len(vector_ids), self.dimension)
+        self.valid[vector_ids] = 1
+
+    def remove(self, vector_ids):
+        vector_ids = np.asarray(vector_ids, dtype='int64')
+        vector_ids = vector_ids[vector_ids < self.capacity]
+        self.valid[vector_ids] = 0
+
+    def flush(self):
+        if not self.readonly and self.vectors is not None:
+            self.vectors.flush()
+            self.valid.flush()
+
+    def close(self):
+        self.flush()
+        # Dropping the memmaps unmaps the files
+        self.vectors = None
+        self.valid = None
+
+def open_embedding_store(readonly=True):
+    """Return the embedding store, or None if there is none yet."""
+    try:
+        return EmbeddingStore(readonly=readonly)
+    except FileNotFoundError:
+        return None
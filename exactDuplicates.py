@@ -0,0 +1,35 @@
+from db import replace_duplicate_pairs, save_duplicate_pairs
+
+def exact_duplicate_key(asset):
+    """Assets with the same key are byte-identical: same content checksum and file size."""
+    checksum = asset.get('checksum')
+    if not checksum:
+        return None
+    return checksum, (asset.get('exifInfo') or {}).get('fileSizeInByte')
+
+def exact_duplicate_groups(assets):
+    """Group the ids of byte-identical assets in one pass. Returns only groups of two or more, in catalog order."""
+    groups = {}
+    for asset in assets:
+        key = exact_duplicate_key(asset)
+        if key is not None:
+            groups.setdefault(key, []).append(asset['id'])
+    return [group for group in groups.values() if len(group) > 1]
+
+def exact_duplicate_pairs(groups):
+    """Pair the first asset of every group with each of its copies, at distance 0."""
+    return [(group[0], copy, 0.0) for group in groups for copy in group[1:]]
+
+def saveExactDuplicates(assets, replace=True):
+    """Store the exact duplicates among assets as 'checksum' pairs and return the groups.
+
+    With replace, assets must be the whole catalog: the stored 'checksum' pairs
+    are replaced, so pairs of deleted or changed assets disappear. Otherwise
+    the pairs are only added."""
+    groups = exact_duplicate_groups(assets)
+    pairs = exact_duplicate_pairs(groups)
+    if replace:
+        replace_duplicate_pairs(pairs, method='checksum')
+    else:
+        save_duplicate_pairs(pairs, method='checksum')
+    return groups
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+
+import numpy as np
+import faiss
+
+from backbones import backbone_dimension, normalizes_embeddings, DEFAULT_BACKBONE, LEGACY_BACKBONE
+from indexFactory import build_index, new_index, enable_reconstruct, index_ids, reconstruct_ids, remove_ids, index_type_of
+from embeddingStore import EmbeddingStore, open_embedding_store, DEFAULT_EMBEDDING_DTYPE
+from db import getVectorIds, loadVectorIdMap, getDeletedVectorIds, deleteVectorIds, delete_duplicate_pairs_of_assets
+from metrics import inc, observe, timer
+
+# Global variables for paths
+index_path = 'faiss_index.bin'
+legacy_metadata_path = 'metadata.npy'  # Positional asset ids of indexes written before stable ids
+index_info_path = 'faiss_index.json'  # Embedding model, dimension and normalization the index was built with
+
+# Defaults for the in-memory index writer used during indexing
+DEFAULT_WRITER_BATCH_SIZE = 64   # vectors buffered before a single index.add()
+DEFAULT_FLUSH_INTERVAL = 60      # seconds between flushes to disk
+DEFAULT_FLUSH_BATCHES = 20       # batches added between flushes to disk
+
+# Defaults for the all-pairs duplicate search
+DEFAULT_SEARCH_MODE = 'knn'      # 'knn' or 'range'
+DEFAULT_SEARCH_K = 5             # neighbours per vector in 'knn' mode
+DEFAULT_SEARCH_RADIUS = 0.6      # squared L2 threshold in 'range' mode; 2 - 2 x cosine for normalized embeddings
+DEFAULT_SEARCH_BLOCK_SIZE = 4096 # query vectors per search call
+
+def load_index_info():
+    """Return the embedding model and dimension of the stored index, or None if there is no index.
+
+    Indexes written before this information was stored are ResNet152 class-logit indexes."""
+    if os.path.exists(index_info_path):
+        with open(index_info_path) as f:
+            return json.load(f)
+    if os.path.exists(index_path):
+        return {'model': LEGACY_BACKBONE, 'dimension': backbone_dimension(LEGACY_BACKBONE)}
+    return None
+
+def index_needs_normalizing(info):
+    """Return True if an index holds vectors of a normalizing backbone added before they were normalized."""
+    return info is not None and normalizes_embeddings(info['model']) and not info.get('normalized', False)
+
+def normalize_vectors(vectors, model_name):
+    """Return the vectors as float32 rows, L2-normalized if the backbone's index holds unit vectors."""
+    vectors = np.asarray(vectors, dtype='float32')
+    if not normalizes_embeddings(model_name):
+        return vectors
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def check_index_model(model_name):
+    """Raise ValueError if the stored index was built with a different embedding model, or must be normalized first."""
+    info = load_index_info()
+    if info is None:
+        return
+    if info['model'] != model_name or info['dimension'] != backbone_dimension(model_name):
+        raise ValueError(
+            f"The FAISS index was built with '{info['model']}' ({info['dimension']} dimensions) but '{model_name}' "
+            f"({backbone_dimension(model_name)} dimensions) is selected. Select '{info['model']}' or delete "
+            f"{index_path} and {index_info_path} to rebuild the index."
+        )
+    if index_needs_normalizing(info):
+        raise ValueError(
+            f"The FAISS index holds '{model_name}' embeddings that were added before embeddings were normalized. "
+            f"Rebuild the FAISS index once (`python -m cli rebuild`) to normalize them, then index again."
+        )
+
+def _atomic_write(path, write_func):
+    """Write a file through a temporary sibling and rename it into place."""
+    tmp_path = f"{path}.tmp"
+    write_func(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_faiss_index(index, model_name, normalized=None):
+    """Save the FAISS index and its info file to disk, replacing the old files atomically.
+
+    normalized records whether the vectors are L2-normalized; it defaults to what the backbone requires."""
+    if normalized is None:
+        normalized = normalizes_embeddings(model_name)
+
+    def write_info(path):
+        with open(path, 'w') as f:
+            json.dump({'model': model_name, 'dimension': index.d, 'index_type': index_type_of(index), 'ids': 'stable',
+                       'normalized': bool(normalized)}, f)
+
+    _atomic_write(index_path, lambda path: faiss.write_index(index, path))
+    _atomic_write(index_info_path, write_info)
+
+def _migrate_legacy_index(index, info):
+    """Convert an index whose vectors are identified by their position in metadata.npy to stable ids.
+
+    Every asset gets a vector id and the index is rebuilt with the vectors
+    stored under those ids; metadata.npy is kept as metadata.npy.migrated."""
+    if not os.path.exists(legacy_metadata_path):
+        print(f"Warning: {index_path} has no stable ids and {legacy_metadata_path} is missing; rebuild the index.")
+        return None
+    metadata = np.load(legacy_metadata_path, allow_pickle=True).tolist()
+    count = min(index.ntotal, len(metadata))
+    if index.ntotal != len(metadata):
+        print(f"Warning: FAISS index has {index.ntotal} vectors but metadata has {len(metadata)} entries.")
+    enable_reconstruct(index)
+    vectors = index.reconstruct_n(0, count) if count else np.empty((0, index.d), dtype='float32')
+    # An asset indexed twice keeps its first vector
+    positions = {}
+    for position, asset_id in enumerate(metadata[:count]):
+        positions.setdefault(asset_id, position)
+    vector_ids = getVectorIds(list(positions))
+    ids = np.array([vector_ids[asset_id] for asset_id in positions], dtype='int64')
+    vectors = vectors[list(positions.values())]
+    try:
+        migrated = build_index(index_type_of(index), vectors, ids)
+    except ValueError:
+        # Too few vectors left to train the IVF index
+        migrated = build_index('Flat', vectors, ids)
+    save_faiss_index(migrated, info['model'], normalized=False)
+    os.replace(legacy_metadata_path, f"{legacy_metadata_path}.migrated")
+    return migrated
+
+def init_or_load_faiss_index(include_deleted=False):
+    """Load the stored index and the {vector_id: asset_id} map of its vectors.
+
+    Returns (None, {}) if there is no index. Vectors of assets deleted on the
+    server are left out of the map unless include_deleted is set."""
+    if not os.path.exists(index_path):
+        return None, {}
+    index = faiss.read_index(index_path)
+    info = load_index_info()
+    if info.get('ids') != 'stable':
+        index = _migrate_legacy_index(index, info)
+        if index is None:
+            return None, {}
+    enable_reconstruct(index)
+    return index, loadVectorIdMap(include_deleted)
+
+def pruneDeletedAssets():
+    """Remove the vectors, stored embeddings and duplicate pairs of assets deleted or trashed on the server.
+
+    Their vector ids are released, so a restored asset is indexed again under
+    a new id. Returns the number of vectors removed from the index."""
+    deleted = getDeletedVectorIds()
+    if not deleted:
+        return 0
+    removed = 0
+    store = open_embedding_store(readonly=False)
+    if store is not None:
+        store.remove(np.fromiter(deleted, dtype='int64'))
+        store.close()
+    info = load_index_info()
+    if info is not None:
+        index, _ = init_or_load_faiss_index()
+        if index is not None:
+            present = np.intersect1d(index_ids(index), np.fromiter(deleted, dtype='int64'))
+            if len(present):
+                index = remove_ids(index, present)
+                save_faiss_index(index, info['model'], normalized=info.get('normalized', False))
+            removed = len(present)
+    delete_duplicate_pairs_of_assets(list(deleted.values()))
+    deleteVectorIds(deleted)
+    return removed
+
+class FaissIndexWriter:
+    """Keep the FAISS index in memory for a whole indexing run.
+
+    Vectors are buffered, normalized if the backbone requires it (see
+    normalize_vectors), and added to the index and the embedding store in
+    batches under the stable vector id of their asset; the index is written
+    to disk every `flush_batches` batches or every `flush_interval` seconds,
+    whichever comes first, and on close(). Vectors that are in the store but
+    missing from the index, e.g. after the index file was deleted, are added
+    back from the store instead of being embedded again.
+    """
+
+    def __init__(self, model_name=DEFAULT_BACKBONE, batch_size=DEFAULT_WRITER_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, flush_batches=DEFAULT_FLUSH_BATCHES,
+                 embedding_dtype=DEFAULT_EMBEDDING_DTYPE):
+        check_index_model(model_name)
+        self.model_name = model_name
+        self.dimension = backbone_dimension(model_name)
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.flush_batches = max(1, int(flush_batches))
+        self.store = EmbeddingStore.open_or_create(model_name, self.dimension, embedding_dtype)
+        self.index, _ = init_or_load_faiss_index()
+        self.batches_since_flush = 0
+        self._sync_with_store()
+        # Deleted assets still count as processed until they are pruned, so a vector id is never added twice
+        id_map = loadVectorIdMap(include_deleted=True)
+        indexed = index_ids(self.index).tolist() if self.index is not None else []
+        self.processed_ids = {id_map[vector_id] for vector_id in indexed if vector_id in id_map}
+        self.pending_vectors = []
+        self.pending_ids = []
+        self.last_flush = time.time()
+
+    def _sync_with_store(self):
+        """Add stored vectors missing from the index, and store the vectors of indexes built before the store existed."""
+        indexed = index_ids(self.index) if self.index is not None else np.empty(0, dtype='int64')
+        unstored = np.setdiff1d(indexed, self.store.ids())
+        if len(unstored):
+            self.store.add(unstored, reconstruct_ids(self.index, unstored))
+            self.store.flush()
+        missing = np.setdiff1d(self.store.ids(), indexed)
+        if len(missing):
+            if self.index is None:
+                self.index = new_index(self.dimension)
+            self.index.add_with_ids(normalize_vectors(self.store.get(missing), self.model_name), missing)
+            self.batches_since_flush += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def is_processed(self, asset_id):
+        """Return True if the asset is already in the index or waiting to be added."""
+        return asset_id in self.processed_ids
+
+    def add(self, asset_id, features):
+        """Queue the feature vector of an asset for insertion into the index."""
+        if asset_id in self.processed_ids:
+            return
+        self.pending_vectors.append(np.asarray(features, dtype='float32').reshape(-1))
+        self.pending_ids.append(asset_id)
+        self.processed_ids.add(asset_id)
+        if len(self.pending_ids) >= self.batch_size:
+            self._add_pending()
+            if self.batches_since_flush >= self.flush_batches or time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def _add_pending(self):
+        """Add all buffered vectors to the in-memory index with a single call."""
+        if not self.pending_ids:
+            return
+        vectors = normalize_vectors(np.vstack(self.pending_vectors), self.model_name)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-dimensional features from '{self.model_name}', got {vectors.shape[1]}.")
+        if self.index is None:
+            # Initialize the FAISS index with the correct dimension if it's the first time
+            self.index = new_index(self.dimension)
+        vector_ids = getVectorIds(self.pending_ids)
+        ids = np.array([vector_ids[asset_id] for asset_id in self.pending_ids], dtype='int64')
+        with timer('index_add_duration_seconds'):
+            self.store.add(ids, vectors)
+            self.index.add_with_ids(vectors, ids)
+        inc('index_vectors_added_total', len(ids))
+        self.pending_vectors = []
+        self.pending_ids = []
+        self.batches_since_flush += 1
+
+    def flush(self):
+        """Add any buffered vectors and write the index and embedding store to disk."""
+        self._add_pending()
+        if self.index is not None and self.batches_since_flush > 0:
+            # The store is flushed first so a saved index never references vectors the store lost
+            with timer('index_flush_duration_seconds'):
+                self.store.flush()
+                save_faiss_index(self.index, self.model_name)
+        self.batches_since_flush = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.store.close()
+
+def find_duplicate_pairs(index, id_map, mode=DEFAULT_SEARCH_MODE, k=DEFAULT_SEARCH_K, radius=DEFAULT_SEARCH_RADIUS, block_size=DEFAULT_SEARCH_BLOCK_SIZE,
+                         first=0):
+    """Search the whole index against itself in blocks of vectors.
+
+    In 'knn' mode every vector is paired with its k nearest neighbours; in
+    'range' mode with every vector closer than radius (in the index's distance
+    units). Vectors whose id isn't in id_map, such as those of deleted
+    assets, are skipped. Yields (vectors_done, pairs) per block, where pairs
+    is a list of (asset_id1, asset_id2, distance) with each pair reported once
+    per block. The first `first` vectors are not searched, which resumes an
+    earlier search of the same index.
+    """
+    ids = index_ids(index)
+    num_vectors = len(ids)
+    block_size = max(1, int(block_size))
+    for start in range(min(max(0, int(first)), num_vectors), num_vectors, block_size):
+        block_start = time.perf_counter()
+        block_ids = ids[start:start + block_size]
+        count = len(block_ids)
+        queries = reconstruct_ids(index, block_ids)
+        block_pairs = {}
+        if mode == 'range':
+            lims, distances, labels = index.range_search(queries, radius)
+            for row in range(count):
+                _collect_pairs(block_pairs, id_map, block_ids[row], labels[lims[row]:lims[row + 1]], distances[lims[row]:lims[row + 1]])
+        else:
+            # One extra neighbour because every vector finds itself
+            distances, labels = index.search(queries, int(k) + 1)
+            for row in range(count):
+                _collect_pairs(block_pairs, id_map, block_ids[row], labels[row], distances[row])
+        observe('pair_search_duration_seconds', time.perf_counter() - block_start, engine=f"faiss-{mode}")
+        inc('pairs_found_total', len(block_pairs), engine=f"faiss-{mode}")
+        yield start + count, [(id1, id2, distance) for (id1, id2), distance in block_pairs.items()]
+
+def _collect_pairs(block_pairs, id_map, query, labels, distances):
+    """Add the neighbours of one query vector to block_pairs, keyed by the ordered asset id pair."""
+    query_asset = id_map.get(int(query))
+    if query_asset is None:
+        return
+    for label, distance in zip(labels.tolist(), distances.tolist()):
+        if label < 0 or label == query:
+            continue
+        asset = id_map.get(label)
+        if asset is None:
+            continue
+        pair = (min(query_asset, asset), max(query_asset, asset))
+        if pair not in block_pairs or distance < block_pairs[pair]:
+            block_pairs[pair] = float(distance)
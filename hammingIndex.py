@@ -0,0 +1,217 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from metrics import inc, observe
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 6     # bits; pHashes this close are near-duplicates
+LARGE_BUCKET = 64            # buckets larger than this are compared block by block
+BUCKET_BLOCK_SIZE = 1024     # hashes per side of one block comparison
+
+# Brute-force engine: a block of 1024 x 1024 hashes needs about 16 MB of scratch memory per worker
+DEFAULT_BRUTE_FORCE_BLOCK_SIZE = 1024
+DEFAULT_BRUTE_FORCE_WORKERS = os.cpu_count() or 1
+
+HASH_ENGINES = ['multi-index', 'brute-force']
+
+# Bit counts of every 16-bit value; 64 KB, so lookups stay in cache
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(1 << 16)], dtype='uint8')
+
+def phash_to_int(phash_hex):
+    """Convert a 64-bit hex pHash string, as stored by imagehash, to an int. Returns None for other hash sizes."""
+    if not phash_hex or len(phash_hex) > HASH_BITS // 4:
+        return None
+    try:
+        return int(phash_hex, 16)
+    except ValueError:
+        return None
+
+def pack_hashes(hashes):
+    """Pack ints as a uint64 array."""
+    return np.fromiter(hashes, dtype='uint64')
+
+def popcount(values):
+    """Number of set bits of every uint64 value."""
+    values = np.ascontiguousarray(values, dtype='uint64')
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype('uint8', copy=False)
+    # NumPy < 2 has no popcount: count the bits of the four 16-bit words with a lookup table
+    words = _POPCOUNT_TABLE[values.view('uint16')].reshape(values.shape + (4,))
+    return (words[..., 0] + words[..., 1]) + (words[..., 2] + words[..., 3])
+
+def hamming_distances(left, right):
+    """Element-wise Hamming distance between two uint64 arrays (broadcasting like ^)."""
+    return popcount(np.bitwise_xor(left, right))
+
+def _chunk_ranges(num_chunks):
+    """Split the hash bits into num_chunks contiguous (shift, width) ranges of near-equal width."""
+    widths = [HASH_BITS // num_chunks + (1 if chunk < HASH_BITS % num_chunks else 0) for chunk in range(num_chunks)]
+    shifts = np.cumsum([0] + widths[:-1])
+    return [(int(shift), width) for shift, width in zip(shifts, widths)]
+
+class MultiIndexHash:
+    """Multi-index hashing of 64-bit hashes for Hamming-distance search.
+
+    The bits are split into max_distance + 1 chunks. Two hashes within
+    max_distance bits of each other must agree exactly on at least one chunk
+    (pigeonhole), so only hashes sharing a chunk value are compared. With
+    random-looking hashes this compares about N^2 / 2^(bits per chunk) pairs
+    per chunk instead of all N^2.
+    """
+
+    def __init__(self, hashes, max_distance=DEFAULT_MAX_DISTANCE):
+        self.hashes = np.ascontiguousarray(hashes, dtype='uint64')
+        self.max_distance = int(max_distance)
+        self.chunks = _chunk_ranges(min(self.max_distance + 1, HASH_BITS))
+        self.keys = [self._chunk_keys(self.hashes, chunk) for chunk in range(len(self.chunks))]
+        self.orders = [np.argsort(keys, kind='stable') for keys in self.keys]
+        self.sorted_keys = [keys[order] for keys, order in zip(self.keys, self.orders)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _chunk_keys(self, hashes, chunk):
+        shift, width = self.chunks[chunk]
+        return (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+
+    def search(self, query):
+        """Return (positions, distances) of the indexed hashes within max_distance of one hash."""
+        query = np.array([query], dtype='uint64')
+        candidates = []
+        for chunk in range(len(self.chunks)):
+            key = self._chunk_keys(query, chunk)[0]
+            start = np.searchsorted(self.sorted_keys[chunk], key, side='left')
+            end = np.searchsorted(self.sorted_keys[chunk], key, side='right')
+            candidates.append(self.orders[chunk][start:end])
+        candidates = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype='int64')
+        distances = hamming_distances(self.hashes[candidates], query[0])
+        keep = distances <= self.max_distance
+        return candidates[keep], distances[keep]
+
+    def pairs(self, progress_callback=None):
+        """Yield (left, right, distances) arrays of positions of every pair within max_distance, each pair once.
+
+        A pair is reported by the first chunk its hashes agree on. progress_callback,
+        if given, is called with (chunks_done, num_chunks)."""
+        for chunk in range(len(self.chunks)):
+            order, sorted_keys = self.orders[chunk], self.sorted_keys[chunk]
+            num_hashes = len(order)
+            if num_hashes < 2:
+                break
+            # Size of the bucket every sorted position belongs to
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            sizes = np.diff(np.r_[starts, num_hashes])
+            bucket_sizes = np.repeat(sizes, sizes)
+
+            # Small buckets: compare every position with the ones up to LARGE_BUCKET places after it
+            small = bucket_sizes <= LARGE_BUCKET
+            positions = np.arange(num_hashes)
+            for offset in range(1, min(int(sizes.max()), LARGE_BUCKET + 1)):
+                left = positions[:num_hashes - offset]
+                right = left + offset
+                same = small[left] & (sorted_keys[left] == sorted_keys[right])
+                if same.any():
+                    yield self._verify(chunk, order[left[same]], order[right[same]])
+
+            # Large buckets: compare blocks of members, keeping each pair once
+            for start, size in zip(starts[sizes > LARGE_BUCKET], sizes[sizes > LARGE_BUCKET]):
+                members = order[start:start + size]
+                for row_start in range(0, size, BUCKET_BLOCK_SIZE):
+                    rows = members[row_start:row_start + BUCKET_BLOCK_SIZE]
+                    for column_start in range(row_start, size, BUCKET_BLOCK_SIZE):
+                        columns = members[column_start:column_start + BUCKET_BLOCK_SIZE]
+                        row_positions = np.arange(row_start, row_start + len(rows))[:, None]
+                        column_positions = np.arange(column_start, column_start + len(columns))[None, :]
+                        row_index, column_index = np.nonzero(row_positions < column_positions)
+                        yield self._verify(chunk, rows[row_index], columns[column_index])
+            if progress_callback:
+                progress_callback(chunk + 1, len(self.chunks))
+
+    def _verify(self, chunk, left, right):
+        """Keep the candidate pairs within max_distance that no earlier chunk has reported."""
+        distances = hamming_distances(self.hashes[left], self.hashes[right])
+        keep = distances <= self.max_distance
+        for earlier in range(chunk):
+            keep &= self.keys[earlier][left] != self.keys[earlier][right]
+        return left[keep], right[keep], distances[keep]
+
+
+_worker_hashes = None
+
+def _init_worker(hashes):
+    global _worker_hashes
+    _worker_hashes = hashes
+
+def _compare_row_block(row_start, block_size, max_distance, hashes=None):
+    """Compare hashes[row_start:row_start + block_size] with every later hash, one column block at a time."""
+    hashes = _worker_hashes if hashes is None else hashes
+    rows = hashes[row_start:row_start + block_size]
+    lefts, rights, distances = [], [], []
+    for column_start in range(row_start, len(hashes), block_size):
+        columns = hashes[column_start:column_start + block_size]
+        block = hamming_distances(rows[:, None], columns[None, :])
+        row_index, column_index = np.nonzero(block <= max_distance)
+        left = row_start + row_index
+        right = column_start + column_index
+        keep = left < right
+        lefts.append(left[keep])
+        rights.append(right[keep])
+        distances.append(block[row_index[keep], column_index[keep]])
+    return np.concatenate(lefts), np.concatenate(rights), np.concatenate(distances)
+
+def brute_force_pairs(hashes, max_distance=DEFAULT_MAX_DISTANCE, block_size=DEFAULT_BRUTE_FORCE_BLOCK_SIZE,
+                      workers=DEFAULT_BRUTE_FORCE_WORKERS, progress_callback=None):
+    """Yield (left, right, distances) arrays of positions of every pair within max_distance by comparing all pairs.
+
+    Hashes are compared block against block with XOR and popcount, so memory
+    stays bounded by block_size^2 per worker. Row blocks are spread over a
+    pool of `workers` processes (1 runs in this process). Exact and
+    quadratic, it is a baseline for libraries up to a few hundred thousand
+    hashes and an oracle for MultiIndexHash. progress_callback, if given, is
+    called with (row_blocks_done, num_row_blocks)."""
+    hashes = np.ascontiguousarray(hashes, dtype='uint64')
+    block_size = max(1, int(block_size))
+    row_starts = list(range(0, len(hashes), block_size))
+    if workers <= 1 or len(row_starts) <= 1:
+        for done, row_start in enumerate(row_starts, start=1):
+            yield _compare_row_block(row_start, block_size, max_distance, hashes)
+            if progress_callback:
+                progress_callback(done, len(row_starts))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(hashes,)) as executor:
+        # Keep a few blocks in flight per worker so finished results don't pile up in memory
+        pending = set()
+        next_block = 0
+        done = 0
+        while next_block < len(row_starts) or pending:
+            while next_block < len(row_starts) and len(pending) < 2 * workers:
+                pending.add(executor.submit(_compare_row_block, row_starts[next_block], block_size, max_distance))
+                next_block += 1
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+                done += 1
+                if progress_callback:
+                    progress_callback(done, len(row_starts))
+
+def find_hash_pairs(asset_ids, hashes, max_distance=DEFAULT_MAX_DISTANCE, progress_callback=None, engine='multi-index',
+                    workers=DEFAULT_BRUTE_FORCE_WORKERS):
+    """Yield lists of (asset_id1, asset_id2, distance) for every pair of hashes within max_distance bits."""
+    if engine == 'brute-force':
+        results = brute_force_pairs(hashes, max_distance, workers=workers, progress_callback=progress_callback)
+    elif engine == 'multi-index':
+        results = MultiIndexHash(hashes, max_distance).pairs(progress_callback)
+    else:
+        raise ValueError(f"Unknown hash search engine '{engine}'. Available engines: {', '.join(HASH_ENGINES)}")
+    # Time spent producing each block, not the time the caller spends on it
+    block_start = time.perf_counter()
+    for left, right, distances in results:
+        observe('pair_search_duration_seconds', time.perf_counter() - block_start, engine=engine)
+        inc('pairs_found_total', len(left), engine=engine)
+        if len(left):
+            yield [(asset_ids[i], asset_ids[j], int(distance)) for i, j, distance in zip(left.tolist(), right.tolist(), distances.tolist())]
+        block_start = time.perf_counter()
@@ -4,24 +4,30 @@ import time
 
 import torch
 import numpy as np
-import faiss
-from torchvision.models import resnet152, ResNet152_Weights
 from torchvision.transforms import Compose, Resize, ToTensor, Normalize
-from PIL import Image
 
-from api import getImage
+from api import getImage, fetchImageBytes, decodeImage
 from utility import display_asset_column
-from api import getAssetInfo
-from db import load_duplicate_pairs, is_db_populated, save_duplicate_pair
+from assetCatalog import AssetCatalog
+from db import load_duplicate_pairs, is_db_populated, save_duplicate_pairs
 from streamlit_image_comparison import image_comparison
+from pipeline import EmbeddingPipeline, DEFAULT_FETCH_WORKERS, DEFAULT_DECODE_WORKERS
+from backbones import DEFAULT_BACKBONE
+from faissIndex import FaissIndexWriter, init_or_load_faiss_index, load_index_info, save_faiss_index, find_duplicate_pairs, normalize_vectors, index_needs_normalizing
+from faissIndex import DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_BATCHES, DEFAULT_SEARCH_MODE, DEFAULT_SEARCH_K, DEFAULT_SEARCH_RADIUS, DEFAULT_SEARCH_BLOCK_SIZE
+from indexFactory import build_index, set_search_params, recall_report, index_type_of, index_ids, reconstruct_ids
+from embeddingCache import EmbeddingCache
+from exactDuplicates import saveExactDuplicates, exact_duplicate_groups
+from shardIndex import ShardWriter, shard_of, SHARDS_DIR
+from embeddingStore import open_embedding_store, DEFAULT_EMBEDDING_DTYPE
+from reporter import Reporter
+from metrics import inc, timer
+from indexFactory import DEFAULT_INDEX_TYPE, DEFAULT_NLIST, DEFAULT_HNSW_M, DEFAULT_PQ_M, DEFAULT_NPROBE, DEFAULT_EF_SEARCH
+from inferenceBackend import get_backend, check_backend_agreement, DEFAULT_BACKEND, DEFAULT_QUANTIZE
 
 # Set the environment variable to allow multiple OpenMP libraries
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-# Load ResNet152 with pretrained weights
-model = resnet152(weights=ResNet152_Weights.DEFAULT)
-model.eval()  # Set model to evaluation mode
-
 def convert_image_to_rgb(image):
     """Convert image to RGB if it's RGBA."""
     if image.mode == 'RGBA':
@@ -35,185 +41,285 @@ transform = Compose([
     Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
 
-# Global variables for paths
-index_path = 'faiss_index.bin'
-metadata_path = 'metadata.npy'
+# Bump when `transform` changes so embeddings cached by checksum are computed again
+PREPROCESSING_VERSION = 1
 
-def extract_features(image):
-    """Extract features from an image using a pretrained model."""
-    image_tensor = transform(image).unsqueeze(0)  # Add batch dimension
-    with torch.no_grad():
-        features = model(image_tensor)
-    return features.numpy().flatten()
-
-def init_or_load_faiss_index():
-    """Initialize or load the FAISS index and metadata, ensuring index is ready for use."""
-    if os.path.exists(index_path) and os.path.exists(metadata_path):
-        index = faiss.read_index(index_path)
-        metadata = np.load(metadata_path, allow_pickle=True).tolist()
-    else:
-        index = None
-        metadata = []
-    return index, metadata
+# Defaults for batched feature extraction
+DEFAULT_INFERENCE_BATCH_SIZE = 32
+DEFAULT_NUM_THREADS = 0          # 0 keeps the torch default
 
-def save_faiss_index_and_metadata(index, metadata):
-    """Save the FAISS index and metadata to disk."""
-    faiss.write_index(index, index_path)
-    np.save(metadata_path, np.array(metadata, dtype=object))
+def set_inference_threads(num_threads):
+    """Set the number of CPU threads torch uses for inference (0 keeps the default)."""
+    if num_threads and num_threads > 0 and torch.get_num_threads() != num_threads:
+        torch.set_num_threads(int(num_threads))
 
-def update_faiss_index(immich_server_url,api_key, asset_id):
-    
-    """Update the FAISS index and metadata with a new image and its ID, 
-    skipping if the asset_id has already been processed."""
-    global index  # Assuming index is defined globally
-    index, existing_metadata = init_or_load_faiss_index()
-    
-    # Check if the asset_id is already in metadata to decide whether to skip processing
-    if asset_id in existing_metadata:
-        return 'skipped'  # Skip processing this image
-
-    image = getImage(asset_id, immich_server_url, "Thumbnail (fast)", api_key)
-    if image is not None:
-        features = extract_features(image)
-    else:
-        return 'error'
-    
-    if index is None:
-        # Initialize the FAISS index with the correct dimension if it's the first time
-        dimension = features.shape[0]
-        index = faiss.IndexFlatL2(dimension)
-    
-    index.add(np.array([features], dtype='float32'))
-    existing_metadata.append(asset_id)
-    
-    save_faiss_index_and_metadata(index, existing_metadata)
-    return 'processed'
-
-def calculateFaissIndex(assets, immich_server_url, api_key):
-    # Initialize session state variables if they are not already set
-    if 'message' not in st.session_state:
-        st.session_state['message'] = ""
-    if 'progress' not in st.session_state:
-        st.session_state['progress'] = 0
-    if 'stop_index' not in st.session_state:
-        st.session_state['stop_index'] = False
-
-    # Set up the UI components
-    progress_bar = st.progress(st.session_state['progress'])
-    stop_button = st.button('Stop Index Processing')
-    message_placeholder = st.empty()
-
-    # Check if stop was requested and reset it if button is pressed
-    if stop_button:
-        st.session_state['stop_index'] = True
-        st.session_state['calculate_faiss'] = False
-
-    total_assets = len(assets)
+def extract_features(image, model_name=DEFAULT_BACKBONE):
+    """Extract features from an image using a pretrained model."""
+    return extract_features_batch([image], model_name=model_name)[0]
+
+def extract_features_batch(images, batch_size=DEFAULT_INFERENCE_BATCH_SIZE, num_threads=DEFAULT_NUM_THREADS, model_name=DEFAULT_BACKBONE,
+                           backend=DEFAULT_BACKEND, quantize=DEFAULT_QUANTIZE):
+    """Extract features from a list of PIL images, running the model on batches of images.
+
+    Returns an (N, D) float32 array with one row per input image.
+    """
+    batch_size = max(1, int(batch_size))
+    features = [embed_tensors([transform(image) for image in images[start:start + batch_size]], num_threads, model_name, backend, quantize)
+                for start in range(0, len(images), batch_size)]
+    if not features:
+        return np.empty((0, 0), dtype='float32')
+    return np.concatenate(features)
+
+def embed_tensors(tensors, num_threads=DEFAULT_NUM_THREADS, model_name=DEFAULT_BACKBONE, backend=DEFAULT_BACKEND, quantize=DEFAULT_QUANTIZE):
+    """Run the model on a list of already transformed image tensors and return an (N, D) float32 array."""
+    set_inference_threads(num_threads)
+    embed = get_backend(model_name, backend, quantize, num_threads)
+    with timer('inference_duration_seconds', model=model_name, backend=backend):
+        features = embed(torch.stack(tensors))
+    inc('inference_images_total', len(tensors), model=model_name, backend=backend)
+    return features
+
+def preprocess_image_bytes(asset_id, content):
+    """Decode downloaded image bytes and apply the model transform, or return None on failure."""
+    image = decodeImage(content, asset_id)
+    if image is None:
+        return None
+    with timer('image_transform_duration_seconds'):
+        return transform(image)
+
+def calculateFaissIndex(assets, immich_server_url, api_key, flush_interval=DEFAULT_FLUSH_INTERVAL, flush_batches=DEFAULT_FLUSH_BATCHES,
+                        batch_size=DEFAULT_INFERENCE_BATCH_SIZE, num_threads=DEFAULT_NUM_THREADS,
+                        fetch_workers=DEFAULT_FETCH_WORKERS, decode_workers=DEFAULT_DECODE_WORKERS, model_name=DEFAULT_BACKBONE,
+                        backend=DEFAULT_BACKEND, quantize=DEFAULT_QUANTIZE, embedding_dtype=DEFAULT_EMBEDDING_DTYPE, reporter=None,
+                        shard=None, shards_dir=SHARDS_DIR):
+    """Embed the assets that aren't indexed yet and add them to the FAISS index, reporting progress to reporter.
+
+    With shard=(I, N) only the assets of shard I of N are embedded, and their
+    vectors are written to the shard directory for merge_shards instead of the
+    index, so N processes can index at once.
+
+    Returns the number of assets processed, skipped (already indexed), cached,
+    copies (exact duplicates of another asset) and errors, or None if indexing
+    could not start."""
+    reporter = reporter or Reporter()
     processed_assets = 0
     skipped_assets = 0
+    cached_assets = 0
+    copied_assets = 0
     error_assets = 0
-    total_time = 0
-
-    for i, asset in enumerate(assets):
-        if st.session_state['stop_index']:
-            st.session_state['message'] = "Processing stopped by user."
-            message_placeholder.text(st.session_state['message'])
-            break  # Break the loop if stop is requested
-
-        asset_id = asset.get('id')
-        start_time = time.time()
-
-        status = update_faiss_index(immich_server_url,api_key, asset_id)
-        if status == 'processed':
-            processed_assets += 1
-        elif status == 'skipped':
-            skipped_assets += 1
-        elif status == 'error':
-            error_assets += 1
-
-        end_time = time.time()
-        processing_time = end_time - start_time
-        total_time += processing_time
-
-        # Update progress and messages
-        progress_percentage = (i + 1) / total_assets
-        st.session_state['progress'] = progress_percentage
-        progress_bar.progress(progress_percentage)
-        estimated_time_remaining = (total_time / (i + 1)) * (total_assets - (i + 1))
-        estimated_time_remaining_min = int(estimated_time_remaining / 60)
-
-        st.session_state['message'] = f"Processing asset {i + 1}/{total_assets} - (Processed: {processed_assets}, Skipped: {skipped_assets}, Errors: {error_assets}). Estimated time remaining: {estimated_time_remaining_min} minutes."
-        message_placeholder.text(st.session_state['message'])
-
-    # Reset stop flag at the end of processing
-    st.session_state['stop_index'] = False
-    if processed_assets >= total_assets:
-        st.session_state['message'] = "Processing complete!"
-        message_placeholder.text(st.session_state['message'])
-        progress_bar.progress(1.0)
-
-def generate_db_duplicate():
-    st.write("Database initialization")
-    index, metadata = init_or_load_faiss_index()
-    if not index or not metadata:
-        st.write("FAISS index or metadata not available.")
-        return
-
-    # Check and update the stop mechanism in session state
-    if 'stop_requested' not in st.session_state:
-        st.session_state['stop_requested'] = False
-
-    # Button to request stopping
-    if st.button('Stop Finding Duplicates'):
-        st.session_state['stop_requested'] = True
-        st.session_state['generate_db_duplicate'] = False
-
-    num_vectors = index.ntotal
-    message_placeholder = st.empty()
-    progress_bar = st.progress(0)
-
-    for i in range(num_vectors):
-        # Check if stop has been requested
-        if st.session_state['stop_requested']:
-            message_placeholder.text("Processing was stopped by the user.")
-            progress_bar.empty()
-            # Optionally, reset the stop flag here if you want the process to be restartable without refreshing the page
-            st.session_state['stop_requested'] = False
+    start_time = time.time()
+    cache = EmbeddingCache(model_name, PREPROCESSING_VERSION, backend, quantize)
+
+    # Keep the index in memory for the whole run; the writer flushes periodically
+    try:
+        if shard is None:
+            writer = FaissIndexWriter(model_name=model_name, flush_interval=flush_interval, flush_batches=flush_batches, embedding_dtype=embedding_dtype)
+        else:
+            writer = ShardWriter(*shard, model_name=model_name, preprocessing_version=PREPROCESSING_VERSION, embedding_dtype=embedding_dtype,
+                                 root=shards_dir)
+        set_inference_threads(num_threads)
+        get_backend(model_name, backend, quantize, num_threads)  # Export/load the backend up front
+    except (ValueError, RuntimeError, ImportError) as e:
+        reporter.log(str(e), 'error')
+        return None
+
+    with writer:
+        # Byte-identical copies are paired from their checksums; one asset per group is enough to embed
+        # Shard workers leave saving the pairs to the process that started them
+        copies = set()
+        groups = saveExactDuplicates(assets, replace=False) if shard is None else exact_duplicate_groups(assets)
+        for group in groups:
+            keep = next((asset_id for asset_id in group if writer.is_processed(asset_id)), group[0])
+            copies.update(asset_id for asset_id in group if asset_id != keep)
+        if shard is not None:
+            assets = [asset for asset in assets if shard_of(asset['id'], shard[1]) == shard[0]]
+        total_assets = len(assets)
+
+        # Already indexed assets never enter the pipeline
+        pending_ids = []
+        checksums = {}
+        for asset in assets:
+            asset_id = asset.get('id')
+            if writer.is_processed(asset_id):
+                skipped_assets += 1
+            elif asset_id in copies:
+                copied_assets += 1
+            else:
+                pending_ids.append(asset_id)
+                checksums[asset_id] = asset.get('checksum')
+
+        # Nor do assets whose content was embedded before under another id
+        cached = cache.get_many(checksums.values())
+        if cached:
+            for asset_id in pending_ids:
+                if checksums[asset_id] in cached:
+                    writer.add(asset_id, cached[checksums[asset_id]])
+                    cached_assets += 1
+            pending_ids = [asset_id for asset_id in pending_ids if checksums[asset_id] not in cached]
+
+        pipeline = EmbeddingPipeline(
+            fetch_func=lambda asset_id: fetchImageBytes(asset_id, immich_server_url, "Thumbnail (fast)", api_key),
+            decode_func=preprocess_image_bytes,
+            embed_func=lambda tensors: embed_tensors(tensors, num_threads, model_name, backend, quantize),
+            batch_size=batch_size,
+            fetch_workers=fetch_workers,
+            decode_workers=decode_workers,
+        )
+        # Leaving the block (including on a Streamlit rerun) stops the worker threads
+        with pipeline:
+            for asset_ids, vectors, failed_ids in pipeline.run(pending_ids):
+                if reporter.stop_requested():
+                    reporter.log("Processing stopped by user.")
+                    break  # Break the loop if stop is requested
+
+                for asset_id, vector in zip(asset_ids, vectors):
+                    writer.add(asset_id, vector)
+                cache.put_many((checksums[asset_id], vector) for asset_id, vector in zip(asset_ids, vectors))
+                processed_assets += len(asset_ids)
+                error_assets += len(failed_ids)
+
+                # Update progress and messages
+                done = skipped_assets + cached_assets + copied_assets + processed_assets + error_assets
+                elapsed = time.time() - start_time
+                handled = processed_assets + error_assets
+                estimated_time_remaining = (elapsed / handled) * (total_assets - done) if handled else 0
+                estimated_time_remaining_min = int(estimated_time_remaining / 60)
+                reporter.progress(
+                    done, total_assets,
+                    f"Processing asset {done}/{total_assets} - (Processed: {processed_assets}, Skipped: {skipped_assets}, Cached: {cached_assets}, Exact copies: {copied_assets}, Errors: {error_assets}). Estimated time remaining: {estimated_time_remaining_min} minutes.\n"
+                    f"Throughput - {pipeline.summary()}; {cache.summary()}",
+                    processed=processed_assets, skipped=skipped_assets, cached=cached_assets, copies=copied_assets, errors=error_assets,
+                    eta_seconds=int(estimated_time_remaining))
+
+    cache.evict()
+    summary = {'processed': processed_assets, 'skipped': skipped_assets, 'cached': cached_assets, 'copies': copied_assets, 'errors': error_assets}
+    if processed_assets + skipped_assets + cached_assets + copied_assets >= total_assets:
+        reporter.progress(total_assets, total_assets, "Processing complete!", **summary)
+    return summary
+
+def checkInferenceBackend(assets, immich_server_url, api_key, model_name=DEFAULT_BACKBONE, backend=DEFAULT_BACKEND,
+                          quantize=DEFAULT_QUANTIZE, num_threads=DEFAULT_NUM_THREADS, sample_size=16):
+    """Report how closely the selected backend's embeddings match the fp32 PyTorch model on a sample of thumbnails."""
+    tensors = []
+    for asset in assets:
+        if len(tensors) >= sample_size:
+            break
+        image = getImage(asset.get('id'), immich_server_url, "Thumbnail (fast)", api_key)
+        if image is not None:
+            tensors.append(transform(image))
+    if not tensors:
+        st.error("Could not download any thumbnails to check the inference backend.")
+        return None
+
+    try:
+        set_inference_threads(num_threads)
+        report = check_backend_agreement(torch.stack(tensors), model_name, backend, quantize, num_threads)
+    except (ValueError, RuntimeError, ImportError) as e:
+        st.error(str(e))
+        return None
+    label = f"{backend}{' int8' if quantize else ''}"
+    st.write(f"Cosine agreement of {label} with fp32 {model_name} on {report['samples']} thumbnails: "
+             f"mean {report['mean_cosine']:.5f}, min {report['min_cosine']:.5f}")
+    return report
+
+def rebuildFaissIndex(index_type=DEFAULT_INDEX_TYPE, nlist=DEFAULT_NLIST, hnsw_m=DEFAULT_HNSW_M, pq_m=DEFAULT_PQ_M, k=DEFAULT_SEARCH_K, reporter=None):
+    """Rebuild the index as another index type from the embedding store and report its recall against exact search.
+
+    Indexes written before the embedding store existed are rebuilt from their own vectors. Embeddings
+    added before they were normalized are normalized, so rebuilding also fixes their distance scale."""
+    reporter = reporter or Reporter()
+    store = open_embedding_store(readonly=True)
+    if store is not None and len(store):
+        model_name = store.model_name
+        ids = store.ids()
+        vectors = store.get(ids)
+        store.close()
+    else:
+        index, _ = init_or_load_faiss_index()
+        if index is None or not index.ntotal:
+            reporter.log("FAISS index not available.", 'error')
             return None
+        if index_type_of(index) == 'IVFPQ':
+            reporter.log("The current index is compressed with PQ, so the rebuilt index uses approximate vectors.", 'warning')
+        model_name = load_index_info()['model']
+        ids = index_ids(index)
+        vectors = reconstruct_ids(index, ids)
+
+    vectors = normalize_vectors(vectors, model_name)
+
+    reporter.log(f"Rebuilding the FAISS index as {index_type}...")
+    try:
+        new_index = build_index(index_type, vectors, ids, nlist=nlist, hnsw_m=hnsw_m, pq_m=pq_m)
+    except (ValueError, RuntimeError) as e:
+        reporter.log(f"Failed to build the {index_type} index: {e}", 'error')
+        return None
+    report = recall_report(new_index, vectors, ids, k=k)
+    save_faiss_index(new_index, model_name)
+
+    reporter.table(report, f"Rebuilt the FAISS index as {index_type} with {new_index.ntotal} vectors. Recall against exact search:")
+    return report
+
+def generate_db_duplicate(mode=DEFAULT_SEARCH_MODE, k=DEFAULT_SEARCH_K, radius=DEFAULT_SEARCH_RADIUS, block_size=DEFAULT_SEARCH_BLOCK_SIZE,
+                          nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH, reporter=None, resume_from=None):
+    """Search the whole index for duplicate pairs and store them as 'faiss' duplicates.
+
+    resume_from is the (done, total) progress of an interrupted search; it
+    continues after the done vectors if the index still holds total vectors.
+    Returns the number of vectors searched and pairs found, or None if the
+    search could not run or was stopped."""
+    reporter = reporter or Reporter()
+    index, id_map = init_or_load_faiss_index()
+    if index is None or not index.ntotal:
+        reporter.log("FAISS index not available.", 'error')
+        return None
+    set_search_params(index, nprobe, ef_search)
+    if index_needs_normalizing(load_index_info()):
+        reporter.log("The index holds embeddings added before they were normalized, so its distances don't match the "
+                     "thresholds. Rebuild the FAISS index first.", 'warning')
 
-        progress = (i + 1) / num_vectors
-        message_placeholder.text(f"Finding duplicates: processing vector {i+1} of {num_vectors}")
-        progress_bar.progress(progress)
-
-        query_vector = np.array([index.reconstruct(i)])
-        distances, indices = index.search(query_vector, 2)
-
-        for j in range(1, indices.shape[1]):
-            #if distances[0][j] < threshold:
-            idx1, idx2 = i, indices[0][j]
-            if idx1 != idx2:
-                sorted_pair = (min(idx1, idx2), max(idx1, idx2))
-                # Check if the indices in sorted_pair are within the bounds of metadata
-                if sorted_pair[0] < len(metadata) and sorted_pair[1] < len(metadata):
-                    save_duplicate_pair(metadata[sorted_pair[0]], metadata[sorted_pair[1]], distances[0][j])
-                else:
-                    st.error(f"Metadata index out of range: {sorted_pair}")
-                    # Optionally log more details or handle this case further
-
-    message_placeholder.text(f"Finished processing {num_vectors} vectors.")
-    progress_bar.empty()
+    num_vectors = index.ntotal
+    total_pairs = 0
+    start_time = time.time()
+    first = 0
+    if resume_from and resume_from[1] == num_vectors:
+        first = resume_from[0]
+        reporter.log(f"Resuming after {first} of {num_vectors} vectors.")
+
+    try:
+        for done, pairs in find_duplicate_pairs(index, id_map, mode, k, radius, block_size, first):
+            # Check if stop has been requested
+            if reporter.stop_requested():
+                reporter.log("Processing was stopped by the user.")
+                return None
+
+            save_duplicate_pairs(pairs)
+            total_pairs += len(pairs)
+
+            elapsed = time.time() - start_time
+            reporter.progress(done, num_vectors, f"Finding duplicates: processed {done} of {num_vectors} vectors ({(done - first) / elapsed if elapsed > 0 else 0:.0f} vectors/sec), {total_pairs} pairs found",
+                              pairs=total_pairs)
+    except RuntimeError as e:
+        # e.g. range search on an index type that doesn't implement it
+        reporter.log(f"Duplicate search failed: {e}", 'error')
+        return None
+
+    reporter.progress(num_vectors, num_vectors, f"Finished processing {num_vectors} vectors, {total_pairs} pairs found.", pairs=total_pairs)
+    return {'vectors': num_vectors, 'pairs': total_pairs}
+
+def show_duplicate_photos_faiss(assets, limit, min_threshold, max_threshold,immich_server_url,api_key, methods=None):
+    # Index the assets once so every pair is looked up in constant time
+    catalog = assets if isinstance(assets, AssetCatalog) else AssetCatalog(assets)
 
-def show_duplicate_photos_faiss(assets, limit, min_threshold, max_threshold,immich_server_url,api_key):
     # First check if the database is populated
     if not is_db_populated():
         st.write("The database does not contain any duplicate entries. Please generate/update the database.")
         return  # Exit the function early if the database is not populated
     
     # Load duplicates from database
-    duplicates = load_duplicate_pairs(min_threshold, max_threshold)
+    duplicates = load_duplicate_pairs(min_threshold, max_threshold, methods)
 
     if duplicates:
-        st.write(f"Found {len(duplicates)} duplicate pairs with FAISS code within threshold {min_threshold} < x < {max_threshold}:")
+        st.write(f"Found {len(duplicates)} duplicate pairs with {', '.join(methods or ['any method'])} within threshold {min_threshold} < x < {max_threshold}:")
         progress_bar = st.progress(0)
         num_duplicates_to_show = min(len(duplicates), limit)
 
@@ -233,10 +339,10 @@ def show_duplicate_photos_faiss(assets, limit, min_threshold, max_threshold,immi
 
                 image1 = getImage(asset_id_1, immich_server_url, 'Thumbnail (fast)', api_key)
                 image2 = getImage(asset_id_2, immich_server_url, 'Thumbnail (fast)', api_key)
-                asset1_info = getAssetInfo(asset_id_1, assets)
-                asset2_info = getAssetInfo(asset_id_2, assets)
+                asset1_info = catalog.info(asset_id_1)
+                asset2_info = catalog.info(asset_id_2)
 
-                if image1 is not None and image2 is not None:
+                if image1 is not None and image2 is not None and asset1_info and asset2_info:
                     # Convert PIL images to numpy arrays if necessary
                     image1 = np.array(image1)
                     image2 = np.array(image2)
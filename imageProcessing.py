@@ -1,22 +1,17 @@
-import streamlit as st
 import time
 from imagehash import phash
-from db import saveAssetInfoToDb, isAssetProcessed
-from immichApi import streamAsset
+from db import saveAssetInfoToDb, isAssetProcessed, getPhashes, save_duplicate_pairs
+from api import getImage
 import gc 
-from faissCalc import update_faiss_index
+from hammingIndex import phash_to_int, pack_hashes, find_hash_pairs, DEFAULT_MAX_DISTANCE, DEFAULT_BRUTE_FORCE_WORKERS
+from reporter import Reporter
+from metrics import timer
 
-def calculatepHashPhotos(assets, immich_server_url, api_key):
-    if 'message' not in st.session_state or st.button('Start Processing'):
-        st.session_state['message'] = ""
-    if 'progress' not in st.session_state:
-        st.session_state['progress'] = 0
-
-    
-    progress_bar = st.progress(st.session_state['progress'])
-    stop_button = st.button('Stop Processing')
-    message_placeholder = st.empty()
+def calculatepHashPhotos(assets, immich_server_url, api_key, reporter=None):
+    """Compute and store the pHash of every original photo that hasn't been hashed yet.
 
+    Returns the number of assets processed, skipped and failed."""
+    reporter = reporter or Reporter()
     total_assets = len(assets)
     processed_assets = 0
     skipped_assets = 0
@@ -24,32 +19,29 @@ def calculatepHashPhotos(assets, immich_server_url, api_key):
     total_time = 0
 
     for i, asset in enumerate(assets):
-        
-        if stop_button:
-            st.session_state['message'] += "Processing stopped by user.\n"
-            message_placeholder.text(st.session_state['message'])
+        if reporter.stop_requested():
+            reporter.log("Processing stopped by user.")
             break
 
         asset_id = asset.get('id')
         start_time = time.time()
 
         if not isAssetProcessed(asset_id):
-            image = streamAsset(asset_id, immich_server_url, "Original Photo (slow)", api_key)
+            image = getImage(asset_id, immich_server_url, "Original Photo (slow)", api_key)
             image_phash=''
             if image is not None:
-                image_phash = phash(image)
+                with timer('image_hash_duration_seconds', hashes='phash'):
+                    image_phash = phash(image)
                 saveAssetInfoToDb(asset_id, str(image_phash), asset)
                 processed_assets += 1
-                st.session_state['message'] += f"Processed and saved asset {asset_id}\n"
                 
                 # Explicitly delete the image object and free memory
                 del image
                 gc.collect()
             else:
-                st.session_state['message'] += f"Failed to fetch image for asset {asset_id}\n"
+                print(f"Failed to fetch image for asset {asset_id}")
                 error_assets += 1
         else:
-            st.session_state['message'] += f"Asset {asset_id} has already been processed. Skipping.\n"
             skipped_assets += 1
 
         end_time = time.time()
@@ -61,80 +53,43 @@ def calculatepHashPhotos(assets, immich_server_url, api_key):
         estimated_time_remaining = average_time_per_asset * (total_assets - processed_assets)
         estimated_time_remaining_min = int(estimated_time_remaining/60)
 
-        # Update the UI
-        progress_percentage = (i + 1) / total_assets
-        st.session_state['progress'] = progress_percentage
-        progress_bar.progress(progress_percentage)
-
-        st.session_state['message'] += f"Estimated time remaining: {estimated_time_remaining_min} minutes\n"
-        st.session_state['message'] += f"Asset {i + 1} / {total_assets} - (processed {processed_assets} - skipped {skipped_assets} - error {error_assets})\n"
-        message_placeholder.text(st.session_state['message'])  # Update the placeholder with the new message
-        st.session_state['message']=''
-
-    if processed_assets >= total_assets:
-        st.session_state['message'] += "Processing complete!"
-        message_placeholder.text(st.session_state['message'])
-        progress_bar.progress(1.0)
-
-def calculateFaissIndex(assets, immich_server_url, api_key):
-    # Initialize session state variables if they are not already set
-    if 'message' not in st.session_state:
-        st.session_state['message'] = ""
-    if 'progress' not in st.session_state:
-        st.session_state['progress'] = 0
-    if 'stop_index' not in st.session_state:
-        st.session_state['stop_index'] = False
-
-    # Set up the UI components
-    progress_bar = st.progress(st.session_state['progress'])
-    stop_button = st.button('Stop Index Processing')
-    message_placeholder = st.empty()
-
-    # Check if stop was requested and reset it if button is pressed
-    if stop_button:
-        st.session_state['stop_index'] = True
-        st.session_state['calculate_faiss'] = False
-
-    total_assets = len(assets)
-    processed_assets = 0
-    skipped_assets = 0
-    error_assets = 0
-    total_time = 0
-
-    for i, asset in enumerate(assets):
-        if st.session_state['stop_index']:
-            st.session_state['message'] = "Processing stopped by user."
-            message_placeholder.text(st.session_state['message'])
-            break  # Break the loop if stop is requested
-
-        asset_id = asset.get('id')
-        start_time = time.time()
-
-        status = update_faiss_index(immich_server_url,api_key, asset_id)
-        if status == 'processed':
-            processed_assets += 1
-        elif status == 'skipped':
-            skipped_assets += 1
-        elif status == 'error':
-            error_assets += 1
-
-        end_time = time.time()
-        processing_time = end_time - start_time
-        total_time += processing_time
-
-        # Update progress and messages
-        progress_percentage = (i + 1) / total_assets
-        st.session_state['progress'] = progress_percentage
-        progress_bar.progress(progress_percentage)
-        estimated_time_remaining = (total_time / (i + 1)) * (total_assets - (i + 1))
-        estimated_time_remaining_min = int(estimated_time_remaining / 60)
-
-        st.session_state['message'] = f"Processing asset {i + 1}/{total_assets} - (Processed: {processed_assets}, Skipped: {skipped_assets}, Errors: {error_assets}). Estimated time remaining: {estimated_time_remaining_min} minutes."
-        message_placeholder.text(st.session_state['message'])
-
-    # Reset stop flag at the end of processing
-    st.session_state['stop_index'] = False
-    if processed_assets >= total_assets:
-        st.session_state['message'] = "Processing complete!"
-        message_placeholder.text(st.session_state['message'])
-        progress_bar.progress(1.0)
+        reporter.progress(i + 1, total_assets,
+                          f"Asset {i + 1} / {total_assets} - (processed {processed_assets} - skipped {skipped_assets} - error {error_assets})\n"
+                          f"Estimated time remaining: {estimated_time_remaining_min} minutes",
+                          processed=processed_assets, skipped=skipped_assets, errors=error_assets, eta_seconds=int(estimated_time_remaining))
+
+    if processed_assets + skipped_assets >= total_assets:
+        reporter.log("Processing complete!")
+    return {'processed': processed_assets, 'skipped': skipped_assets, 'errors': error_assets}
+
+def generatePhashDuplicates(assets, max_distance=DEFAULT_MAX_DISTANCE, engine='multi-index', workers=DEFAULT_BRUTE_FORCE_WORKERS, reporter=None):
+    """Store every pair of assets whose pHashes differ in at most max_distance bits as 'phash' duplicates.
+
+    engine is 'multi-index' or the exact 'brute-force' comparison run on
+    `workers` processes. Returns the number of hashes compared and pairs
+    found, or None if there are not enough pHashes."""
+    reporter = reporter or Reporter()
+    asset_ids = []
+    hashes = []
+    for asset_id, image_phash in getPhashes():
+        value = phash_to_int(image_phash)
+        # Only assets still in the library take part
+        if value is not None and asset_id in assets:
+            asset_ids.append(asset_id)
+            hashes.append(value)
+    if len(asset_ids) < 2:
+        reporter.log("Not enough pHashes available. Please calculate the pHashes first.", 'error')
+        return None
+
+    start_time = time.time()
+    total_pairs = 0
+
+    def report_progress(done, total):
+        reporter.progress(done, total, f"Finding pHash duplicates ({engine}): step {done}/{total}, {total_pairs} pairs found", pairs=total_pairs)
+
+    for pairs in find_hash_pairs(asset_ids, pack_hashes(hashes), max_distance, report_progress, engine, workers):
+        save_duplicate_pairs(pairs, method='phash')
+        total_pairs += len(pairs)
+
+    reporter.log(f"Compared {len(asset_ids)} pHashes in {time.time() - start_time:.1f}s, {total_pairs} pairs within {max_distance} bits found.")
+    return {'hashes': len(asset_ids), 'pairs': total_pairs}
@@ -0,0 +1,180 @@
+import time
+import numpy as np
+import faiss
+
+# Index types that can be built from stored vectors
+INDEX_TYPES = ['Flat', 'IVFFlat', 'HNSW', 'IVFPQ']
+
+DEFAULT_INDEX_TYPE = 'Flat'
+DEFAULT_NLIST = 0        # IVF cells, 0 picks ~4*sqrt(N)
+DEFAULT_HNSW_M = 32      # HNSW graph neighbours per node
+DEFAULT_PQ_M = 0         # PQ sub-quantizers, 0 picks dimension/8
+DEFAULT_NPROBE = 16      # IVF cells visited per query
+DEFAULT_EF_SEARCH = 64   # HNSW candidate list size per query
+DEFAULT_RECALL_SAMPLE = 1000
+
+def default_nlist(num_vectors):
+    return int(min(max(4 * np.sqrt(max(num_vectors, 1)), 1), 65536))
+
+def default_pq_m(dimension):
+    """Largest number of sub-quantizers giving sub-vectors of at least 8 dimensions."""
+    for m in range(max(dimension // 8, 1), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def index_description(index_type, dimension, num_vectors, nlist=DEFAULT_NLIST, hnsw_m=DEFAULT_HNSW_M, pq_m=DEFAULT_PQ_M):
+    """Return the faiss.index_factory string for an index type."""
+    nlist = nlist or default_nlist(num_vectors)
+    if index_type == 'Flat':
+        return 'Flat'
+    if index_type == 'IVFFlat':
+        return f"IVF{nlist},Flat"
+    if index_type == 'HNSW':
+        return f"HNSW{hnsw_m}"
+    if index_type == 'IVFPQ':
+        return f"IVF{nlist},PQ{pq_m or default_pq_m(dimension)}"
+    raise ValueError(f"Unknown index type '{index_type}'. Available index types: {', '.join(INDEX_TYPES)}")
+
+def index_type_of(index):
+    """Return the INDEX_TYPES name of a loaded index."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'IVFPQ'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'IVFFlat'
+    if isinstance(index, faiss.IndexHNSW):
+        return 'HNSW'
+    return 'Flat'
+
+def build_index(index_type, vectors, ids=None, nlist=DEFAULT_NLIST, hnsw_m=DEFAULT_HNSW_M, pq_m=DEFAULT_PQ_M, train_size=None, seed=1234):
+    """Build an index of the given type, train it on a random sample of vectors and add all vectors under their ids.
+
+    IVF indexes store the ids themselves; Flat and HNSW indexes are wrapped in
+    an IndexIDMap2. Without ids the vectors are numbered from 0."""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    num_vectors, dimension = vectors.shape
+    ids = np.arange(num_vectors, dtype='int64') if ids is None else np.ascontiguousarray(ids, dtype='int64')
+    description = index_description(index_type, dimension, num_vectors, nlist, hnsw_m, pq_m)
+    index = faiss.index_factory(dimension, description, faiss.METRIC_L2)
+    if not index.is_trained:
+        nlist = faiss.extract_index_ivf(index).nlist
+        if num_vectors < nlist:
+            raise ValueError(f"{description} needs at least {nlist} vectors to train, the index has {num_vectors}.")
+        train_size = train_size or min(num_vectors, max(64 * nlist, 10000))
+        sample = np.random.default_rng(seed).choice(num_vectors, size=min(train_size, num_vectors), replace=False)
+        index.train(vectors[np.sort(sample)])
+    if not _is_ivf(index):
+        index = faiss.IndexIDMap2(index)
+    enable_reconstruct(index)
+    index.add_with_ids(vectors, ids)
+    return index
+
+def new_index(dimension):
+    """Return an empty exact index that stores vectors under their ids."""
+    return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+def _is_ivf(index):
+    try:
+        faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return False
+    return True
+
+def enable_reconstruct(index):
+    """Make reconstruct() by id work on IVF indexes, which need a hashtable direct map for it."""
+    if not _is_ivf(index):
+        return
+    ivf = faiss.extract_index_ivf(index)
+    if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+def index_ids(index):
+    """Return the ids of all vectors in the index, in storage order."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map).astype('int64', copy=False)
+    ivf = faiss.extract_index_ivf(index)
+    invlists = ivf.invlists
+    lists = [faiss.rev_swig_ptr(invlists.get_ids(cell), invlists.list_size(cell)).copy()
+             for cell in range(ivf.nlist) if invlists.list_size(cell)]
+    return np.concatenate(lists).astype('int64', copy=False) if lists else np.empty(0, dtype='int64')
+
+def reconstruct_ids(index, ids):
+    """Return the stored vectors of the given ids as a float32 array."""
+    ids = np.ascontiguousarray(ids, dtype='int64')
+    if not len(ids):
+        return np.empty((0, index.d), dtype='float32')
+    return index.reconstruct_batch(ids)
+
+def remove_ids(index, ids):
+    """Remove vectors by id and return the index holding the rest.
+
+    HNSW graphs can't remove nodes, so an HNSW index is rebuilt from the
+    remaining vectors and the returned index is a new object."""
+    ids = np.ascontiguousarray(ids, dtype='int64')
+    if not len(ids):
+        return index
+    if index_type_of(index) != 'HNSW':
+        index.remove_ids(ids)
+        return index
+    hnsw_m = faiss.downcast_index(faiss.downcast_index(index).index).hnsw.nb_neighbors(1)
+    remaining = np.setdiff1d(index_ids(index), ids)
+    if not len(remaining):
+        return faiss.IndexIDMap2(faiss.index_factory(index.d, f"HNSW{hnsw_m}", faiss.METRIC_L2))
+    return build_index('HNSW', reconstruct_ids(index, remaining), remaining, hnsw_m=hnsw_m)
+
+def set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """Apply the query-time tunables of IVF (nprobe) and HNSW (efSearch) indexes."""
+    try:
+        faiss.extract_index_ivf(index).nprobe = int(nprobe)
+    except RuntimeError:
+        pass
+    inner = faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexIDMap):
+        inner = faiss.downcast_index(inner.index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = int(ef_search)
+
+def recall_report(index, vectors, ids=None, k=5, sample_size=DEFAULT_RECALL_SAMPLE, nprobe_values=(1, 4, 16, 64), ef_search_values=(16, 64, 256), seed=1234):
+    """Measure recall@k of an approximate index against exact brute-force search.
+
+    Queries are a random sample of the indexed vectors, whose ids in the index
+    are given by ids (positions if None). Returns one row per search setting
+    with the recall and query throughput, so a setting that keeps duplicate
+    recall acceptable can be picked."""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    ids = np.arange(len(vectors), dtype='int64') if ids is None else np.asarray(ids, dtype='int64')
+    sample = np.random.default_rng(seed).choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)
+    queries = vectors[sample]
+    _, exact = faiss.knn(queries, vectors, k + 1)
+
+    index_type = index_type_of(index)
+    if index_type in ('IVFFlat', 'IVFPQ'):
+        settings = [{'nprobe': value} for value in nprobe_values]
+    elif index_type == 'HNSW':
+        settings = [{'efSearch': value} for value in ef_search_values]
+    else:
+        settings = [{}]
+
+    # True neighbours of every query, without the query itself
+    expected = [{int(ids[position]) for position in exact_row[:k + 1] if position >= 0} - {int(ids[query])}
+                for query, exact_row in zip(sample, exact)]
+    total = sum(len(neighbours) for neighbours in expected)
+
+    report = []
+    for setting in settings:
+        set_search_params(index, setting.get('nprobe', DEFAULT_NPROBE), setting.get('efSearch', DEFAULT_EF_SEARCH))
+        start_time = time.time()
+        _, found = index.search(queries, k + 1)
+        elapsed = time.time() - start_time
+        hits = sum(len(neighbours & set(found_row.tolist())) for neighbours, found_row in zip(expected, found))
+        report.append({
+            'index_type': index_type,
+            **setting,
+            f'recall@{k}': hits / total if total else 1.0,
+            'queries_per_sec': len(sample) / elapsed if elapsed > 0 else 0.0,
+        })
+    return report
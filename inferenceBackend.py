@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import streamlit as st
+
+from backbones import get_model, DEFAULT_BACKBONE
+
+# Inference backends for the embedding model. 'torch' runs the eager model;
+# 'torchscript' and 'onnxruntime' export it once to EXPORT_DIR and run the
+# exported graph. Only ONNX Runtime quantizes the convolutions to int8: torch's
+# dynamic quantization covers Linear layers, and the backbones' heads are Identity.
+BACKENDS = ['torch', 'torchscript', 'onnxruntime']
+QUANTIZED_BACKENDS = ['onnxruntime']
+
+DEFAULT_BACKEND = os.environ.get('INFERENCE_BACKEND', 'torch')
+DEFAULT_QUANTIZE = os.environ.get('INFERENCE_INT8', '0').lower() in ('1', 'true', 'yes')
+EXPORT_DIR = os.environ.get('MODEL_EXPORT_DIR', 'exported_models')
+
+# Input shape used when tracing/exporting; the batch dimension stays dynamic
+_EXAMPLE_SHAPE = (1, 3, 224, 224)
+
+class TorchBackend:
+    """Run the eager PyTorch model."""
+
+    def __init__(self, model_name):
+        self.model = get_model(model_name)
+
+    def __call__(self, batch):
+        import torch
+        with torch.inference_mode():
+            return self.model(batch).numpy().astype('float32', copy=False)
+
+class TorchScriptBackend(TorchBackend):
+    """Run a frozen TorchScript export of the model, saved once to EXPORT_DIR."""
+
+    def __init__(self, model_name):
+        import torch
+        path = _export_path(model_name, False, 'pt')
+        if not os.path.exists(path):
+            super().__init__(model_name)
+            with torch.inference_mode():
+                scripted = torch.jit.trace(self.model, torch.zeros(_EXAMPLE_SHAPE))
+            scripted = torch.jit.freeze(scripted)
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            torch.jit.save(scripted, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        self.model = torch.jit.optimize_for_inference(torch.jit.load(path))
+
+class OnnxRuntimeBackend:
+    """Run an ONNX export of the model with ONNX Runtime's CPU execution provider."""
+
+    def __init__(self, model_name, quantize=False, num_threads=0):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("The 'onnxruntime' backend requires the optional 'onnxruntime' package.")
+        path = _export_path(model_name, False, 'onnx')
+        if not os.path.exists(path):
+            _export_onnx(model_name, path)
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            int8_path = _export_path(model_name, True, 'onnx')
+            if not os.path.exists(int8_path):
+                quantize_dynamic(path, f"{int8_path}.tmp", weight_type=QuantType.QUInt8)
+                os.replace(f"{int8_path}.tmp", int8_path)
+            path = int8_path
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads and num_threads > 0:
+            options.intra_op_num_threads = int(num_threads)
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        features = self.session.run(None, {self.input_name: batch.numpy()})[0]
+        return features.astype('float32', copy=False)
+
+def _export_path(model_name, quantize, extension):
+    suffix = '.int8' if quantize else ''
+    return os.path.join(EXPORT_DIR, f"{model_name}{suffix}.{extension}")
+
+def _export_onnx(model_name, path):
+    import torch
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    torch.onnx.export(
+        get_model(model_name), torch.zeros(_EXAMPLE_SHAPE), f"{path}.tmp",
+        input_names=['input'], output_names=['features'],
+        dynamic_axes={'input': {0: 'batch'}, 'features': {0: 'batch'}},
+        opset_version=17,
+    )
+    os.replace(f"{path}.tmp", path)
+
+@st.cache_resource(show_spinner="Preparing inference backend...")
+def get_backend(model_name=DEFAULT_BACKBONE, backend=DEFAULT_BACKEND, quantize=DEFAULT_QUANTIZE, num_threads=0):
+    """Return the process-wide inference backend: a callable mapping a (N, 3, 224, 224) tensor to an (N, D) float32 array.
+
+    Raises ValueError for int8 with a backend not in QUANTIZED_BACKENDS."""
+    if quantize and backend in BACKENDS and backend not in QUANTIZED_BACKENDS:
+        raise ValueError(f"int8 quantization is only supported by the {', '.join(QUANTIZED_BACKENDS)} backend, not '{backend}'.")
+    if backend == 'torch':
+        return TorchBackend(model_name)
+    if backend == 'torchscript':
+        return TorchScriptBackend(model_name)
+    if backend == 'onnxruntime':
+        return OnnxRuntimeBackend(model_name, quantize, num_threads)
+    raise ValueError(f"Unknown inference backend '{backend}'. Available backends: {', '.join(BACKENDS)}")
+
+def cosine_agreement(reference, candidate):
+    """Row-wise cosine similarity between two (N, D) embedding arrays."""
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    candidate = candidate / np.maximum(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12)
+    return np.sum(reference * candidate, axis=1)
+
+def check_backend_agreement(batch, model_name=DEFAULT_BACKBONE, backend=DEFAULT_BACKEND, quantize=DEFAULT_QUANTIZE, num_threads=0):
+    """Compare a backend's embeddings of a sample batch against the fp32 eager model.
+
+    Returns the mean and minimum cosine similarity over the sample."""
+    reference = get_backend(model_name, 'torch', False, num_threads)(batch)
+    candidate = get_backend(model_name, backend, quantize, num_threads)(batch)
+    similarity = cosine_agreement(reference, candidate)
+    return {'samples': len(similarity), 'mean_cosine': float(similarity.mean()), 'min_cosine': float(similarity.min())}
@@ -0,0 +1,285 @@
+import os
+import threading
+import time
+import traceback
+from collections import deque
+
+from reporter import Reporter
+from assetCatalog import AssetCatalog
+from assetSync import syncAssetCatalog, isCatalogSynced
+from shardIndex import SHARDS_DIR, parse_shard, merge_shards, run_shard_workers
+from db import createJob, saveJobCheckpoint, loadJob, loadJobs, markInterruptedJobs, loadCatalogAssets
+
+CHECKPOINT_INTERVAL = 5   # seconds between checkpoints saved while a job runs
+MAX_LOG_LINES = 100       # most recent log lines kept per job
+
+ACTIVE_STATUSES = ('running', 'stopping')
+RESUMABLE_STATUSES = ('stopped', 'failed', 'interrupted')
+# Parameters never written to jobs.db; they are passed again to resume a job
+SECRET_PARAMS = ('api_key',)
+
+def _catalog(params, reporter):
+    """The synced image assets, syncing first if the catalog was never synced."""
+    if not isCatalogSynced():
+        reporter.log("The asset catalog was never synced, syncing it first.")
+        _sync(params, reporter)
+    return AssetCatalog(loadCatalogAssets('IMAGE'))
+
+def _sync(params, reporter):
+    return syncAssetCatalog(params['server'], params['api_key'], full=params.get('full', False),
+                            progress_callback=lambda count: reporter.progress(count, None, f"Synced {count} assets...", fetched=count))
+
+def _index_options(params):
+    return dict(flush_interval=params['flush_interval'], flush_batches=params['flush_batches'], batch_size=params['batch_size'],
+                num_threads=params['threads'], fetch_workers=params['fetch_workers'], decode_workers=params['decode_workers'],
+                model_name=params['model'], backend=params['backend'], quantize=params['int8'], embedding_dtype=params['embedding_dtype'])
+
+# Job runners: run(params, reporter, checkpoint) returns a summary dict, or None if the job failed.
+# checkpoint is the last saved state of the job being resumed, if any. Engines that skip the work
+# already done (indexed assets, hashed photos) resume without it.
+def run_sync(params, reporter, checkpoint=None):
+    return _sync(params, reporter)
+
+def _worker_args(params, num_processes):
+    """Arguments of `python -m cli index` repeating the index options of params for a shard worker."""
+    # Workers share the CPUs unless a thread count was given
+    threads = params['threads'] or max(1, (os.cpu_count() or 1) // num_processes)
+    args = ['--model', params['model'], '--backend', params['backend'], '--batch-size', str(params['batch_size']),
+            '--threads', str(threads), '--fetch-workers', str(params['fetch_workers']), '--decode-workers', str(params['decode_workers']),
+            '--embedding-dtype', params['embedding_dtype'], '--shards-dir', params.get('shards_dir') or SHARDS_DIR]
+    return args + ['--int8'] if params['int8'] else args
+
+def _run_sharded_index(params, reporter):
+    """Index with one worker process per shard, then merge the shards into the index."""
+    from exactDuplicates import saveExactDuplicates
+    num_processes = params['processes']
+    catalog = _catalog(params, reporter)
+    # The workers only skip the copies; the pairs are saved once, here
+    saveExactDuplicates(catalog, replace=False)
+    reporter.log(f"Indexing {len(catalog)} assets with {num_processes} processes.")
+    exit_codes, summaries = run_shard_workers(num_processes, params['server'], params['api_key'], _worker_args(params, num_processes),
+                                              reporter=reporter)
+    if reporter.stop_requested():
+        reporter.log("Processing stopped by user. Finished parts are kept; resume to index the rest.")
+        return None
+    failed = [shard for shard, code in exit_codes.items() if code not in (0, 3)]
+    if failed:
+        reporter.log(f"Shard workers {', '.join(map(str, failed))} failed; the shards were not merged. Resume to retry them.", 'error')
+        return None
+    summary = {key: sum(shard_summary.get(key, 0) for shard_summary in summaries.values())
+               for key in ('processed', 'skipped', 'cached', 'copies', 'errors')}
+    merged = merge_shards(params.get('shards_dir') or SHARDS_DIR, flush_interval=params['flush_interval'], flush_batches=params['flush_batches'],
+                          embedding_dtype=params['embedding_dtype'], remove=True, reporter=reporter)
+    if merged is None:
+        return None
+    return {**summary, 'merged': merged['added']}
+
+def run_index(params, reporter, checkpoint=None):
+    if params.get('processes', 1) > 1 and not params.get('shard'):
+        return _run_sharded_index(params, reporter)
+    # Imported here so torch is only loaded by the jobs that embed images
+    from imageDuplicate import calculateFaissIndex
+    shard = parse_shard(params['shard']) if params.get('shard') else None
+    return calculateFaissIndex(_catalog(params, reporter), params['server'], params['api_key'], reporter=reporter,
+                               shard=shard, shards_dir=params.get('shards_dir') or SHARDS_DIR, **_index_options(params))
+
+def run_merge(params, reporter, checkpoint=None):
+    return merge_shards(params.get('shards_dir') or SHARDS_DIR, flush_interval=params['flush_interval'], flush_batches=params['flush_batches'],
+                        embedding_dtype=params['embedding_dtype'], remove=params.get('remove', False), reporter=reporter)
+
+def run_pairs(params, reporter, checkpoint=None):
+    from imageDuplicate import generate_db_duplicate
+    return generate_db_duplicate(mode=params['mode'], k=params['k'], radius=params['radius'], nprobe=params['nprobe'],
+                                 ef_search=params['ef_search'], reporter=reporter,
+                                 resume_from=(checkpoint['done'], checkpoint['total']) if checkpoint else None)
+
+def run_rebuild(params, reporter, checkpoint=None):
+    from imageDuplicate import rebuildFaissIndex
+    report = rebuildFaissIndex(params['index_type'], nlist=params['nlist'], hnsw_m=params['hnsw_m'], pq_m=params['pq_m'], k=params['k'],
+                               reporter=reporter)
+    return None if report is None else {'index_type': params['index_type']}
+
+def run_exact(params, reporter, checkpoint=None):
+    from exactDuplicates import saveExactDuplicates
+    groups = saveExactDuplicates(_catalog(params, reporter))
+    return {'groups': len(groups), 'assets': sum(len(group) for group in groups)}
+
+def run_phash(params, reporter, checkpoint=None):
+    from imageProcessing import calculatepHashPhotos
+    return calculatepHashPhotos(_catalog(params, reporter), params['server'], params['api_key'], reporter=reporter)
+
+def run_phash_pairs(params, reporter, checkpoint=None):
+    from imageProcessing import generatePhashDuplicates
+    return generatePhashDuplicates(_catalog(params, reporter), params['max_distance'], params['engine'], params['workers'], reporter=reporter)
+
+def run_cascade(params, reporter, checkpoint=None):
+    from cascade import runDuplicateCascade
+    options = _index_options(params)
+    report = runDuplicateCascade(_catalog(params, reporter), params['server'], params['api_key'], max_hash_distance=params['hash_distance'],
+                                 time_window=params['time_window'], max_distance=params['max_distance'],
+                                 fetch_workers=options.pop('fetch_workers'), reporter=reporter, **options)
+    return None if report is None else {'stages': len(report)}
+
+JOB_RUNNERS = {
+    'sync': run_sync,
+    'index': run_index,
+    'merge': run_merge,
+    'pairs': run_pairs,
+    'rebuild': run_rebuild,
+    'exact': run_exact,
+    'phash': run_phash,
+    'phash-pairs': run_phash_pairs,
+    'cascade': run_cascade,
+}
+
+class Job(Reporter):
+    """A job running on a background thread; it is also the reporter of the engine it runs.
+
+    Progress, log lines and tables are kept in memory for the app to poll.
+    The progress is saved to jobs.db at most every CHECKPOINT_INTERVAL
+    seconds and when the job ends.
+    """
+
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.status = 'running'
+        self.done = 0
+        self.total = None
+        self.counts = {}
+        self.message = None
+        self.error = None
+        self.result = None
+        self.logs = deque(maxlen=MAX_LOG_LINES)
+        self.tables = []
+        self.started_at = self.updated_at = time.time()
+        self.finished_at = None
+        self.thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._last_checkpoint = self.started_at
+
+    def progress(self, done, total, message=None, **counts):
+        with self._lock:
+            self.done, self.total = done, total
+            self.counts.update(counts)
+            if message:
+                self.message = message
+            self.updated_at = time.time()
+        if self.updated_at - self._last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def log(self, text, level='info'):
+        with self._lock:
+            self.logs.append((level, text))
+
+    def table(self, rows, title=None):
+        with self._lock:
+            self.tables.append((title, rows))
+
+    def stop_requested(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        with self._lock:
+            if self.status == 'running':
+                self.status = 'stopping'
+        self._stop.set()
+
+    def checkpoint(self):
+        with self._lock:
+            state = (self.status, self.done, self.total, dict(self.counts), self.message, self.error, self.updated_at, self.finished_at)
+            self._last_checkpoint = time.time()
+        saveJobCheckpoint(self.id, *state)
+
+    def snapshot(self):
+        """The state of the job as a dict shaped like the rows of loadJobs, plus its logs, tables and result."""
+        with self._lock:
+            return {'id': self.id, 'kind': self.kind, 'params': {key: value for key, value in self.params.items() if key not in SECRET_PARAMS},
+                    'status': self.status, 'done': self.done, 'total': self.total, 'counts': dict(self.counts),
+                    'message': self.message, 'error': self.error, 'started_at': self.started_at, 'updated_at': self.updated_at,
+                    'finished_at': self.finished_at, 'result': self.result, 'logs': list(self.logs), 'tables': list(self.tables)}
+
+    def run(self, runner, checkpoint=None):
+        result, error = None, None
+        try:
+            result = runner(self.params, self, checkpoint)
+        except Exception as e:
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+            self.log(error, 'error')
+        with self._lock:
+            if self._stop.is_set():
+                self.status = 'stopped'
+            else:
+                self.status = 'done' if result is not None else 'failed'
+            self.result, self.error = result, error
+            self.finished_at = self.updated_at = time.time()
+        self.checkpoint()
+
+class JobManager:
+    """Runs one job at a time on a daemon thread of the server process.
+
+    Jobs belong to the process rather than to a browser session, so they keep
+    running across Streamlit reruns, closed tabs and reconnects, and any
+    session can poll or stop them. Jobs recorded as running when the manager
+    starts belonged to a process that died; they are marked 'interrupted' and
+    can be resumed from their last checkpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        markInterruptedJobs()
+
+    def active_job(self):
+        """The job still running in this process, or None."""
+        for job in self._jobs.values():
+            if job.thread is not None and job.thread.is_alive():
+                return job
+        return None
+
+    def start(self, kind, params, checkpoint=None, resumed_from=None):
+        """Start a job of a kind of JOB_RUNNERS. Raises RuntimeError if a job is already running."""
+        if kind not in JOB_RUNNERS:
+            raise ValueError(f"Unknown job '{kind}'. Available jobs: {', '.join(JOB_RUNNERS)}")
+        with self._lock:
+            active = self.active_job()
+            if active is not None:
+                raise RuntimeError(f"Job {active.id} ({active.kind}) is still running. Stop it or wait for it to finish.")
+            stored_params = {key: value for key, value in params.items() if key not in SECRET_PARAMS}
+            job = Job(createJob(kind, stored_params, time.time(), resumed_from), kind, params)
+            job.thread = threading.Thread(target=job.run, args=(JOB_RUNNERS[kind], checkpoint), name=f"job-{job.id}-{kind}", daemon=True)
+            self._jobs[job.id] = job
+            job.thread.start()
+            return job
+
+    def resume(self, job_id, **params):
+        """Start a stopped, failed or interrupted job again from its checkpoint.
+
+        params are added to the saved parameters, e.g. the api_key that isn't saved."""
+        saved = loadJob(job_id)
+        if saved is None or saved['status'] not in RESUMABLE_STATUSES:
+            raise ValueError(f"Job {job_id} can't be resumed.")
+        return self.start(saved['kind'], {**saved['params'], **params}, checkpoint=saved, resumed_from=job_id)
+
+    def stop(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.stop()
+
+    def jobs(self, limit=10):
+        """The most recent jobs, newest first; jobs of this process are reported from memory."""
+        return [self._jobs[saved['id']].snapshot() if saved['id'] in self._jobs else saved for saved in loadJobs(limit)]
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Return the process-wide JobManager, creating it on first use."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,189 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_FILE = os.environ.get('METRICS_FILE')   # where the CLI writes the metrics, for node_exporter's textfile collector
+DEFAULT_WRITE_INTERVAL = 15                      # seconds between writes of the metrics file
+
+# Upper bounds (s) of the latency buckets: from a cached lookup to a slow original download
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name: (type, help) of every metric; stages record into these names only
+METRICS = {
+    'immich_http_requests_total': ('counter', "Requests to the Immich server by method, path and status."),
+    'immich_http_request_duration_seconds': ('histogram', "Time to receive the response of a request to the Immich server."),
+    'immich_http_response_bytes_total': ('counter', "Bytes downloaded from the Immich server."),
+    'image_decode_duration_seconds': ('histogram', "Time to decode downloaded image bytes."),
+    'image_decode_failures_total': ('counter', "Downloads that couldn't be decoded as an image."),
+    'image_transform_duration_seconds': ('histogram', "Time to resize and normalize one decoded image for the model."),
+    'image_hash_duration_seconds': ('histogram', "Time to compute the perceptual hashes of one image."),
+    'inference_duration_seconds': ('histogram', "Time to embed one batch of images."),
+    'inference_images_total': ('counter', "Images embedded by the model."),
+    'index_add_duration_seconds': ('histogram', "Time to add one batch of vectors to the embedding store and the index."),
+    'index_vectors_added_total': ('counter', "Vectors added to the index."),
+    'index_flush_duration_seconds': ('histogram', "Time to write the index and the embedding store to disk."),
+    'db_transaction_duration_seconds': ('histogram', "Time of one SQLite transaction, by database file."),
+    'pair_search_duration_seconds': ('histogram', "Time to search one block of vectors or hashes for duplicate pairs."),
+    'pairs_found_total': ('counter', "Duplicate pairs found, by engine."),
+}
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """Counters and latency histograms of the pipeline stages, shared by every thread of the process.
+
+    Values are kept per metric name and label set, and rendered in the
+    Prometheus text exposition format. Recording takes a lock, so stages can
+    record from their worker threads; the overhead is a dictionary lookup
+    and, for histograms, a bisect over LATENCY_BUCKETS.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> value
+        self._histograms = {}   # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in a histogram."""
+        key = (name, _label_key(labels))
+        position = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            values[position] += 1
+            values[-1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the duration of the block in a histogram, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            series = counters if kind == 'counter' else histograms
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == 'counter':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(series[key])}")
+                    continue
+                values = series[key]
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write render() to path, replacing the file in one step so a scraper never reads half of it."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """One row per series for display: counters with their value, histograms with count, mean and p50/p95/p99."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        rows = []
+        for (name, labels), value in sorted(counters.items()):
+            rows.append({'metric': name, 'labels': _format_labels(labels), 'count': value, 'mean (ms)': None,
+                         'p50 (ms)': None, 'p95 (ms)': None, 'p99 (ms)': None, 'total (s)': None})
+        for (name, labels), values in sorted(histograms.items()):
+            count = sum(values[:-1])
+            rows.append({'metric': name, 'labels': _format_labels(labels), 'count': count,
+                         'mean (ms)': round(1000 * values[-1] / count, 2) if count else None,
+                         'p50 (ms)': self._quantile_ms(values, 0.5), 'p95 (ms)': self._quantile_ms(values, 0.95),
+                         'p99 (ms)': self._quantile_ms(values, 0.99), 'total (s)': round(values[-1], 3)})
+        return rows
+
+    def _quantile_ms(self, values, quantile):
+        """Upper bound of the bucket holding the quantile, like Prometheus' histogram_quantile without interpolation."""
+        count = sum(values[:-1])
+        if not count:
+            return None
+        target = quantile * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, values):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return round(1000 * bound, 2)
+        return float('inf')
+
+registry = MetricsRegistry()
+
+# Shortcuts to the process-wide registry used by the stages
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+class MetricsFileWriter:
+    """Writes the registry to a file every `interval` seconds on a daemon thread, and once more on stop()."""
+
+    def __init__(self, path, interval=DEFAULT_WRITE_INTERVAL, metrics=registry):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.metrics.write(self.path)
@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+
+# Defaults for the staged indexing pipeline
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_DECODE_WORKERS = 4
+
+# Marker passed down the queues when a stage has no more items
+_DONE = object()
+
+
+class StageStats:
+    """Count items and busy time of one pipeline stage to report its throughput."""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, items, busy_time, errors=0):
+        with self._lock:
+            self.items += items
+            self.errors += errors
+            self.busy_time += busy_time
+
+    def throughput(self):
+        """Items per second of wall-clock time since the pipeline started."""
+        elapsed = time.time() - self.start_time
+        return self.items / elapsed if elapsed > 0 else 0.0
+
+    def utilization(self):
+        """Fraction of the stage's worker time spent doing work rather than waiting."""
+        elapsed = time.time() - self.start_time
+        return min(1.0, self.busy_time / (elapsed * self.workers)) if elapsed > 0 else 0.0
+
+    def summary(self):
+        return f"{self.name}: {self.throughput():.1f}/s (busy {self.utilization():.0%})"
+
+
+class EmbeddingPipeline:
+    """Run download, decode/transform and embedding as concurrent stages.
+
+    A pool of fetch threads downloads image bytes, a pool of decode threads
+    decodes and preprocesses them, and the calling thread embeds the results
+    in batches. Bounded queues between the stages provide backpressure so
+    that fast stages never run far ahead of slow ones.
+
+    fetch_func(asset_id) -> bytes or None
+    decode_func(asset_id, content) -> preprocessed item or None
+    embed_func(list of items) -> sequence of vectors
+    """
+
+    def __init__(self, fetch_func, decode_func, embed_func, batch_size,
+                 fetch_workers=DEFAULT_FETCH_WORKERS, decode_workers=DEFAULT_DECODE_WORKERS, queue_size=None):
+        self.fetch_func = fetch_func
+        self.decode_func = decode_func
+        self.embed_func = embed_func
+        self.batch_size = max(1, int(batch_size))
+        self.fetch_workers = max(1, int(fetch_workers))
+        self.decode_workers = max(1, int(decode_workers))
+        queue_size = queue_size or 2 * self.batch_size
+        self.id_queue = queue.Queue(maxsize=queue_size)
+        self.fetched_queue = queue.Queue(maxsize=queue_size)
+        self.decoded_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.stats = {
+            'fetch': StageStats('fetch', self.fetch_workers),
+            'decode': StageStats('decode', self.decode_workers),
+            'embed': StageStats('embed', 1),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def stop(self):
+        """Ask all stages to stop and wait for the worker threads to exit."""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def summary(self):
+        return ", ".join(stats.summary() for stats in self.stats.values())
+
+    def _put(self, q, item):
+        """Put an item on a bounded queue, giving up if the pipeline is stopped."""
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        """Get an item from a queue, returning _DONE if the pipeline is stopped."""
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _feed(self, asset_ids):
+        for asset_id in asset_ids:
+            if not self._put(self.id_queue, (asset_id, None)):
+                return
+        for _ in range(self.fetch_workers):
+            self._put(self.id_queue, _DONE)
+
+    def _run_stage(self, in_queue, out_queue, work, stats, remaining, downstream_workers, needs_payload):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                break
+            asset_id, payload = item
+            if needs_payload and payload is None:
+                # Failed upstream; pass it through so it's reported as an error
+                if not self._put(out_queue, (asset_id, None)):
+                    break
+                continue
+            start_time = time.time()
+            try:
+                result = work(asset_id, payload)
+            except Exception as e:
+                print(f"Pipeline {stats.name} failed for asset_id {asset_id}: {e}")
+                result = None
+            stats.record(1, time.time() - start_time, errors=int(result is None))
+            if not self._put(out_queue, (asset_id, result)):
+                break
+        # The last worker of a stage tells every worker of the next stage to finish
+        with remaining['lock']:
+            remaining['count'] -= 1
+            last = remaining['count'] == 0
+        if last:
+            for _ in range(downstream_workers):
+                self._put(out_queue, _DONE)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def run(self, asset_ids):
+        """Process asset_ids and yield (embedded_ids, vectors, failed_ids) for each batch."""
+        self._start(self._feed, list(asset_ids))
+        fetch_remaining = {'count': self.fetch_workers, 'lock': threading.Lock()}
+        for _ in range(self.fetch_workers):
+            self._start(self._run_stage, self.id_queue, self.fetched_queue, self._fetch,
+                        self.stats['fetch'], fetch_remaining, self.decode_workers, False)
+        decode_remaining = {'count': self.decode_workers, 'lock': threading.Lock()}
+        for _ in range(self.decode_workers):
+            self._start(self._run_stage, self.fetched_queue, self.decoded_queue, self._decode,
+                        self.stats['decode'], decode_remaining, 1, True)
+
+        ids, items, failed = [], [], []
+        while True:
+            item = self._get(self.decoded_queue)
+            finished = item is _DONE
+            if not finished:
+                asset_id, result = item
+                if result is None:
+                    failed.append(asset_id)
+                else:
+                    ids.append(asset_id)
+                    items.append(result)
+            if len(items) >= self.batch_size or (finished and (items or failed)):
+                vectors = self._embed(items) if items else []
+                yield ids, vectors, failed
+                ids, items, failed = [], [], []
+            if finished:
+                break
+
+    def _fetch(self, asset_id, _):
+        return self.fetch_func(asset_id)
+
+    def _decode(self, asset_id, content):
+        return self.decode_func(asset_id, content)
+
+    def _embed(self, items):
+        start_time = time.time()
+        vectors = self.embed_func(items)
+        self.stats['embed'].record(len(items), time.time() - start_time)
+        return vectors
@@ -0,0 +1,68 @@
+import json
+import sys
+import time
+
+class Reporter:
+    """Receives the progress of a long-running job.
+
+    Engines report through a Reporter instead of drawing Streamlit widgets, so
+    the same code runs as a background job of the app and headless from the
+    command line. This base class ignores everything and never asks to stop.
+    """
+
+    def progress(self, done, total, message=None, **counts):
+        """done of total units of work are finished (total may be None if unknown); counts are numbers worth logging."""
+
+    def log(self, text, level='info'):
+        """Report a line of text; level is 'info', 'warning' or 'error'."""
+
+    def table(self, rows, title=None):
+        """Report a list of dicts sharing the same keys."""
+
+    def stop_requested(self):
+        """True if the job should stop at the next convenient point."""
+        return False
+
+def _json_default(value):
+    # NumPy scalars and anything else json can't encode
+    return value.item() if hasattr(value, 'item') else str(value)
+
+class JsonLinesReporter(Reporter):
+    """Writes every event as one JSON object per line, for cron jobs and other programs.
+
+    Every line has the time, the job name and the event ('progress', 'log',
+    'table' or whatever emit() is given). Progress lines are written at most
+    every min_interval seconds, apart from the one completing the job. Stopping
+    is requested with request_stop(), e.g. from a signal handler.
+    """
+
+    def __init__(self, job, stream=None, min_interval=1.0):
+        self.job = job
+        self.stream = stream or sys.stdout
+        self.min_interval = min_interval
+        self.last_progress = None
+        self.stopped = False
+
+    def emit(self, event, **fields):
+        record = {'time': round(time.time(), 3), 'job': self.job, 'event': event, **fields}
+        self.stream.write(json.dumps(record, default=_json_default) + '\n')
+        self.stream.flush()
+
+    def progress(self, done, total, message=None, **counts):
+        now = time.monotonic()
+        if self.last_progress is not None and now - self.last_progress < self.min_interval and not (total and done >= total):
+            return
+        self.last_progress = now
+        self.emit('progress', done=done, total=total, message=message, **counts)
+
+    def log(self, text, level='info'):
+        self.emit('log', level=level, message=text)
+
+    def table(self, rows, title=None):
+        self.emit('table', title=title, rows=rows)
+
+    def request_stop(self):
+        self.stopped = True
+
+    def stop_requested(self):
+        return self.stopped
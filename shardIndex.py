@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import glob
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import subprocess
+
+import numpy as np
+
+from backbones import backbone_dimension
+from faissIndex import FaissIndexWriter, init_or_load_faiss_index, check_index_model, normalize_vectors, DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_BATCHES
+from indexFactory import index_ids, reconstruct_ids, index_type_of
+from embeddingStore import EMBEDDING_DTYPES, DEFAULT_EMBEDDING_DTYPE, open_embedding_store
+from db import loadVectorIdMap
+from reporter import Reporter
+
+# Directory holding one sub-directory per shard; workers on other machines must see the same directory
+SHARDS_DIR = os.environ.get('INDEX_SHARDS_DIR', 'shards')
+SHARD_MANIFEST = 'shard.json'
+DEFAULT_SHARD_PART_SIZE = 2048   # vectors per part file written by a shard worker
+MERGE_VERIFY_SAMPLE = 1000       # merged vectors compared with the index after a merge
+
+def shard_of(asset_id, num_shards):
+    """The shard of an asset: a hash of its id that is the same in every process and on every machine."""
+    digest = hashlib.blake2b(asset_id.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % num_shards
+
+def parse_shard(value):
+    """Parse 'I/N' into (I, N) with 0 <= I < N."""
+    try:
+        shard, num_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected I/N such as 0/4.")
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Invalid shard '{value}', I must be between 0 and N - 1.")
+    return shard, num_shards
+
+def shard_directory(shard, num_shards, root=SHARDS_DIR):
+    return os.path.join(root, f"shard-{shard:03d}-of-{num_shards:03d}")
+
+def indexed_asset_ids():
+    """Asset ids that already have a vector in the main index, read without writing anything."""
+    id_map = loadVectorIdMap(include_deleted=True)
+    store = open_embedding_store(readonly=True)
+    if store is not None:
+        vector_ids = store.ids().tolist()
+        store.close()
+    else:
+        # Indexes written before the embedding store existed
+        index, _ = init_or_load_faiss_index()
+        vector_ids = index_ids(index).tolist() if index is not None else []
+    return {id_map[vector_id] for vector_id in vector_ids if vector_id in id_map}
+
+def _read_part(path):
+    with np.load(path) as part:
+        return part['asset_ids'].tolist(), part['vectors']
+
+class ShardWriter:
+    """Writes the embeddings of one shard of the assets to its own directory, for merge_shards to add to the index.
+
+    A shard worker never writes the FAISS index, the embedding store or the
+    vector ids, so any number of workers can run at once, on this machine or
+    on others sharing the shards directory; each shard must have a single
+    worker. Vectors are written in part files of part_size vectors that are
+    renamed into place once complete, so a stopped or crashed worker keeps its
+    finished parts and skips their assets when it runs again. It has the
+    interface of FaissIndexWriter used by calculateFaissIndex.
+    """
+
+    def __init__(self, shard, num_shards, model_name, preprocessing_version, embedding_dtype=DEFAULT_EMBEDDING_DTYPE,
+                 root=SHARDS_DIR, part_size=DEFAULT_SHARD_PART_SIZE):
+        check_index_model(model_name)
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{embedding_dtype}'. Available dtypes: {', '.join(EMBEDDING_DTYPES)}")
+        self.directory = shard_directory(shard, num_shards, root)
+        self.dimension = backbone_dimension(model_name)
+        self.dtype = embedding_dtype
+        self.part_size = max(1, int(part_size))
+        manifest = {'model': model_name, 'dimension': self.dimension, 'preprocessing': int(preprocessing_version),
+                    'dtype': embedding_dtype, 'shard': shard, 'num_shards': num_shards}
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, SHARD_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                existing = json.load(f)
+            if {key: existing.get(key) for key in manifest} != manifest:
+                raise ValueError(f"{self.directory} holds vectors made with other settings ({existing}). Merge or delete it first.")
+        else:
+            with open(f"{manifest_path}.tmp", 'w') as f:
+                json.dump(manifest, f)
+            os.replace(f"{manifest_path}.tmp", manifest_path)
+
+        self.processed_ids = indexed_asset_ids()
+        for path in glob.glob(os.path.join(self.directory, 'part-*.npz')):
+            self.processed_ids.update(_read_part(path)[0])
+        self.pending_vectors = []
+        self.pending_ids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def is_processed(self, asset_id):
+        """Return True if the asset is in the main index, in a finished part of this shard, or waiting to be written."""
+        return asset_id in self.processed_ids
+
+    def add(self, asset_id, features):
+        if asset_id in self.processed_ids:
+            return
+        self.pending_vectors.append(np.asarray(features, dtype='float32').reshape(-1))
+        self.pending_ids.append(asset_id)
+        self.processed_ids.add(asset_id)
+        if len(self.pending_ids) >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered vectors as a new part file."""
+        if not self.pending_ids:
+            return
+        vectors = np.vstack(self.pending_vectors)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-dimensional features, got {vectors.shape[1]}.")
+        path = os.path.join(self.directory, f"part-{uuid.uuid4().hex}.npz")
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, asset_ids=np.array(self.pending_ids), vectors=vectors.astype(self.dtype))
+        os.replace(f"{path}.tmp", path)
+        self.pending_vectors = []
+        self.pending_ids = []
+
+    def close(self):
+        self.flush()
+
+def _load_shards(root):
+    """Return [(directory, manifest, part paths)] of the shards under root."""
+    shards = []
+    for manifest_path in sorted(glob.glob(os.path.join(root, '*', SHARD_MANIFEST))):
+        directory = os.path.dirname(manifest_path)
+        with open(manifest_path) as f:
+            shards.append((directory, json.load(f), sorted(glob.glob(os.path.join(directory, 'part-*.npz')))))
+    return shards
+
+def merge_shards(root=SHARDS_DIR, flush_interval=DEFAULT_FLUSH_INTERVAL, flush_batches=DEFAULT_FLUSH_BATCHES,
+                 embedding_dtype=DEFAULT_EMBEDDING_DTYPE, remove=False, reporter=None):
+    """Add the vectors written by shard workers to the main index, embedding store and vector ids.
+
+    Shards must agree on the model, dimension and preprocessing. Every asset is
+    added once: vectors of assets already indexed or seen in another part are
+    skipped, and rows with a wrong shape or non-finite values are rejected.
+    Afterwards the index and the store must hold the same vectors and a sample
+    of the merged vectors is read back from the index. Merging is idempotent;
+    with remove the shard directories are deleted once the merge is verified.
+    Returns counts of the merge, or None if the shards or the result are
+    inconsistent."""
+    reporter = reporter or Reporter()
+    shards = _load_shards(root)
+    if not shards:
+        reporter.log(f"No index shards found in {root}.", 'error')
+        return None
+    settings = {(manifest['model'], manifest['dimension'], manifest['preprocessing']) for _, manifest, _ in shards}
+    if len(settings) > 1:
+        reporter.log(f"The shards were embedded with different models or preprocessing: {sorted(settings)}.", 'error')
+        return None
+    model_name, dimension, _ = settings.pop()
+
+    num_parts = sum(len(parts) for _, _, parts in shards)
+    counts = {'shards': len(shards), 'parts': num_parts, 'vectors': 0, 'added': 0, 'already_indexed': 0,
+              'duplicates': 0, 'misplaced': 0, 'invalid': 0}
+    seen = set()
+    sample = {}
+    parts_done = 0
+    with FaissIndexWriter(model_name=model_name, flush_interval=flush_interval, flush_batches=flush_batches,
+                          embedding_dtype=embedding_dtype) as writer:
+        for directory, manifest, parts in shards:
+            for path in parts:
+                asset_ids, vectors = _read_part(path)
+                counts['vectors'] += len(asset_ids)
+                if vectors.ndim != 2 or vectors.shape != (len(asset_ids), dimension):
+                    reporter.log(f"{path} has vectors of shape {vectors.shape}, expected ({len(asset_ids)}, {dimension}); skipped.", 'warning')
+                    counts['invalid'] += len(asset_ids)
+                else:
+                    vectors = vectors.astype('float32')
+                    finite = np.isfinite(vectors).all(axis=1).tolist()
+                    for asset_id, vector, is_finite in zip(asset_ids, vectors, finite):
+                        if not is_finite:
+                            counts['invalid'] += 1
+                        elif asset_id in seen:
+                            counts['duplicates'] += 1
+                        elif writer.is_processed(asset_id):
+                            seen.add(asset_id)
+                            counts['already_indexed'] += 1
+                        else:
+                            seen.add(asset_id)
+                            # Still merged: the vector is valid, the worker was just started with other shard settings
+                            if shard_of(asset_id, manifest['num_shards']) != manifest['shard']:
+                                counts['misplaced'] += 1
+                            writer.add(asset_id, vector)
+                            counts['added'] += 1
+                            if len(sample) < MERGE_VERIFY_SAMPLE:
+                                # Compared with the index, which holds the vector as the writer added it
+                                sample[asset_id] = normalize_vectors(vector[None], model_name)[0]
+                parts_done += 1
+                reporter.progress(parts_done, num_parts, f"Merged {parts_done}/{num_parts} shard parts: {counts['added']} vectors added, "
+                                  f"{counts['already_indexed']} already indexed, {counts['duplicates']} duplicates, {counts['invalid']} invalid",
+                                  **counts)
+
+    if not _verify_merge(sample, reporter):
+        return None
+    if remove:
+        for directory, _, _ in shards:
+            shutil.rmtree(directory)
+    reporter.log(f"Merged {counts['added']} vectors from {len(shards)} shards into the index.")
+    return counts
+
+def _verify_merge(sample, reporter):
+    """Check that the index and the store agree and that the sampled merged vectors read back from the index."""
+    index, id_map = init_or_load_faiss_index(include_deleted=True)
+    store = open_embedding_store(readonly=True)
+    indexed = index_ids(index) if index is not None else np.empty(0, dtype='int64')
+    stored = store.ids() if store is not None else np.empty(0, dtype='int64')
+    if store is not None:
+        store.close()
+    problems = []
+    if len(np.setxor1d(indexed, stored)):
+        problems.append(f"the index holds {len(indexed)} vectors but the embedding store {len(stored)}")
+    asset_to_vector = {asset_id: vector_id for vector_id, asset_id in id_map.items()}
+    missing = [asset_id for asset_id in sample if asset_id not in asset_to_vector]
+    if missing:
+        problems.append(f"{len(missing)} merged assets have no vector id")
+    elif sample and index_type_of(index) != 'IVFPQ':
+        # PQ codes only approximate the vectors, so there is nothing exact to compare with
+        found = reconstruct_ids(index, [asset_to_vector[asset_id] for asset_id in sample])
+        if not np.allclose(found, np.stack(list(sample.values())), rtol=1e-3, atol=1e-3):
+            problems.append("merged vectors differ from the vectors read back from the index")
+    for problem in problems:
+        reporter.log(f"Merge verification failed: {problem}.", 'error')
+    return not problems
+
+def _forward_worker_output(shard, process, progress, reporter, results):
+    """Read the JSON lines of a shard worker, keeping its latest progress and forwarding its log lines."""
+    for line in process.stdout:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event.get('event') == 'progress':
+            progress[shard] = (event.get('done') or 0, event.get('total') or 0)
+        elif event.get('event') == 'log':
+            reporter.log(f"Shard {shard}: {event.get('message')}", event.get('level', 'info'))
+        elif event.get('event') == 'result':
+            results[shard] = event
+
+def run_shard_workers(num_shards, server, api_key, worker_args, reporter=None, poll_interval=1.0):
+    """Run `python -m cli index --shard I/N` for every shard in its own process and wait for all of them.
+
+    worker_args are more arguments of the index command. The API key is passed
+    in the environment rather than on the command line. Progress of the
+    workers is summed into reporter; stopping the reporter terminates the
+    workers, which stop at their next batch. Returns ({shard: exit code},
+    {shard: summary of the worker})."""
+    reporter = reporter or Reporter()
+    env = {**os.environ, 'IMMICH_API_KEY': api_key or ''}
+    # Every worker would overwrite the same metrics file
+    env.pop('METRICS_FILE', None)
+    processes = {}
+    for shard in range(num_shards):
+        processes[shard] = subprocess.Popen(
+            [sys.executable, '-m', 'cli', '--server', server, 'index', '--shard', f"{shard}/{num_shards}", *worker_args],
+            stdout=subprocess.PIPE, text=True, env=env, cwd=os.getcwd())
+    progress = {}
+    results = {}
+    readers = [threading.Thread(target=_forward_worker_output, args=(shard, process, progress, reporter, results), daemon=True)
+               for shard, process in processes.items()]
+    for reader in readers:
+        reader.start()
+
+    stopping = False
+    while any(process.poll() is None for process in processes.values()):
+        if reporter.stop_requested() and not stopping:
+            stopping = True
+            for process in processes.values():
+                process.terminate()
+        done = sum(value[0] for value in progress.values())
+        total = sum(value[1] for value in progress.values())
+        running = sum(process.poll() is None for process in processes.values())
+        reporter.progress(done, total or None, f"Indexing with {num_shards} processes ({running} running): {done}/{total} assets",
+                          processes=running)
+        time.sleep(poll_interval)
+    for reader in readers:
+        reader.join()
+    summaries = {shard: results.get(shard, {}).get('summary') or {} for shard in processes}
+    return {shard: process.returncode for shard, process in processes.items()}, summaries
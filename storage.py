@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import observe
+
+# Connection settings applied to every database
+DEFAULT_CACHE_SIZE_KIB = 64 * 1024  # Page cache per connection
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+
+class Database:
+    """One long-lived SQLite connection to a database file, shared by all threads.
+
+    The connection runs in WAL mode with synchronous=NORMAL, so readers don't
+    block the writer and commits don't fsync every row. Access is serialized
+    with a lock, and transaction() groups many statements into one commit.
+    The schema is versioned with PRAGMA user_version: migrations[i] upgrades
+    a database from version i to i + 1 and is either an SQL script or a
+    callable taking the connection.
+    """
+
+    def __init__(self, path, migrations=(), cache_size_kib=DEFAULT_CACHE_SIZE_KIB):
+        self.path = path
+        self.migrations = list(migrations)
+        self.cache_size_kib = cache_size_kib
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA busy_timeout={DEFAULT_BUSY_TIMEOUT_MS}")
+        self._migrate(conn)
+        return conn
+
+    def _migrate(self, conn):
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= len(self.migrations):
+            return
+        for target, migration in enumerate(self.migrations, start=1):
+            conn.execute("BEGIN IMMEDIATE")
+            # Read under the write lock: another process opening the database may have migrated it meanwhile
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.execute("COMMIT")
+                continue
+            try:
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for statement in migration.split(';'):
+                        if statement.strip():
+                            conn.execute(statement)
+                conn.execute(f"PRAGMA user_version={target}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of the block in a single write transaction on the shared connection.
+
+        The write lock is taken up front (BEGIN IMMEDIATE): a deferred transaction that
+        reads and then writes can't wait for another process' writer and fails with
+        "database is locked" instead. Plain reads go through fetchone() and fetchall()."""
+        with self._lock:
+            conn = self.connection
+            start = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                observe('db_transaction_duration_seconds', time.perf_counter() - start, database=os.path.basename(self.path))
+
+    def execute(self, sql, params=()):
+        """Run one statement in its own transaction and return all result rows."""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, rows):
+        """Run a statement for every row in a single transaction."""
+        with self.transaction() as conn:
+            conn.executemany(sql, rows)
+
+    def fetchone(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(path, migrations=()):
+    """Return the process-wide Database for a file, opening and migrating it on first use."""
+    with _databases_lock:
+        database = _databases.get(path)
+        if database is None:
+            database = Database(path, migrations)
+            _databases[path] = database
+        return database
@@ -2,7 +2,7 @@ from datetime import datetime
 import streamlit as st
 from datetime import datetime
 from api import deleteAsset, updateAsset
-from db import delete_duplicate_pair
+from db import delete_duplicate_pair, markAssetsDeleted
 
 def compare_and_color_data(value1, value2):
     date1 = datetime.fromisoformat(value1.rstrip('Z'))
@@ -26,16 +26,16 @@ def compare_and_color(value1, value2):
 
 def display_asset_column(col, asset1_info, asset2_info, asset_id_1,asset_id_2, server_url, api_key):
     details = f"""
-    - **File name:** {asset1_info[1]}
+    - **File name:** {asset1_info.original_file_name}
     - **Photo with ID:** {asset_id_1}
-    - **Size:** {compare_and_color(asset1_info[0], asset2_info[0])}
-    - **Resolution:** {compare_and_color(asset1_info[2], asset2_info[2])}
-    - **Lens Model:** {asset1_info[3]}
-    - **Created At:** {compare_and_color_data(asset1_info[4], asset2_info[4])}
-    - **Original Path:** {asset1_info[5]}
-    - **Is Offline:** {'Yes' if asset1_info[6] else 'No'}
-    - **Is Trashed:** {'Yes' if asset1_info[7] else 'No'}
-    - **Is Favorite:** {'Yes' if asset1_info[8] else 'No'}
+    - **Size:** {compare_and_color(asset1_info.file_size, asset2_info.file_size)}
+    - **Resolution:** {compare_and_color(asset1_info.resolution, asset2_info.resolution)}
+    - **Lens Model:** {asset1_info.lens_model}
+    - **Created At:** {compare_and_color_data(asset1_info.creation_date, asset2_info.creation_date)}
+    - **Original Path:** {asset1_info.original_path}
+    - **Is Offline:** {'Yes' if asset1_info.is_offline else 'No'}
+    - **Is Trashed:** {'Yes' if asset1_info.is_trashed else 'No'}
+    - **Is Favorite:** {'Yes' if asset1_info.is_favorite else 'No'}
     """
     with col:
         st.markdown(details, unsafe_allow_html=True)
@@ -50,6 +50,7 @@ def display_asset_column(col, asset1_info, asset2_info, asset_id_1,asset_id_2, s
                     st.session_state['generate_db_duplicate'] = False
                     #remove from asset db
                     delete_duplicate_pair(asset_id_1,asset_id_2)
+                    markAssetsDeleted([asset_id_1])
                 else:
                     st.error(f"Failed to delete photo {asset_id_1}")
             except Exception as e:
@@ -1,20 +1,10 @@
-import streamlit as st
-import time
 import os
-import torch
-import numpy as np
-import faiss
-from torchvision.models import resnet152, ResNet152_Weights
 from torchvision.transforms import Compose, Resize, ToTensor, Normalize
 
-from api import getVideo
-
 # Set the environment variable to allow multiple OpenMP libraries
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-# Load ResNet152 with pretrained weights
-model = resnet152(weights=ResNet152_Weights.DEFAULT)
-model.eval()  # Set model to evaluation mode
+# The embedding model is shared with the image path and loaded on first use via backbones.get_model()
 transform = Compose([
     Resize((224, 224)),  # Standard size for ImageNet-trained models
     ToTensor(),
@@ -23,4 +13,4 @@ transform = Compose([
 
 # Global variables for paths
 index_path = 'video_faiss_index.bin'
-metadata_path = 'video_metadata.npy'
\ No newline at end of file
+metadata_path = 'video_metadata.npy'